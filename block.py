@@ -2,12 +2,13 @@ class Block:
     """
     A block is a collection of transactions that are validated together.
     """
-    def __init__(self, prevblock, timestamp, transactions, userid):
+    def __init__(self, prevblock, timestamp, transactions, userid, tx_count=None):
         """
         prevblock: the previous (parent) block in the chain (None if genesis block)
         timestamp: the time the block was created
         transactions: a set of transactions in the block
         userid: the id of the user who mined the block
+        tx_count: number of transactions of a block without transaction objects (fluid transaction model)
         balances: a dictionary of the balances of all users in the network
         """
         self.prevblock = prevblock
@@ -28,15 +29,20 @@ class Block:
             self.height = self.prevblock.height + 1
             self.blkid = hash(str(prevblock.blkid) + str(timestamp) + str(trans_string) + str(userid))
 
+        # Number of transactions in the block and in the chain up to this block
+        self.tx_count = len(transactions) if tx_count is None else tx_count
+        self.chain_tx = self.tx_count if prevblock is None else prevblock.chain_tx + self.tx_count
+
         # Size in Kb
-        self.size = 8*(len(transactions) + 1) # Each transaction is 1 KB = 8 Kb, +1 due to coinbase transaction
+        self.size = 8*(self.tx_count + 1) # Each transaction is 1 KB = 8 Kb, +1 due to coinbase transaction
 
     def validate(self):
         """
         Validates the block by checking that the transactions are valid
         """
         balance_copy = self.balances.copy() #balance_copy shows cumulative balance after each transaction
-        for t in self.transactions:
+        # In id order, a shortfall must not depend on the order of the set
+        for t in sorted(self.transactions, key=lambda t: t.id):
             if t.sender == t.receiver:
                 return False
             if t.amount <= 0:
@@ -50,14 +56,38 @@ class Block:
         self.balances[self.userid] += 50 # Reward for mining the block
         return True
 
-    def get_all_transactions(self):
+    def get_all_transactions(self, root=None):
         """
         Returns a set of all transactions in the chain up to this block
+
+        root: tree node of a pruning checkpoint the chain stops at (its transactions are final and left out)
         """
-        if self.prevblock == None:
-            return self.transactions
-        return self.transactions.union(self.prevblock.get_all_transactions())
+        transactions = set([])
+        curr_block = self
+        while curr_block is not None and (root is None or curr_block is not root.block):
+            transactions |= curr_block.transactions
+            curr_block = curr_block.prevblock
+        return transactions
     
+    def chain_counts(self, root=None):
+        """
+        Returns a dictionary {userid: number of blocks mined} for the chain up to this block, genesis excluded
+
+        root: tree node of a pruning checkpoint, the blocks below it are counted from its checkpoint_counts
+        """
+        checkpoint = root.block if root is not None and root.checkpoint_counts is not None else None
+        counts = {}
+        curr_block = self
+        while curr_block is not checkpoint and curr_block.prevblock is not None:
+            counts[curr_block.userid] = counts.get(curr_block.userid, 0) + 1
+            curr_block = curr_block.prevblock
+
+        # The walk stops either at the genesis block or at a pruning checkpoint
+        if curr_block is checkpoint:
+            for userid, count in root.checkpoint_counts.items():
+                counts[userid] = counts.get(userid, 0) + count
+        return counts
+
     def __str__(self):
         """
         Returns a string representation of the block
@@ -0,0 +1,226 @@
+import gzip
+import os
+import pickle
+import random
+import time
+from block import Block
+from peer import Peer
+from selfish_peer import SelfishPeer
+from network import Network, exact_delay
+from metrics import CountingEnvironment
+
+# Bumped whenever the layout of the snapshot changes
+VERSION = 19
+
+PEER_CLASSES = {"Peer": Peer, "SelfishPeer": SelfishPeer}
+
+class SnapshotPickler(pickle.Pickler):
+    """
+    Pickler that writes peers, blocks, the environment and the network by reference
+
+    Blocks are queued and written one record at a time afterwards, so that long chains
+    do not recurse through prevblock and every block is stored exactly once.
+    """
+    def __init__(self, file, env, network):
+        super(SnapshotPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.env = env
+        self.network = network
+        self.seen_blocks = set([])
+        self.block_queue = []
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Block):
+            if obj.blkid not in self.seen_blocks:
+                self.seen_blocks.add(obj.blkid)
+                self.block_queue.append(obj)
+            return ("block", obj.blkid)
+        if isinstance(obj, Peer):
+            return ("peer", type(obj).__name__, obj.id)
+        if obj is self.env:
+            return ("env",)
+        if obj is self.network:
+            return ("network",)
+        if obj is random._inst:
+            # The delay matrix holds bound methods of the global generator
+            return ("rng",)
+        if obj is random:
+            # Generator of the peers and of the mining race without --rng streams
+            return ("random",)
+        return None
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """
+    Counterpart of SnapshotPickler, references are resolved to placeholders filled in later
+    """
+    def __init__(self, file):
+        super(SnapshotUnpickler, self).__init__(file)
+        self.env = None
+        self.network = Network.__new__(Network)
+        self.blocks = {}
+        self.peers = {}
+
+    def persistent_load(self, pid):
+        if pid[0] == "block":
+            if pid[1] not in self.blocks:
+                self.blocks[pid[1]] = Block.__new__(Block)
+            return self.blocks[pid[1]]
+        if pid[0] == "peer":
+            if pid[2] not in self.peers:
+                self.peers[pid[2]] = PEER_CLASSES[pid[1]].__new__(PEER_CLASSES[pid[1]])
+            return self.peers[pid[2]]
+        if pid[0] == "env":
+            return self.env
+        if pid[0] == "network":
+            return self.network
+        if pid[0] == "rng":
+            return random._inst
+        if pid[0] == "random":
+            return random
+        raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+
+def save_checkpoint(filename, env, peers, advs, network, args):
+    """
+    Snapshot the whole simulator state into filename
+
+    The file is a gzip stream of pickle records: a header, the peers and network,
+    then one record per block and a None terminator.
+    It is written to a temporary file first so an interrupted write never clobbers
+    the previous checkpoint.
+    """
+    start = time.time()
+    if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    tmp = filename + ".tmp"
+    with gzip.open(tmp, "wb", compresslevel=1) as f:
+        pickler = SnapshotPickler(f, env, network)
+        pickler.dump({"version": VERSION, "now": env.now, "events": getattr(env, "events_processed", 0), "args": vars(args), "rng": random.getstate()})
+        pickler.dump({
+            "honest": [p.id for p in peers],
+            "advs": [adv.id for adv in advs],
+            "peers": [(type(p).__name__, p.id, p.__dict__) for p in peers + advs],
+            # The trace is an open file, it is reopened in append mode on resume
+            "network": dict(network.__dict__, tracer=None),
+        })
+        # Writing a block can queue its parent, drain until the chain is complete
+        while pickler.block_queue:
+            block = pickler.block_queue.pop()
+            pickler.dump((block.blkid, block.__dict__))
+        pickler.dump(None)
+    os.replace(tmp, filename)
+
+    print(f"Checkpoint written to {filename} at time {env.now} in {time.time() - start:.2f}s")
+
+def load_checkpoint(filename):
+    """
+    Load a snapshot written by save_checkpoint
+
+    returns: env, honest peers, adversaries, network and the arguments of the checkpointed run
+    """
+    with gzip.open(filename, "rb") as f:
+        unpickler = SnapshotUnpickler(f)
+        header = unpickler.load()
+        if header["version"] != VERSION:
+            raise ValueError(f"Checkpoint {filename} has version {header['version']}, expected {VERSION}")
+
+        env = CountingEnvironment(header["now"], header["events"])
+        unpickler.env = env
+        state = unpickler.load()
+
+        record = unpickler.load()
+        while record is not None:
+            blkid, block_state = record
+            unpickler.persistent_load(("block", blkid)).__dict__.update(block_state)
+            record = unpickler.load()
+
+    for cls_name, id, peer_state in state["peers"]:
+        unpickler.persistent_load(("peer", cls_name, id)).__dict__.update(peer_state)
+    network = unpickler.network
+    network.__dict__.update(state["network"])
+
+    random.setstate(header["rng"])
+
+    peers = [unpickler.peers[id] for id in state["honest"]]
+    advs = [unpickler.peers[id] for id in state["advs"]]
+    return env, peers, advs, network, header["args"]
+
+def check_resumable(broadcast):
+    """
+    Raise a ValueError if a run with this broadcast mode cannot be checkpointed and resumed exactly
+    """
+    if broadcast != "concurrent":
+        raise ValueError("Checkpoints can only be resumed with --broadcast concurrent, a sequential relay waiting for a neighbor cannot be restored")
+
+def resume_processes(env, peers, advs, network, Ttx):
+    """
+    Recreate the simpy processes that were alive when the checkpoint was taken
+
+    Generator frames cannot be saved, so the work in progress is restarted from the bookkeeping:
+    messages on the wire are delivered at their original time, relays start again (the routing tables
+    skip the neighbors already served), and the pending transaction batches, the blocks being mined,
+    the next transaction of every peer and the next block of the mining race come at the time
+    scheduled before the snapshot.
+
+    With --broadcast sequential a relay waits for every neighbor to process the message, which
+    includes the neighbor's own relays and mining, and that wait cannot be rebuilt from the snapshot:
+    such runs are refused instead of resumed with different events.
+    """
+    check_resumable(network.broadcast)
+    in_flight = list(network.in_flight.values())
+    network.in_flight = {}
+    for kind, sender, receiver, item, deliver_at in in_flight:
+        env.process(network.deliver(kind, sender, receiver, item, exact_delay(env.now, deliver_at)))
+
+    for peer in peers + advs:
+        relaying = peer.relaying
+        peer.relaying = {}
+        for (kind, item_id), (item, count) in relaying.items():
+            if kind == "block":
+                env.process(peer.broadcast_block(item))
+            else:
+                env.process(peer.forward_transaction(item))
+
+        # The next batch leaves when it was scheduled, not a full interval after the resume
+        if peer.inventory:
+            peer.flush_scheduled = True
+            env.process(peer.flush_inventory(exact_delay(env.now, peer.flush_at) if peer.flush_at is not None else None))
+        else:
+            peer.flush_scheduled = False
+            peer.flush_at = None
+
+        # Blocks being mined are found at their original time, on the tip they were built on
+        mining = peer.mining
+        peer.mining = []
+        for block, found_at in mining:
+            env.process(peer.wait_block(block, exact_delay(env.now, found_at)))
+
+        if network.fluid is None:
+            # A peer forwarding its last transaction when the snapshot was taken draws the next one now
+            pending = None
+            if peer.next_transaction is not None:
+                at, coins = peer.next_transaction
+                pending = (exact_delay(env.now, at), coins)
+            env.process(peer.generate_transactions(Ttx, peers, pending))
+
+    if network.scheduler is not None:
+        delay = exact_delay(env.now, network.scheduler.next_block) if network.scheduler.next_block is not None else None
+        env.process(network.scheduler.run(delay))
+
+def checkpointer(env, filename, peers, advs, network, args, sim_interval=None, wall_interval=None):
+    """
+    Simpy process writing a checkpoint every sim_interval units of simulated time
+    and/or every wall_interval seconds of wall-clock time
+
+    The wall-clock condition is checked once per mean block interarrival time.
+    """
+    step = sim_interval if sim_interval is not None else args.I
+    last_sim = env.now
+    last_wall = time.time()
+    while True:
+        yield env.timeout(step)
+        due = sim_interval is not None and env.now - last_sim >= sim_interval
+        due = due or (wall_interval is not None and time.time() - last_wall >= wall_interval)
+        if due:
+            save_checkpoint(filename, env, peers, advs, network, args)
+            last_sim = env.now
+            last_wall = time.time()
@@ -0,0 +1,137 @@
+import math
+
+# Two sided 95% quantiles of the Student t distribution, indexed by degrees of freedom
+T_95 = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def t_quantile(dof):
+    """
+    95% two sided Student t quantile, the normal quantile is used past 30 degrees of freedom
+    """
+    if dof < len(T_95):
+        return T_95[dof]
+    return 1.960
+
+class BatchMeans:
+    """
+    Running mean and variance of batch means (Welford's algorithm)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0
+        self.m2 = 0
+
+    def add(self, value):
+        """
+        Add the mean of one batch
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(value - self.mean)
+
+    def half_width(self):
+        """
+        Half width of the 95% confidence interval of the mean, None with fewer than two batches
+        """
+        if self.count < 2:
+            return None
+        std = math.sqrt(self.m2/(self.count - 1))
+        return t_quantile(self.count - 1)*std/math.sqrt(self.count)
+
+class ConvergenceMonitor:
+    """
+    Estimates the adversaries' share of the main chain and the overall MPU with batch means
+    and stops the run once both confidence intervals are narrow enough
+
+    Every batch covers `batch` units of simulated time. Its share is the fraction of the
+    blocks added to the main chain of the first honest peer that were mined by an adversary,
+    its MPU is the growth of that chain divided by the blocks generated by honest peers.
+    """
+    def __init__(self, env, peers, advs, target_width, batch, max_time, min_batches=10):
+        """
+        env: simpy environment
+        peers: list of honest peers
+        advs: list of adversaries
+        target_width: stop once both 95% confidence intervals are narrower than this
+        batch: simulated time covered by one batch
+        max_time: time at which the run stops if it has not converged
+        min_batches: batches needed before the intervals are trusted
+        """
+        self.env = env
+        self.peers = peers
+        self.adv_ids = set([adv.id for adv in advs])
+        self.target_width = target_width
+        self.batch = batch
+        self.max_time = max_time
+        self.min_batches = min_batches
+
+        self.share = BatchMeans()
+        self.mpu = BatchMeans()
+        self.stop_reason = None
+
+        self.last_height = peers[0].longest_chain.height
+        self.last_gen = self.total_generated()
+
+    def total_generated(self):
+        return sum(p.num_gen for p in self.peers)
+
+    def end_batch(self):
+        """
+        Turn the blocks of the last batch into one observation of each metric
+        """
+        tip = self.peers[0].longest_chain
+        total_gen = self.total_generated()
+        if tip.height <= self.last_height or total_gen == self.last_gen:
+            # Nothing was added to the main chain, the batch carries no information
+            return
+
+        adv_blocks = 0
+        curr_block = tip
+        # A chain pruned above the last batch only loses the blocks collapsed into the checkpoint
+        while curr_block is not None and curr_block.height > self.last_height:
+            if curr_block.userid in self.adv_ids:
+                adv_blocks += 1
+            curr_block = curr_block.prevblock
+
+        new_blocks = tip.height - self.last_height
+        self.share.add(adv_blocks/new_blocks)
+        self.mpu.add(new_blocks/(total_gen - self.last_gen))
+
+        self.last_height = tip.height
+        self.last_gen = total_gen
+
+    def converged(self):
+        if self.share.count < self.min_batches or self.mpu.count < self.min_batches:
+            return False
+        return 2*self.share.half_width() <= self.target_width and 2*self.mpu.half_width() <= self.target_width
+
+    def run(self):
+        """
+        Simpy process that ends when the run has converged or reached max_time
+
+        returns: the reason the run stopped
+        """
+        while self.env.now + self.batch <= self.max_time:
+            yield self.env.timeout(self.batch)
+            self.end_batch()
+            if self.converged():
+                self.stop_reason = "converged"
+                return self.stop_reason
+
+        yield self.env.timeout(self.max_time - self.env.now)
+        self.stop_reason = "max time"
+        return self.stop_reason
+
+    def report(self, f):
+        """
+        Print the stop reason and the precision reached to the file f
+        """
+        print(f"Stopped : {self.stop_reason} at time {self.env.now}", file=f)
+        for name, estimate in [("Adversary share", self.share), ("Overall MPU (batch means)", self.mpu)]:
+            half_width = estimate.half_width()
+            if half_width is None:
+                print(f"{name} : not enough batches ({estimate.count})", file=f)
+            else:
+                print(f"{name} : {estimate.mean} +- {half_width} (95% CI width {2*half_width}, {estimate.count} batches)", file=f)
@@ -0,0 +1,262 @@
+import json
+import mmap
+import os
+import struct
+from block import Block
+from network import Network
+from tree import Node
+from fork_choice import ForkChoice
+from peer import Peer
+from selfish_peer import SelfishPeer
+
+MAGIC = b"P2PTRACE"
+VERSION = 2
+HEADER = struct.Struct("<8sII") # magic, version, length of the JSON metadata that follows
+
+# Every record has the same size, so record i of a memory mapped trace is at a fixed offset:
+# kind, simulated time, a double value, two 64 bit and two 32 bit integers
+RECORD = struct.Struct("<Bddqqii")
+
+BLOCK_CREATED = 1 # value: block timestamp, a: blkid, b: parent blkid, c: miner, d: height
+BLOCK_RECEIVED = 2 # a: blkid, b: sender id, c: receiving peer
+ADV_RELEASE = 3 # a: blkid, c: adversary
+TX_SUMMARY = 4 # a: transactions generated so far, b: mempool size of the miner, c: miner (-1 at the end of the run), d: transactions in the block
+NUM_GEN = 5 # a: blocks generated by the peer, c: peer (written when the trace is closed)
+TIPS = 6 # a: longest chain, b: private tip of an adversary (the longest chain for honest peers), c: peer (at close)
+ORPHANS = 7 # a: orphans buffered, b: orphans connected, c: peer, d: orphans evicted (at close)
+REORGS = 8 # a: reorgs, b: depth of the deepest reorg, c: peer (at close)
+RELAY = 9 # value: Kb sent to relay blocks, a: round trips for missing transactions, b: messages that waited for a busy link (at close)
+QUEUEING = 10 # value: total time spent waiting for a busy link (at close)
+
+class Tracer:
+    """
+    Appends the events of a run to a binary trace
+
+    The trace starts with a header holding the configuration of the run and of every peer,
+    followed by fixed size records: block creations (with parent, miner and timestamp), the arrival
+    of every block in the tree of every peer, the blocks released by the adversaries and a summary
+    of the transactions at every block. When the trace is closed, the final tips and counters of every
+    peer and of the network are appended. Replaying it rebuilds the trees without simulating the gossip.
+    """
+    def __init__(self, filename, peers, advs, genesis, args, append=False):
+        """
+        filename: trace file
+        peers: list of honest peers
+        advs: list of adversaries
+        genesis: genesis block
+        args: arguments of the run, stored in the header
+        append: continue an existing trace (used when resuming a checkpoint)
+        """
+        self.filename = filename
+        self.transactions = 0 # transactions generated since the start of the trace
+        # With the fluid transaction model the count comes from its counters, from where this segment starts
+        self.fluid = peers[0].network.fluid if peers and peers[0].network is not None else None
+        self.fluid_start = self.fluid.generated() if self.fluid is not None else 0
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        if append and os.path.exists(filename):
+            self.f = open(filename, "ab", buffering=1 << 20)
+            return
+
+        metadata = json.dumps({
+            "args": vars(args),
+            "genesis": genesis.blkid,
+            "peers": [{"id": p.id, "speed": p.speed, "cpu": p.cpu, "hashing power": p.hashing_power, "neighbors": [q.id for q in p.neighbors]} for p in peers],
+            "advs": [{"id": adv.id, "speed": adv.speed, "cpu": adv.cpu, "hashing power": adv.hashing_power, "selfish": adv.isSelfish, "neighbors": [q.id for q in adv.neighbors]} for adv in advs],
+        }, default=str).encode()
+        self.f = open(filename, "wb", buffering=1 << 20)
+        self.f.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+        self.f.write(metadata)
+
+    def write(self, kind, time, value=0.0, a=0, b=0, c=0, d=0):
+        self.f.write(RECORD.pack(kind, time, value, a, b, c, d))
+
+    def block_created(self, peer, block, pending):
+        """
+        peer mined block, pending is the size of its mempool
+        """
+        if self.fluid is not None:
+            self.transactions = self.fluid.generated() - self.fluid_start
+            pending = self.fluid.backlog(block.prevblock)
+        self.write(TX_SUMMARY, peer.env.now, 0.0, self.transactions, pending, peer.id, block.tx_count)
+        self.write(BLOCK_CREATED, peer.env.now, block.timestamp, block.blkid, block.prevblock.blkid, peer.id, block.height)
+
+    def block_received(self, peer, sender, block):
+        """
+        block joined the tree of peer
+        """
+        self.write(BLOCK_RECEIVED, peer.env.now, 0.0, block.blkid, sender.id, peer.id)
+
+    def adversary_release(self, adv, block):
+        """
+        The adversary broadcasts a block of its private chain
+        A release in progress when a checkpoint is taken is recorded again after the resume.
+        """
+        self.write(ADV_RELEASE, adv.env.now, 0.0, block.blkid, 0, adv.id)
+
+    def close(self, nodes):
+        """
+        Record the blocks generated by every peer (invalid blocks included), the final tips and the
+        counters of the peers and of the network, and close the trace
+        """
+        if self.fluid is not None:
+            self.transactions = self.fluid.generated() - self.fluid_start
+        if nodes:
+            self.write(TX_SUMMARY, nodes[0].env.now, 0.0, self.transactions, 0, -1, 0)
+        for p in nodes:
+            self.write(NUM_GEN, p.env.now, 0.0, p.num_gen, 0, p.id)
+            private = p.hidden_longest if isinstance(p, SelfishPeer) else p.longest_chain
+            self.write(TIPS, p.env.now, 0.0, p.longest_chain.blkid, private.blkid, p.id)
+            self.write(ORPHANS, p.env.now, 0.0, p.orphans_buffered, p.orphans_connected, p.id, p.orphans_evicted)
+            self.write(REORGS, p.env.now, 0.0, p.reorgs, p.max_reorg_depth, p.id)
+        if nodes and nodes[0].network is not None:
+            network = nodes[0].network
+            self.write(RELAY, network.env.now, network.block_kb, network.missing_tx_fetches, network.queued_messages)
+            self.write(QUEUEING, network.env.now, network.queueing_delay)
+        self.f.close()
+
+class TraceReader:
+    """
+    Memory mapped trace, the records are decoded lazily in file order
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a trace")
+        if version != VERSION:
+            raise ValueError(f"Trace {filename} has version {version}, expected {VERSION}")
+        self.metadata = json.loads(self.map[HEADER.size:HEADER.size + length])
+        self.offset = HEADER.size + length
+        # A run that died while writing can leave a partial record at the end
+        self.count = (len(self.map) - self.offset)//RECORD.size
+
+    def records(self):
+        """
+        Iterator over the records as tuples (kind, time, value, a, b, c, d)
+        """
+        return RECORD.iter_unpack(memoryview(self.map)[self.offset:self.offset + self.count*RECORD.size])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class Replay:
+    """
+    Peers and block trees rebuilt from a trace
+
+    The peers are Peer and SelfishPeer objects with only the state needed by save_tree, print_tree
+    and the metrics: their tree, their longest chain (and private tip), the blocks they generated,
+    their orphan and reorg counters and their configuration. Blocks carry no transactions. network holds
+    the relay and link counters of the run. The convergence report of --stop-ci is not replayed, and the
+    trees of a run with --prune-depth are rebuilt without pruning.
+    """
+    def __init__(self, filename):
+        reader = TraceReader(filename)
+        self.metadata = reader.metadata
+
+        genesis = Block.__new__(Block)
+        genesis.__dict__.update({"prevblock": None, "timestamp": 0, "transactions": set([]), "userid": -1,
+                                 "balances": {}, "height": 0, "blkid": self.metadata["genesis"], "size": 8,
+                                 "tx_count": 0, "chain_tx": 0})
+        self.blocks = {genesis.blkid: genesis}
+
+        self.peers = [self.make_peer(Peer, config, genesis) for config in self.metadata["peers"]]
+        self.advs = []
+        for config in self.metadata["advs"]:
+            adv = self.make_peer(SelfishPeer, config, genesis)
+            adv.isSelfish = config["selfish"]
+            self.advs.append(adv)
+        nodes = {p.id: p for p in self.peers + self.advs}
+        # Traces written before the links were recorded have no neighbors
+        for config in self.metadata["peers"] + self.metadata["advs"]:
+            nodes[config["id"]].neighbors = [nodes[id] for id in config.get("neighbors", [])]
+
+        self.releases = {adv.id: 0 for adv in self.advs}
+        self.transactions = 0
+        self.records = 0
+        created = {p.id: 0 for p in self.peers + self.advs}
+        tips = {}
+
+        self.network = Network.__new__(Network)
+        self.network.relay = self.metadata["args"].get("relay", "full")
+        self.network.link = self.metadata["args"].get("link", "independent")
+        self.network.block_kb = 0
+        self.network.missing_tx_fetches = 0
+        self.network.queued_messages = 0
+        self.network.queueing_delay = 0
+        generated_before = 0
+        num_gen = {}
+        for kind, time, value, a, b, c, d in reader.records():
+            self.records += 1
+            if kind == BLOCK_CREATED:
+                block = Block.__new__(Block)
+                block.__dict__.update({"prevblock": self.blocks[b], "timestamp": value, "transactions": set([]), "userid": c,
+                                       "balances": {}, "height": d, "blkid": a, "size": 8,
+                                       "tx_count": 0, "chain_tx": 0})
+                self.blocks[a] = block
+                created[c] += 1
+                self.add(nodes[c], block, time)
+            elif kind == BLOCK_RECEIVED:
+                self.add(nodes[c], self.blocks[a], time)
+            elif kind == ADV_RELEASE:
+                self.releases[c] += 1
+            elif kind == TX_SUMMARY:
+                # Every segment of a resumed run counts from zero and ends with its total
+                self.transactions = generated_before + a
+                if c == -1:
+                    generated_before += a
+            elif kind == NUM_GEN:
+                num_gen[c] = a
+            # The counters are cumulative, a resumed run overwrites those of the previous segments
+            elif kind == TIPS:
+                tips[c] = (a, b)
+            elif kind == ORPHANS:
+                nodes[c].orphans_buffered, nodes[c].orphans_connected, nodes[c].orphans_evicted = a, b, d
+            elif kind == REORGS:
+                nodes[c].reorgs, nodes[c].max_reorg_depth = a, b
+            elif kind == RELAY:
+                # Full blocks have a whole number of Kb, compact ones add fractional headers and short ids
+                self.network.block_kb = value if self.network.relay == "compact" else int(value)
+                self.network.missing_tx_fetches, self.network.queued_messages = a, b
+            elif kind == QUEUEING:
+                self.network.queueing_delay = value
+        reader.close()
+
+        for id, p in nodes.items():
+            p.num_gen = num_gen.get(id, created[id])
+            # A trace cut short by a crash has no tips, the best block of the tree is the closest guess
+            longest, private = tips.get(id, (p.fork_choice.best.blkid, p.fork_choice.best.blkid))
+            p.longest_chain = self.blocks[longest]
+            if isinstance(p, SelfishPeer):
+                p.hidden_longest = self.blocks[private]
+            p.chain_counts = p.longest_chain.chain_counts(p.root)
+
+    def make_peer(self, cls, config, genesis):
+        p = cls.__new__(cls)
+        p.id = config["id"]
+        p.speed = config["speed"]
+        p.cpu = config["cpu"]
+        p.hashing_power = config["hashing power"]
+        p.genesis = genesis
+        p.root = Node(genesis, 0)
+        p.node_block_map = {genesis.blkid: p.root}
+        p.fork_choice = ForkChoice(genesis)
+        p.orphans_buffered = 0
+        p.orphans_connected = 0
+        p.orphans_evicted = 0
+        p.reorgs = 0
+        p.max_reorg_depth = 0
+        return p
+
+    def add(self, peer, block, time):
+        """
+        Add block to the tree of peer, as receive_block does
+        """
+        parent = peer.node_block_map[block.prevblock.blkid]
+        if block.blkid not in parent.children:
+            parent.children.append(block.blkid)
+        peer.node_block_map[block.blkid] = Node(block, time)
+        peer.fork_choice.add(block)
@@ -0,0 +1,42 @@
+import random
+
+class FluidTransactions:
+    """
+    Fluid transaction model: transactions are counts instead of objects and are not gossiped
+
+    Every peer generates transactions at the rate 1/Ttx, kept as one arrival-rate counter per peer.
+    Transactions reach every peer much faster than blocks are found, so the mempool of a peer is
+    taken to be every transaction generated so far minus those already in the chain it mines on.
+    A block takes a random number of them, drawn like the detailed model draws from the pending
+    set, and only that number is stored in the block (its size, and so its latency, follow from it).
+    There are no balances to check, so every block is valid.
+    """
+    def __init__(self, env, nodes, Ttx):
+        """
+        env: simpy environment
+        nodes: list of all the peers (honest and adversaries)
+        Ttx: mean interarrival time of the transactions of every peer
+        """
+        self.env = env
+        self.rates = {p.id: 1/Ttx for p in nodes} # {peer id: transactions per unit of time}
+        self.total_rate = sum(self.rates.values())
+
+    def generated(self):
+        """
+        Number of transactions generated by all the peers up to now
+        """
+        return int(self.total_rate*self.env.now)
+
+    def backlog(self, tip):
+        """
+        Number of transactions waiting for a block on top of tip
+        """
+        return max(self.generated() - tip.chain_tx, 0)
+
+    def block_size(self, tip, rng=random):
+        """
+        Number of transactions of a new block on top of tip
+
+        rng: random generator of the miner
+        """
+        return rng.randint(0, min(self.backlog(tip), 999))
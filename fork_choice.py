@@ -0,0 +1,87 @@
+class Reorg:
+    """
+    Change of the best chain of a peer
+    """
+    def __init__(self, ancestor, disconnected, connected):
+        """
+        ancestor: last block common to the old and the new best chain
+        disconnected: blocks leaving the best chain, from the old tip down to the ancestor (excluded)
+        connected: blocks joining the best chain, from the ancestor (excluded) up to the new tip
+        """
+        self.ancestor = ancestor
+        self.disconnected = disconnected
+        self.connected = connected
+
+    def depth(self):
+        return len(self.disconnected)
+
+def chain_change(old_tip, new_tip):
+    """
+    Reorg from the chain of old_tip to the chain of new_tip, found by walking both down to their common ancestor
+    """
+    old_chain = old_tip
+    new_chain = new_tip
+    disconnected = []
+    connected = []
+    while old_chain.height > new_chain.height:
+        disconnected.append(old_chain)
+        old_chain = old_chain.prevblock
+    while new_chain.height > old_chain.height:
+        connected.append(new_chain)
+        new_chain = new_chain.prevblock
+    while old_chain is not new_chain:
+        disconnected.append(old_chain)
+        connected.append(new_chain)
+        old_chain = old_chain.prevblock
+        new_chain = new_chain.prevblock
+    connected.reverse()
+    return Reorg(old_chain, disconnected, connected)
+
+class ForkChoice:
+    """
+    Keeps the tips of a block tree and the best one, updated one block at a time
+
+    A block is better than the best tip if it is higher, or as high and older (the rule of the honest peers).
+    Every switch of the best tip is announced to the listeners as a Reorg, computed by walking
+    the two chains down to their common ancestor, in time proportional to the depth of the change.
+    """
+    def __init__(self, root):
+        """
+        root: first block of the tree (genesis block)
+        """
+        self.tips = {root.blkid: root}
+        self.best = root
+        self.listeners = []
+
+    def subscribe(self, listener):
+        """
+        listener: function called with the Reorg every time the best tip changes
+        """
+        self.listeners.append(listener)
+
+    def better(self, block, best):
+        if block.height > best.height:
+            return True
+        return block.height == best.height and block.timestamp < best.timestamp
+
+    def add(self, block):
+        """
+        Add a block whose parent is already in the tree
+
+        returns: the Reorg if the block became the best tip, None otherwise
+        """
+        self.tips.pop(block.prevblock.blkid, None)
+        self.tips[block.blkid] = block
+        if not self.better(block, self.best):
+            return None
+        return self.switch(block)
+
+    def switch(self, new_best):
+        """
+        Make new_best the best tip and announce the Reorg
+        """
+        reorg = chain_change(self.best, new_best)
+        self.best = new_best
+        for listener in self.listeners:
+            listener(reorg)
+        return reorg
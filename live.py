@@ -0,0 +1,147 @@
+import json
+import os
+import resource
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class LiveMetrics:
+    """
+    Live view of a running simulation served over HTTP from a background thread
+
+    Nothing is added to the simpy loop: every request reads the counters of the environment
+    and of the peers as they are at that moment, without locking. A value may be one event
+    old, which does not matter for monitoring. GET /metrics answers in the Prometheus text
+    format, any other path in JSON.
+    """
+    def __init__(self, env, peers, advs, address):
+        """
+        env: simpy environment (a CountingEnvironment to get event counts)
+        peers: list of honest peers
+        advs: list of adversaries
+        address: "port", "host:port" or "unix:/path/to/socket"
+        """
+        self.env = env
+        self.peers = peers
+        self.advs = advs
+        self.address = address
+
+        self.start_wall = time.time()
+        # Rate since the previous request, shared by all the clients
+        self.last_wall = self.start_wall
+        self.last_events = getattr(env, "events_processed", 0)
+
+        self.server = None
+        self.thread = None
+
+    def memory(self):
+        """
+        Resident and peak resident memory of the process in bytes
+        """
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kb on Linux, bytes on macOS
+        peak = peak if sys.platform == "darwin" else peak*1024
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            rss = peak
+        return rss, peak
+
+    def snapshot(self):
+        """
+        Current values of the exposed metrics
+        """
+        now_wall = time.time()
+        events = getattr(self.env, "events_processed", 0)
+        elapsed = now_wall - self.last_wall
+        rate = (events - self.last_events)/elapsed if elapsed > 0 else 0
+        self.last_wall = now_wall
+        self.last_events = events
+
+        rss, peak = self.memory()
+        return {
+            "sim_time": self.env.now,
+            "wall_time": now_wall - self.start_wall,
+            "events": events,
+            "events_per_sec": rate,
+            "events_per_sec_average": events/(now_wall - self.start_wall) if now_wall > self.start_wall else 0,
+            "memory_rss_bytes": rss,
+            "memory_peak_bytes": peak,
+            "heights": {str(p.id): p.longest_chain.height for p in self.peers + self.advs},
+            "adversaries": {str(adv.id): {"lead": adv.lead, "private_chain": len(adv.private_chain), "private_height": adv.hidden_longest.height} for adv in self.advs},
+        }
+
+    def prometheus(self, snapshot):
+        """
+        Snapshot in the Prometheus text exposition format
+        """
+        lines = []
+        for key in ["sim_time", "wall_time", "events", "events_per_sec", "events_per_sec_average", "memory_rss_bytes", "memory_peak_bytes"]:
+            lines.append(f"# TYPE simulator_{key} gauge")
+            lines.append(f"simulator_{key} {snapshot[key]}")
+        lines.append("# TYPE simulator_chain_height gauge")
+        for id, height in snapshot["heights"].items():
+            lines.append(f'simulator_chain_height{{peer="{id}"}} {height}')
+        for key in ["lead", "private_chain", "private_height"]:
+            lines.append(f"# TYPE simulator_adversary_{key} gauge")
+            for id, values in snapshot["adversaries"].items():
+                lines.append(f'simulator_adversary_{key}{{adversary="{id}"}} {values[key]}')
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """
+        Start serving in a daemon thread, which dies with the simulation
+        """
+        live = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = live.snapshot()
+                if self.path.startswith("/metrics"):
+                    body = live.prometheus(snapshot).encode()
+                    content_type = "text/plain; version=0.0.4"
+                else:
+                    body = json.dumps(snapshot).encode()
+                    content_type = "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # Unix sockets have no client address
+                return str(self.client_address[0]) if self.client_address else "unix"
+
+            def log_message(self, format, *args):
+                # stdout belongs to the simulator
+                pass
+
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+
+            class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            self.server = UnixHTTPServer(path, Handler)
+        else:
+            host, _, port = self.address.rpartition(":")
+            self.server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+            self.server.daemon_threads = True
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"Live metrics served on {self.address}", file=sys.stderr)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.address.startswith("unix:") and os.path.exists(self.address[len("unix:"):]):
+                os.remove(self.address[len("unix:"):])
+            self.server = None
@@ -0,0 +1,166 @@
+import linecache
+import os
+import tracemalloc
+
+# Frames kept per allocation, enough to get from simpy or the standard library back to the simulator
+DEPTH = 8
+
+SUBSYSTEMS = ["block store", "per-peer trees", "mempools", "routing tables", "simpy event queue", "other"]
+
+# Allocations made directly in these files
+FILE_SUBSYSTEMS = {
+    "block.py": "block store",
+    "tree.py": "per-peer trees",
+    "transaction.py": "mempools",
+    "fork_choice.py": "per-peer trees",
+}
+
+# Allocations made in the peers and the network, attributed by the source line (first match wins)
+LINE_SUBSYSTEMS = [
+    ("routing_table", "routing tables"),
+    ("node_block_map", "per-peer trees"),
+    ("Node(", "per-peer trees"),
+    ("children", "per-peer trees"),
+    ("orphan", "per-peer trees"),
+    ("Block(", "block store"),
+    ("transactions", "mempools"),
+    ("pending", "mempools"),
+    ("confirmed", "mempools"),
+    ("inventory", "mempools"),
+    ("env.process", "simpy event queue"),
+    ("env.timeout", "simpy event queue"),
+    ("in_flight", "simpy event queue"),
+    ("link_free_at", "simpy event queue"),
+]
+
+SIMULATOR_FILES = ["peer.py", "selfish_peer.py", "network.py", "mining.py", "pruning.py"]
+
+def start_tracing():
+    """
+    Start tracemalloc, before the simulation is built so that its initial state is traced
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(DEPTH)
+
+def classify(traceback):
+    """
+    Subsystem of an allocation, from the most recent frame that belongs to a known file
+    """
+    for frame in reversed(traceback):
+        if os.sep + "simpy" + os.sep in frame.filename:
+            return "simpy event queue"
+        name = os.path.basename(frame.filename)
+        if name in FILE_SUBSYSTEMS:
+            return FILE_SUBSYSTEMS[name]
+        if name in SIMULATOR_FILES:
+            line = linecache.getline(frame.filename, frame.lineno)
+            for keyword, subsystem in LINE_SUBSYSTEMS:
+                if keyword in line:
+                    return subsystem
+            return "other"
+    return "other"
+
+class MemoryProfiler:
+    """
+    Periodic tracemalloc snapshots of the simulation with the memory attributed to subsystems
+
+    Every allocation still alive is attributed to the block store, the per-peer trees, the mempools,
+    the routing tables or the simpy event queue from the file (and for the peers the source line)
+    that made it. Structural counts are recorded next to the bytes, and the report ends with the
+    growth of every subsystem and the allocation sites that grew the most, so that two versions
+    of the simulator can be compared on the same run.
+    """
+    def __init__(self, env, peers, advs, filename, interval):
+        """
+        env: simpy environment
+        peers: list of honest peers
+        advs: list of adversaries
+        filename: report file
+        interval: simulated time between two snapshots
+        """
+        self.env = env
+        self.peers = peers
+        self.advs = advs
+        self.filename = filename
+        self.interval = interval
+
+        self.rows = [] # [time, bytes per subsystem..., total, counts...]
+        self.first = None # first snapshot, to find the allocation sites that grew
+        self.last = None
+        start_tracing()
+
+    def counts(self):
+        """
+        Number of blocks, tree nodes, mempool entries, routing table entries and queued events
+        """
+        nodes = self.peers + self.advs
+        blocks = set([])
+        for p in nodes:
+            blocks.update(p.node_block_map.keys())
+        routing = 0
+        for p in nodes:
+            routing += sum(len(v) for v in p.transaction_routing_table.values())
+            routing += sum(len(v) for v in p.block_routing_table.values())
+        return [
+            len(blocks),
+            sum(len(p.node_block_map) for p in nodes),
+            sum(len(p.transactions) for p in nodes),
+            routing,
+            len(getattr(self.env, "_queue", [])),
+        ]
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+        ])
+        sizes = {subsystem: 0 for subsystem in SUBSYSTEMS}
+        for stat in snapshot.statistics("traceback"):
+            sizes[classify(stat.traceback)] += stat.size
+
+        self.rows.append([self.env.now] + [sizes[s] for s in SUBSYSTEMS] + [sum(sizes.values())] + self.counts())
+        if self.first is None:
+            self.first = snapshot
+        self.last = snapshot
+
+    def run(self):
+        """
+        Simpy process taking a snapshot every interval
+        """
+        while True:
+            self.take_snapshot()
+            yield self.env.timeout(self.interval)
+
+    def write(self, top=15):
+        """
+        Take a last snapshot and write the report
+        """
+        self.take_snapshot()
+        if os.path.dirname(self.filename) and not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+
+        columns = ["time"] + SUBSYSTEMS + ["total", "blocks", "tree nodes", "mempool entries", "routing entries", "queued events"]
+        with open(self.filename, 'w') as f:
+            print(f"# Memory profile, snapshot every {self.interval} units of simulated time, bytes traced by tracemalloc", file=f)
+            print(",".join(columns), file=f)
+            for row in self.rows:
+                print(",".join(str(value) for value in row), file=f)
+
+            first, last = self.rows[0], self.rows[-1]
+            duration = last[0] - first[0]
+            print(file=f)
+            print(f"# Growth from time {first[0]} to {last[0]}", file=f)
+            for i, name in enumerate(SUBSYSTEMS + ["total"]):
+                growth = last[i + 1] - first[i + 1]
+                rate = growth/duration if duration > 0 else 0
+                print(f"{name} : {last[i + 1]} bytes, {growth:+} bytes, {rate:.1f} bytes per unit of time", file=f)
+            blocks = last[len(SUBSYSTEMS) + 2]
+            if blocks > 0:
+                print(f"bytes per block : {last[len(SUBSYSTEMS) + 1]/blocks:.0f}", file=f)
+
+            print(file=f)
+            print(f"# Allocation sites that grew the most", file=f)
+            for stat in self.last.compare_to(self.first, "lineno")[:top]:
+                frame = stat.traceback[0]
+                print(f"{os.path.basename(frame.filename)}:{frame.lineno} {stat.size_diff:+} bytes ({stat.count_diff:+} blocks)", file=f)
+        print(f"Memory profile written to {self.filename}")
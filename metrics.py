@@ -0,0 +1,106 @@
+import os
+import time
+from array import array
+import simpy
+
+class CountingEnvironment(simpy.Environment):
+    """
+    Simpy environment that counts the events it has processed
+    """
+    def __init__(self, initial_time=0, events_processed=0):
+        super(CountingEnvironment, self).__init__(initial_time)
+        self.events_processed = events_processed
+
+    def step(self):
+        self.events_processed += 1
+        super(CountingEnvironment, self).step()
+
+class MetricsSampler:
+    """
+    Samples time series of the run at a fixed simulated interval
+
+    Every column has a preallocated buffer of `capacity` rows, when it is full the rows
+    are appended to a CSV file and the buffer is reused, so memory does not grow with the run.
+    """
+    def __init__(self, env, peers, advs, filename, interval, capacity=1024, append=False):
+        """
+        env: simpy environment (a CountingEnvironment to get event counts)
+        peers: list of honest peers
+        advs: list of adversaries
+        filename: CSV file the samples are written to
+        interval: simulated time between two samples
+        capacity: number of samples kept in memory before a flush
+        append: continue an existing file (used when resuming a checkpoint)
+        """
+        self.env = env
+        self.peers = peers
+        self.advs = advs
+        self.filename = filename
+        self.interval = interval
+        self.capacity = capacity
+
+        self.columns = ["time", "wall_time", "events", "events_per_sec", "orphans"]
+        self.columns += [f"height_{p.id}" for p in peers + advs]
+        self.columns += [f"mempool_{p.id}" for p in peers + advs]
+        for adv in advs:
+            self.columns += [f"lead_{adv.id}", f"private_chain_{adv.id}"]
+
+        self.buffers = [array('d', bytes(8*capacity)) for _ in self.columns]
+        self.size = 0
+
+        self.start_wall = time.time()
+        self.last_wall = self.start_wall
+        self.last_events = getattr(env, "events_processed", 0)
+
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        if not (append and os.path.exists(filename)):
+            with open(filename, 'w') as f:
+                print(",".join(self.columns), file=f)
+
+    def sample(self):
+        """
+        Record one row of every series
+        """
+        now_wall = time.time()
+        events = getattr(self.env, "events_processed", 0)
+        elapsed = now_wall - self.last_wall
+
+        # Orphans as seen by the first honest peer: blocks of its tree (pruned ones included) that are off its main chain
+        reference = self.peers[0]
+        orphans = len(reference.node_block_map) + reference.pruned_nodes - 1 - reference.longest_chain.height
+
+        row = [self.env.now, now_wall - self.start_wall, events, (events - self.last_events)/elapsed if elapsed > 0 else 0, orphans]
+        row += [p.longest_chain.height for p in self.peers + self.advs]
+        row += [p.mempool_size() for p in self.peers + self.advs]
+        for adv in self.advs:
+            row += [adv.lead, len(adv.private_chain)]
+
+        for buffer, value in zip(self.buffers, row):
+            buffer[self.size] = value
+        self.size += 1
+
+        self.last_wall = now_wall
+        self.last_events = events
+
+        if self.size == self.capacity:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered rows to the CSV file and empty the buffers
+        """
+        if self.size == 0:
+            return
+        with open(self.filename, 'a') as f:
+            for i in range(self.size):
+                print(",".join(repr(buffer[i]) for buffer in self.buffers), file=f)
+        self.size = 0
+
+    def run(self):
+        """
+        Simpy process sampling every interval
+        """
+        while True:
+            self.sample()
+            yield self.env.timeout(self.interval)
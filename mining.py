@@ -0,0 +1,64 @@
+import bisect
+import random
+
+class MiningScheduler:
+    """
+    Single mining race between all the peers instead of one create_block process per peer
+
+    Mining times are exponential, so the first block found by any peer comes after an
+    exponential time of rate (total hashing power)/interarrival and the winner is drawn
+    with a probability proportional to its hashing power. By memorylessness a peer that
+    switches to a new tip does not need a new mining time, it keeps mining on whatever tip
+    it has when it wins. One event is scheduled per block and the winner is found by a
+    binary search in the cumulative hashing powers, in O(log n).
+    """
+    def __init__(self, env, miners, interarrival):
+        """
+        env: simpy environment
+        miners: honest peers and adversaries taking part in the race
+        interarrival: mean time between two blocks of a peer holding all the hashing power
+        """
+        self.env = env
+        self.miners = miners
+        self.interarrival = interarrival
+
+        # Random generator of the race, a stream of its own with Network.use_streams
+        self.rng = random
+
+        # Ids of the miners simulated by this process in a parallel run, None for all of them. Every partition
+        # runs the same race and only the winners it owns build their block.
+        self.local = None
+
+        self.cumulative = []
+        self.total = 0
+        for miner in miners:
+            self.total += miner.hashing_power
+            self.cumulative.append(self.total)
+
+        self.blocks_found = 0
+        self.next_block = None # time the next block is found, used to resume from a checkpoint
+
+    def winner(self):
+        """
+        Miner finding the next block, drawn according to the hashing powers
+        """
+        index = bisect.bisect_right(self.cumulative, self.rng.random()*self.total)
+        return self.miners[min(index, len(self.miners) - 1)]
+
+    def run(self, delay=None):
+        """
+        Simpy process running the race, the winner builds its block on its current tip
+
+        delay: time left until the block that was awaited when a checkpoint was taken, None to draw a new one
+        """
+        while True:
+            if delay is None:
+                delay = self.rng.expovariate(self.total/self.interarrival)
+            self.next_block = self.env.now + delay
+            yield self.env.timeout(delay)
+            self.next_block = None
+            delay = None
+            self.blocks_found += 1
+            winner = self.winner()
+            if self.local is None or winner.id in self.local:
+                self.env.process(winner.mine_block())
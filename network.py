@@ -1,65 +1,151 @@
+import math
 import random 
 
+# Sizes in Kb used by compact block relay (BIP152)
+HEADER_SIZE = 80*8/1000 # 80 byte header
+SHORT_ID_SIZE = 6*8/1000 # 6 byte short transaction id
+TRANSACTION_SIZE = 8 # Each transaction is 1KB = 8Kb
+MESSAGE_HEADER_SIZE = 24*8/1000 # 24 byte header of a batched transaction message
+
+def exact_delay(now, when):
+    """
+    Delay of a timeout at now that fires exactly at when, a time computed earlier (by a sender, or before a checkpoint)
+
+    now + (when - now) can be rounded one unit away from when and swap the order of two events,
+    the delay is moved by one unit at a time until the sum is exact.
+    """
+    delay = when - now
+    while now + delay < when:
+        delay = math.nextafter(delay, math.inf)
+    while now + delay > when:
+        delay = math.nextafter(delay, -math.inf)
+    return delay
+
 class Network:
     """
     Network class that contains that handles the propagtions of transactions and blocks
     """
-    def __init__(self, peers, adv, interarrival, adv_conn, env) -> None:
+    def __init__(self, peers, advs, interarrival, adv_conns, env, relay="full", tx_relay="flood", trickle_interval=1000, link="independent", max_orphans=100, topology=None, broadcast="sequential") -> None:
         """
-        peers: list of peers in the network
-        adversary: the adversary peer
+        peers: list of honest peers in the network
+        advs: list of adversary peers (ids continue after the honest peers)
         interarrival: interarrival time of transactions
+        adv_conns: percentage of honest peers connected to each adversary
         env: simpy environment
+        relay: "full" to send whole blocks, "compact" to send the header and short transaction ids
+        tx_relay: "flood" to send every transaction on its own, "trickle" to batch them per neighbor
+        trickle_interval: time a peer collects new transactions before sending a batch (trickle only)
+        link: "independent" to give every message the full link speed, "shared" to queue the messages of a link
+        max_orphans: number of blocks without a known parent each peer keeps
+        topology: Topology giving the links and delays between honest peers, None to draw them
+        broadcast: "sequential" to send a block or transaction to one neighbor after the other, each send waiting
+                   until the neighbor has processed (and relayed) it, "concurrent" to send to every neighbor at once
         """
         self.peers = peers
-        self.adv = adv
+        self.advs = advs
         self.peer_ids = []
-        self.adv_id = adv.id
+        self.adv_ids = [adv.id for adv in advs]
         self.interarrival = interarrival
         
-        # Unnormalized percentage
-        self.adv_conn = adv_conn
+        # Unnormalized percentages, one per adversary
+        self.adv_conns = adv_conns
 
         for i in range(len(self.peers)):
             self.peer_ids.append(self.peers[i].id)
 
+        self.topology = topology
         self.generate_network()
         self.check_graph()
         self.init_properties()
 
         self.env = env
 
+        # Messages on the wire, kept so that a checkpoint can deliver them after a resume
+        # {token: (kind, sender, receiver, block or transaction, delivery time)}, a compact block waiting
+        # for its missing transactions is a "block fetch"
+        self.in_flight = {}
+        self.next_token = 0
+
+        if relay not in ("full", "compact"):
+            raise ValueError(f"Unknown relay mode '{relay}'")
+        self.relay = relay
+        self.block_kb = 0 # Kb sent to relay blocks
+        self.missing_tx_fetches = 0 # compact relays that needed a round trip for missing transactions
+
+        if tx_relay not in ("flood", "trickle"):
+            raise ValueError(f"Unknown transaction relay mode '{tx_relay}'")
+        self.tx_relay = tx_relay
+        self.trickle_interval = trickle_interval
+
+        if link not in ("independent", "shared"):
+            raise ValueError(f"Unknown link model '{link}'")
+        self.link = link
+        # Shared links transmit one message at a time in FIFO order
+        # Only links that have been used get an entry: {(sender id, receiver id): time the last queued message is fully sent}
+        self.link_free_at = {}
+        self.queued_messages = 0 # messages that found their link busy
+        self.queueing_delay = 0 # total time spent waiting for a busy link
+
+        self.max_orphans = max_orphans
+
+        if broadcast not in ("sequential", "concurrent"):
+            raise ValueError(f"Unknown broadcast mode '{broadcast}'")
+        self.broadcast = broadcast
+
+        # Seed of the random streams of the peers and of the mining race, None when every draw comes from the global generator
+        self.streams = None
+
+        # Partition of a parallel run (parallel.Partition) sending the messages to peers of other processes, None when this process simulates every peer
+        self.partition = None
+
+        # Mining race shared by all the peers, None when every peer runs its own create_block
+        self.scheduler = None
+
+        # Event trace of the run, None when no trace is recorded
+        self.tracer = None
+
+        # Fluid transaction model, None when every transaction is an object gossiped to the peers
+        self.fluid = None
+
     def generate_network(self):
         """
         Generate a random network with 4 neighbors for each peer 
         Fully connected graph
         """
-        for peer in self.peers:
-            num_neighbors = random.randint(4, 8)
-            num_neighbors = min(num_neighbors, len(self.peers))
+        if self.topology is not None:
+            # Sorted so that a topology read from the cache links the peers in the same order
+            for i, j in sorted(self.topology.edges):
+                self.peers[i].add_neighbor(self.peers[j])
+                self.peers[j].add_neighbor(self.peers[i])
+        else:
+            for peer in self.peers:
+                num_neighbors = random.randint(4, 8)
+                num_neighbors = min(num_neighbors, len(self.peers) - 1)
 
-            temp_list = list(set(self.peers.copy()) - set([peer]))
-            neighbors = random.sample(temp_list, num_neighbors)
+                # In id order, a set of peers would follow their memory addresses and change from run to run
+                temp_list = [p for p in self.peers if p is not peer]
+                neighbors = random.sample(temp_list, num_neighbors)
 
-            for n in neighbors:
-                peer.add_neighbor(n)
-                n.add_neighbor(peer)
+                for n in neighbors:
+                    peer.add_neighbor(n)
+                    n.add_neighbor(peer)
 
-        adv_neighbors = random.sample(range(len(self.peers)), (int) (self.adv_conn*len(self.peers)//100))
+        for adv, adv_conn in zip(self.advs, self.adv_conns):
+            adv_neighbors = random.sample(range(len(self.peers)), (int) (adv_conn*len(self.peers)//100))
 
-        print("Neighbors of adversary:", adv_neighbors)
+            print(f"Neighbors of adversary {adv.id}:", adv_neighbors)
 
-        for i in adv_neighbors:
-            self.peers[i].add_neighbor(self.adv)
-            self.adv.add_neighbor(self.peers[i])
+            for i in adv_neighbors:
+                self.peers[i].add_neighbor(adv)
+                adv.add_neighbor(self.peers[i])
 
     def check_graph(self):
         # check if the graph is connected
         # if not, connect the graph
 
         # Check this implementation again
-        # Adversary behaves just as the last of the peers
-        visited = [False for i in range(len(self.peers)+1)]
+        # Adversaries behave just as the last of the peers
+        visited = [False for i in range(len(self.peers)+len(self.advs))]
 
         def dfs(node):
             visited[node.id] = True
@@ -75,7 +161,19 @@ class Network:
 
         print("connected: ", connected)
 
-        if not connected:
+        if not connected and self.topology is not None:
+            # The generated graph of the honest peers is kept as it is, only an adversary
+            # left without neighbors (Z too small) can be cut off, it gets one honest neighbor
+            if not all(visited[p.id] for p in self.peers):
+                raise ValueError(f"Topology {self.topology.model} left the honest peers disconnected")
+            for adv in self.advs:
+                if not visited[adv.id]:
+                    peer = self.peers[random.randrange(len(self.peers))]
+                    print(f"Adversary {adv.id} has no neighbor, connected to peer {peer.id}")
+                    peer.add_neighbor(adv)
+                    adv.add_neighbor(peer)
+
+        elif not connected:
             # connect the graph
             num_peers = len(self.peers)
             for i in range(num_peers):
@@ -92,7 +190,7 @@ class Network:
         """
         Init the propagation delay, computation delay, and queueing delay for each peer pair
         """
-        temp_peers = self.peers + [self.adv]
+        temp_peers = self.peers + self.advs
 
         self.p = [[0 for i in range(len(temp_peers))] for j in range(len(temp_peers))]
         self.c = [[0 for i in range(len(temp_peers))] for j in range(len(temp_peers))]
@@ -111,6 +209,8 @@ class Network:
                     # In ms
                     if val != 0:
                         self.p[i][j] = val
+                    elif self.topology is not None and i < len(self.peers) and j < len(self.peers):
+                        self.p[i][j] = self.topology.delays[(min(i, j), max(i, j))]
                     else:
                         r = random.randint(10, 500)
                         self.p[i][j] = r
@@ -132,23 +232,142 @@ class Network:
                     else:
                         self.d[i][j] = random.expovariate
 
+    def use_streams(self, seed):
+        """
+        Give every peer a random generator of its own, seeded from seed and its id, for all its draws
+        (transactions, blocks, mining times and the queueing delays of the messages it sends)
+
+        The draws of a peer then do not depend on the order of the events of the other peers,
+        so a run gives the same results whether its peers are simulated by one process or several.
+        """
+        self.streams = seed
+        temp_peers = self.peers + self.advs
+        for peer in temp_peers:
+            peer.rng = self.stream(f"peer {peer.id}")
+        for i in range(len(temp_peers)):
+            for j in range(len(temp_peers)):
+                if i != j:
+                    self.d[i][j] = temp_peers[i].rng.expovariate
+
+    def stream(self, name):
+        """
+        Random generator of its own for name with use_streams, the random module otherwise
+        """
+        if self.streams is None:
+            return random
+        # Seeding with a string does not depend on the hash seed
+        return random.Random(f"{self.streams} {name}")
+
+    def track(self, kind, sender, receiver, item, latency):
+        """
+        Record a message put on the wire, returns the token used to forget it on delivery
+        """
+        token = self.next_token
+        self.next_token += 1
+        self.in_flight[token] = (kind, sender, receiver, item, self.env.now + latency)
+        return token
+
+    def latency(self, sender, receiver, size):
+        """
+        Latency in ms of a message of size Kb from sender to receiver
+
+        With shared links the message is transmitted once the messages ahead of it on
+        the same directed link are out, propagation of consecutive messages overlaps
+        """
+        transmission = size/self.c[sender.id][receiver.id]
+        wait = 0
+        if self.link == "shared":
+            key = (sender.id, receiver.id)
+            start = self.env.now
+            if key in self.link_free_at and self.link_free_at[key] > start:
+                start = self.link_free_at[key]
+                wait = start - self.env.now
+                self.queued_messages += 1
+                self.queueing_delay += wait
+            self.link_free_at[key] = start + transmission
+        return self.p[sender.id][receiver.id] + wait + transmission + self.d[sender.id][receiver.id](self.c[sender.id][receiver.id]/96)
+
     def send_transaction(self, sender, receiver, transaction):
         """
         Send and recieve a transaction from sender to receiver with latency
         """
         # print("Send transaction from", sender.id, "to", receiver.id)
-        # Each transaction is 1KB = 8Kb
-        latency = self.p[sender.id][receiver.id] + 8/self.c[sender.id][receiver.id] + self.d[sender.id][receiver.id](self.c[sender.id][receiver.id]/96)
+        latency = self.latency(sender, receiver, TRANSACTION_SIZE)
         # print("Latency:", latency)
 
+        token = self.track("transaction", sender, receiver, transaction, latency)
         yield self.env.timeout(latency)
+        del self.in_flight[token]
         yield self.env.process(receiver.receive_transaction(sender, transaction))
 
+    def send_inventory(self, sender, receiver, transactions):
+        """
+        Send a batch of transactions from sender to receiver as a single message
+        """
+        latency = self.latency(sender, receiver, MESSAGE_HEADER_SIZE + TRANSACTION_SIZE*len(transactions))
+        token = self.track("inventory", sender, receiver, transactions, latency)
+        yield self.env.timeout(latency)
+        del self.in_flight[token]
+        receiver.receive_inventory(sender, transactions)
+
     def send_block(self, sender, receiver, block):
         """
         Send and recieve a block from sender to receiver with latency
+
+        In compact mode only the header and short transaction ids are sent, the receiver
+        rebuilds the block from its own transactions and fetches the missing ones
+        with one more round trip
         """
-        latency = self.p[sender.id][receiver.id] + block.size/self.c[sender.id][receiver.id] + self.d[sender.id][receiver.id](self.c[sender.id][receiver.id]/96)
+        if self.relay == "compact":
+            size = HEADER_SIZE + SHORT_ID_SIZE*block.tx_count
+        else:
+            size = block.size
+        self.block_kb += size
+        latency = self.latency(sender, receiver, size)
+        if self.partition is not None and not self.partition.owns(receiver):
+            self.partition.post("block", sender, receiver, block, self.env.now + latency)
+            return
+        token = self.track("block", sender, receiver, block, latency)
         yield self.env.timeout(latency)
+        del self.in_flight[token]
+        yield from self.arrive_block(sender, receiver, block)
+
+    def arrive_block(self, sender, receiver, block):
+        """
+        End of send_block once the block reached the receiver: compact relay round trip, then reception
+        """
+        if self.relay == "compact":
+            missing = 0
+            for transaction in block.transactions:
+                if transaction not in receiver.transactions:
+                    missing += 1
+            if missing > 0:
+                # getblocktxn request followed by the blocktxn response
+                self.missing_tx_fetches += 1
+                self.block_kb += (SHORT_ID_SIZE + TRANSACTION_SIZE)*missing
+                latency = self.latency(receiver, sender, SHORT_ID_SIZE*missing) + self.latency(sender, receiver, TRANSACTION_SIZE*missing)
+                token = self.track("block fetch", sender, receiver, block, latency)
+                yield self.env.timeout(latency)
+                del self.in_flight[token]
+
         yield self.env.process(receiver.receive_block(sender,block))
-        print("Block received by", receiver.id)
\ No newline at end of file
+        print("Block received by", receiver.id)
+
+    def deliver(self, kind, sender, receiver, item, delay):
+        """
+        Finish the delivery of a message that was on the wire when a checkpoint was taken
+
+        A block goes through arrive_block like in send_block, so a compact block still fetches the
+        transactions the receiver is missing when it arrives.
+        """
+        token = self.track(kind, sender, receiver, item, delay)
+        yield self.env.timeout(delay)
+        del self.in_flight[token]
+        if kind == "block":
+            yield from self.arrive_block(sender, receiver, item)
+        elif kind == "block fetch":
+            yield self.env.process(receiver.receive_block(sender, item))
+        elif kind == "inventory":
+            receiver.receive_inventory(sender, item)
+        else:
+            yield self.env.process(receiver.receive_transaction(sender, item))
@@ -0,0 +1,120 @@
+import os
+import shutil
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Jobs waiting or running per worker thread before submit blocks
+PENDING_PER_WORKER = 16
+
+class OutputWriter:
+    """
+    Background stage writing the outputs of finished runs (trees, graphviz renders, HTML pages) while
+    the next run goes on
+
+    Jobs run in a pool of threads: graphviz renders in a dot subprocess and files are written without
+    holding the interpreter lock, so they overlap with the simulation. The number of pending jobs is
+    bounded, submit blocks while the queue is full so the outputs of many runs cannot pile up in memory.
+    A job must only read objects the next runs do not change (the peers of a finished run).
+    Errors do not stop the other jobs, they are reported by close.
+    """
+    def __init__(self, workers=2, max_pending=None):
+        """
+        workers: number of writer threads, 0 to run every job at once in the calling thread
+        max_pending: jobs waiting or running before submit blocks (default: PENDING_PER_WORKER per worker)
+        """
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="output") if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending if max_pending is not None else PENDING_PER_WORKER*max(workers, 1))
+        self.lock = threading.Lock()
+        self.futures = set([])
+        self.errors = [] # [(description, traceback)]
+        self.done = 0
+
+    def submit(self, description, function, *args):
+        """
+        Queue function(*args)
+
+        description: name of the output, used in the error report
+        """
+        if self.executor is None:
+            self.run(description, function, args)
+            return
+        self.slots.acquire()
+        future = self.executor.submit(self.run, description, function, args)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.finished)
+
+    def run(self, description, function, args):
+        try:
+            function(*args)
+        except Exception:
+            with self.lock:
+                self.errors.append((description, traceback.format_exc()))
+        with self.lock:
+            self.done += 1
+
+    def finished(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+
+    def flush(self):
+        """
+        Wait until every queued job is done
+
+        returns: the list of (description, traceback) of the jobs that failed so far
+        """
+        while True:
+            with self.lock:
+                pending = list(self.futures)
+            if not pending:
+                return list(self.errors)
+            for future in pending:
+                future.result()
+
+    def close(self, raise_errors=True):
+        """
+        Flush, stop the threads and print the errors
+
+        raise_errors: raise a RuntimeError if a job failed
+        """
+        errors = self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+        for description, trace in errors:
+            print(f"Could not write {description}:\n{trace}", file=sys.stderr)
+        if errors and raise_errors:
+            raise RuntimeError(f"{len(errors)} of {self.done} outputs could not be written")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Do not hide the exception of the run behind the errors of the outputs
+        self.close(raise_errors=exc_type is None)
+
+def submit(writer, description, function, *args):
+    """
+    Queue function(*args) on writer, or run it at once when writer is None
+    """
+    if writer is None:
+        function(*args)
+    else:
+        writer.submit(description, function, *args)
+
+def clear_folder(folder, writer=None):
+    """
+    Remove an output folder of a previous run: it is renamed at once, so the new outputs can be written
+    to folder right away, and deleted in the background
+    """
+    if not os.path.exists(folder):
+        return
+    if writer is None:
+        shutil.rmtree(folder)
+        return
+    old = f"{folder}.old.{os.getpid()}.{id(writer)}"
+    os.rename(folder, old)
+    writer.submit(f"removal of {folder}", shutil.rmtree, old)
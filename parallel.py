@@ -0,0 +1,330 @@
+import contextlib
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import traceback
+from block import Block
+import checkpoint
+import metrics
+from network import exact_delay
+
+class Partition:
+    """
+    Peers of a parallel run simulated by one process, with the messages they send to the peers of other processes
+
+    Every process starts from a copy of the whole network, but only the peers it owns mine and
+    receive: a block sent to a peer of another partition is posted with its delivery time instead of
+    being scheduled here. A message takes at least the propagation delay of its link, so the
+    messages posted during a window of the lookahead (the smallest delay of a link between two
+    partitions) are delivered after the window and can be exchanged at its end.
+
+    Blocks cross partitions as records, with the ancestors the other partition has not seen yet,
+    and are rebuilt there once (the fluid model has no transaction objects to carry).
+    """
+    def __init__(self, index, owner, env, network, nodes):
+        """
+        index: number of this partition
+        owner: partition of every peer, by peer id
+        env: simpy environment
+        network: Network of this process
+        nodes: every peer (honest and adversaries), by id
+        """
+        self.index = index
+        self.owner = owner
+        self.env = env
+        self.network = network
+        self.nodes = nodes
+        self.partitions = max(owner) + 1
+
+        self.outbox = {} # {partition: [(delivery time, sender id, receiver id, blkid, block records)]}
+        genesis = nodes[0].genesis
+        self.blocks = {genesis.blkid: genesis} # blocks sent to or received from other partitions {blkid: block}
+        self.known = [set([genesis.blkid]) for k in range(self.partitions)] # blkids every partition has from this one or sent to it
+        self.posted = 0
+        self.delivered = 0
+
+    def owns(self, peer):
+        return self.owner[peer.id] == self.index
+
+    def lookahead(self):
+        """
+        Smallest propagation delay of a link from a peer of this partition to a peer of another one
+        """
+        delays = [self.network.p[p.id][n.id] for p in self.nodes if self.owns(p) for n in p.neighbors if not self.owns(n)]
+        return min(delays) if delays else math.inf
+
+    def post(self, kind, sender, receiver, block, when):
+        """
+        Queue a block for a peer of another partition, delivered at time when
+        """
+        if kind != "block":
+            raise ValueError(f"Only blocks cross partitions, got a {kind}")
+        dest = self.owner[receiver.id]
+        known = self.known[dest]
+        records = []
+        curr_block = block
+        while curr_block.blkid not in known:
+            records.append((curr_block.blkid, curr_block.prevblock.blkid, curr_block.timestamp, curr_block.userid, curr_block.tx_count))
+            known.add(curr_block.blkid)
+            self.blocks[curr_block.blkid] = curr_block
+            curr_block = curr_block.prevblock
+        records.reverse()
+        self.outbox.setdefault(dest, []).append((when, sender.id, receiver.id, block.blkid, records))
+        self.posted += 1
+
+    def take_outbox(self):
+        outbox = self.outbox
+        self.outbox = {}
+        return outbox
+
+    def receive(self, messages):
+        """
+        Schedule the deliveries of the messages posted by the other partitions
+        """
+        # A block travels with the first message posted for it, rebuild them in the order they were posted
+        for when, sender_id, receiver_id, blkid, records in messages:
+            source = self.owner[sender_id]
+            for record_id, parent_id, timestamp, userid, tx_count in records:
+                if record_id not in self.blocks:
+                    block = Block(self.blocks[parent_id], timestamp, set([]), userid, tx_count)
+                    if block.blkid != record_id:
+                        raise RuntimeError(f"Block {record_id} rebuilt with id {block.blkid}, the processes do not share the hash seed")
+                    self.blocks[record_id] = block
+                self.known[source].add(record_id)
+
+        # Same order whatever the number of partitions
+        for when, sender_id, receiver_id, blkid, records in sorted(messages, key=lambda message: message[:3]):
+            self.env.process(self.deliver(self.nodes[sender_id], self.nodes[receiver_id], self.blocks[blkid], when))
+
+    def deliver(self, sender, receiver, block, when):
+        yield self.env.timeout(exact_delay(self.env.now, when))
+        self.delivered += 1
+        yield from self.network.arrive_block(sender, receiver, block)
+
+def check_options(args):
+    """
+    Raise a ValueError for the options a parallel run does not support
+    """
+    if args.tx_model != "fluid" or args.mining != "race" or args.broadcast != "concurrent" or args.rng != "streams":
+        raise ValueError("--parallel needs --tx-model fluid --mining race --broadcast concurrent --rng streams")
+    for option in ["replicates", "resume", "checkpoint", "metrics", "trace", "live", "memprofile", "stop_ci", "prune_depth"]:
+        if getattr(args, option) is not None:
+            raise ValueError(f"--parallel cannot be combined with --{option.replace('_', '-')}")
+
+def assign(network, partitions):
+    """
+    Partition of every peer, by peer id
+
+    The lookahead is the shortest link between two partitions, so the links are taken from the
+    shortest and their ends put in the same cluster as long as it stays under n/partitions peers.
+    The clusters are then spread over the partitions, largest first, each to the least loaded one.
+    """
+    nodes = network.peers + network.advs
+    capacity = math.ceil(len(nodes)/partitions)
+    links = sorted(set((network.p[p.id][n.id], min(p.id, n.id), max(p.id, n.id)) for p in nodes for n in p.neighbors))
+
+    cluster = list(range(len(nodes)))
+    size = [1]*len(nodes)
+    def find(i):
+        while cluster[i] != i:
+            cluster[i] = cluster[cluster[i]]
+            i = cluster[i]
+        return i
+    for delay, i, j in links:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j and size[root_i] + size[root_j] <= capacity:
+            cluster[root_j] = root_i
+            size[root_i] += size[root_j]
+
+    members = {}
+    for i in range(len(nodes)):
+        members.setdefault(find(i), []).append(i)
+    owner = [0]*len(nodes)
+    load = [0]*partitions
+    for group in sorted(members.values(), key=lambda group: (-len(group), group)):
+        index = load.index(min(load))
+        load[index] += len(group)
+        for i in group:
+            owner[i] = index
+    return owner
+
+def run_partition(index, args, env, peers, advs, network, owner, conn, filename):
+    """
+    Worker process simulating one partition, driven by run_parallel through conn
+
+    The network was built by run_parallel before the fork, every worker starts from a copy of it.
+    """
+    import run_selfish
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            nodes = peers + advs
+            partition = Partition(index, owner, env, network, nodes)
+            network.partition = partition
+            run_selfish.start_processes(env, peers, advs, network, args)
+            network.scheduler.local = set([p.id for p in nodes if partition.owns(p)])
+            conn.send(("ready", partition.lookahead(), env.peek()))
+
+            while True:
+                command = conn.recv()
+                if command[0] == "run":
+                    until, messages = command[1], command[2]
+                    partition.receive(messages)
+                    if until > env.now:
+                        env.run(until=until)
+                    conn.send(("window", partition.take_outbox(), env.peek()))
+                else:
+                    if args.time > env.now:
+                        env.run(until=args.time)
+                    save_partition(filename, env, network, [p for p in nodes if partition.owns(p)])
+                    conn.send(("saved", env.events_processed, {counter: getattr(network, counter) for counter in COUNTERS}))
+                    return
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+
+# Counters of the network summed over the partitions
+COUNTERS = ["block_kb", "missing_tx_fetches", "queued_messages", "queueing_delay"]
+
+def save_partition(filename, env, network, nodes):
+    """
+    Write the final state of the peers of a partition and of the blocks they reference
+
+    Unlike a checkpoint, the network (with its delay matrices) is not written, the process that
+    reads the file has it already.
+    """
+    with open(filename, "wb") as f:
+        pickler = checkpoint.SnapshotPickler(f, env, network)
+        pickler.dump([(type(p).__name__, p.id, p.__dict__) for p in nodes])
+        while pickler.block_queue:
+            block = pickler.block_queue.pop()
+            pickler.dump((block.blkid, block.__dict__))
+        pickler.dump(None)
+
+def load_partitions(filenames, env, network):
+    """
+    Read the files of save_partition into one set of peers and blocks
+
+    Every file fills the peers it owns, the references to the peers and blocks of the other
+    files resolve to the same objects, as in a run simulated by one process.
+
+    returns: {peer id: peer}
+    """
+    peers = {}
+    blocks = {}
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            unpickler = checkpoint.SnapshotUnpickler(f)
+            unpickler.env = env
+            unpickler.network = network
+            unpickler.peers = peers
+            unpickler.blocks = blocks
+            states = unpickler.load()
+            record = unpickler.load()
+            while record is not None:
+                blkid, block_state = record
+                unpickler.persistent_load(("block", blkid)).__dict__.update(block_state)
+                record = unpickler.load()
+        for cls_name, id, peer_state in states:
+            unpickler.persistent_load(("peer", cls_name, id)).__dict__.update(peer_state)
+    return peers
+
+def receive(conn, index):
+    reply = conn.recv()
+    if reply[0] == "error":
+        raise RuntimeError(f"Partition {index} failed:\n{reply[1]}")
+    return reply
+
+def run_parallel(args, partitions):
+    """
+    Run one simulation split across partitions processes, with a conservative synchronization
+
+    The processes advance in windows: every window starts at the earliest pending event or message of
+    all the partitions and lasts the lookahead, then the messages posted during the window are handed
+    to their partitions. Every draw of a peer comes from its own random stream, so the run gives the
+    same trees as the sequential engine with the same options (--rng streams --broadcast concurrent).
+
+    args: arguments of the run subcommand, with a seed
+    partitions: number of processes
+
+    returns: env, honest peers, adversaries and network, assembled from the final state of every partition
+    """
+    import run_selfish
+
+    start = time.time()
+    partitions = max(1, min(partitions, args.n))
+    random.seed(args.seed)
+    advs_config = run_selfish.parse_adversaries(args)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, peers, advs, network = run_selfish.build_simulation(args, advs_config, run_selfish.shared_topology(args, advs_config))
+    owner = assign(network, partitions)
+
+    directory = tempfile.mkdtemp(prefix="parallel_")
+    # Forked workers share the network built here and the hash seed of this process, so blocks get the same ids everywhere
+    context = multiprocessing.get_context("fork")
+    conns = []
+    workers = []
+    try:
+        for index in range(partitions):
+            parent_conn, child_conn = context.Pipe()
+            worker = context.Process(target=run_partition, args=(index, args, env, peers, advs, network, owner, child_conn, os.path.join(directory, f"partition_{index}.state")))
+            worker.start()
+            conns.append(parent_conn)
+            workers.append(worker)
+
+        next_times = []
+        lookahead = math.inf
+        for index, conn in enumerate(conns):
+            ready, partition_lookahead, next_time = receive(conn, index)
+            lookahead = min(lookahead, partition_lookahead)
+            next_times.append(next_time)
+        print(f"{partitions} partitions, lookahead {lookahead} ms, set up in {time.time() - start:.2f}s")
+
+        pending = [[] for index in range(partitions)]
+        windows = 0
+        messages = 0
+        while True:
+            now = min(next_times + [message[0] for inbox in pending for message in inbox])
+            if now >= args.time:
+                break
+            until = min(now + lookahead, args.time)
+            for index, conn in enumerate(conns):
+                conn.send(("run", until, pending[index]))
+                pending[index] = []
+            for index, conn in enumerate(conns):
+                window, outbox, next_times[index] = receive(conn, index)
+                for dest, posted in outbox.items():
+                    # Messages delivered after the end of the run are passed on too, they carry blocks later messages refer to
+                    pending[dest] += posted
+                    messages += len(posted)
+            windows += 1
+
+        for conn in conns:
+            conn.send(("finish",))
+        events = 0
+        for index, conn in enumerate(conns):
+            saved, partition_events, counters = receive(conn, index)
+            events += partition_events
+            for counter, value in counters.items():
+                setattr(network, counter, getattr(network, counter) + value)
+        for worker in workers:
+            worker.join()
+        print(f"Parallel run done in {time.time() - start:.2f}s: {windows} windows, {messages} messages between partitions")
+
+        # The peers built here are replaced by their final state in the partitions
+        env = metrics.CountingEnvironment(args.time, events)
+        nodes = load_partitions([os.path.join(directory, f"partition_{index}.state") for index in range(partitions)], env, network)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Every peer is taken from the partition that simulated it
+    network.env = env
+    network.peers = [nodes[p.id] for p in peers]
+    network.advs = [nodes[adv.id] for adv in advs]
+    return env, network.peers, network.advs, network
@@ -2,7 +2,7 @@ import random
 from transaction import Transaction
 from block import Block
 from tree import Node
-import graphviz
+from fork_choice import ForkChoice
 import os
 
 class Peer:
@@ -31,10 +31,41 @@ class Peer:
 
         self.env = env
         self.network = None
+        # Random generator of the draws of this peer: the random module, or a stream of its own (Network.use_streams)
+        self.rng = random
         self.root = Node(genesis, self.env.now)
         self.node_block_map = {genesis.blkid: self.root}
         self.hashing_power = config["hashing power"]
 
+        # Bookkeeping of work in progress, used to resume from a checkpoint
+        self.mining = [] # pending create_block calls: [(block being mined, time it is found)]
+        self.next_transaction = None # (time, coins) of the next transaction of generate_transactions
+        self.relaying = {} # {(kind, id): [block or transaction, number of ongoing relays]}
+
+        # Transactions waiting to be sent in a batch, used by trickle relay
+        self.inventory = {} # {neighbor: [list of transactions]}
+        self.flush_scheduled = False
+        self.flush_at = None # time of the next batch while one is scheduled
+
+        self.pruned_nodes = 0 # nodes removed from the tree by finality pruning
+        self.final_ids = set([]) # ids of the transactions below the pruning checkpoint, shared by all the peers
+
+        # Blocks that arrived before their parent
+        self.orphans = {} # {missing parent blkid: [(sender, block), ...]}
+        self.orphan_order = {} # {blkid: missing parent blkid}, in arrival order for eviction
+        self.orphans_buffered = 0
+        self.orphans_connected = 0
+        self.orphans_evicted = 0
+
+        # Fork choice keeps the best chain, the state below is updated by delta on every reorg
+        self.fork_choice = ForkChoice(genesis)
+        self.fork_choice.subscribe(self.on_reorg)
+        self.pending = set([]) # known transactions that are not in the longest chain
+        self.confirmed = set([]) # transactions in the longest chain
+        self.chain_counts = {} # {userid: blocks in the longest chain}
+        self.reorgs = 0 # switches that disconnected at least one block
+        self.max_reorg_depth = 0
+
     def use_network(self, network):
         """
         Use the network to send transactions and blocks
@@ -54,43 +85,104 @@ class Peer:
         Disconnect the peer from the network
         """
         self.neighbors = []
+
+    def mempool_size(self):
+        """
+        Number of known transactions that are not in the longest chain yet
+        """
+        if self.network.fluid is not None:
+            # No transaction objects, the backlog is what the fluid model would put in the next block
+            return self.network.fluid.backlog(self.longest_chain)
+        return len(self.pending)
     
-    def generate_transactions(self, Ttx, peers):
+    def generate_transactions(self, Ttx, peers, pending=None):
         """
         Generate transactions at a rate of Ttx
 
         Ttx: mean interarrival time of transactions
         peers: list of all peers in the network
+        pending: (time left, coins) of the transaction that was awaited when a checkpoint was taken, None to draw a new one
 
         returns: a generator
         """
         while True:
-            r = random.expovariate(1/Ttx) # same as exponential distribution with mean Ttx
-            coins = random.randint(1, 5)
+            if pending is None:
+                r = self.rng.expovariate(1/Ttx) # same as exponential distribution with mean Ttx
+                coins = self.rng.randint(1, 5)
+            else:
+                r, coins = pending
+                pending = None
+            self.next_transaction = (self.env.now + r, coins)
             yield self.env.timeout(r)
+            self.next_transaction = None
 
-            receiver = random.choice(peers)
+            receiver = self.rng.choice(peers)
             while receiver == self:
-                receiver = random.choice(peers)
+                receiver = self.rng.choice(peers)
             # generate a random transaction id by hashing the sender, receiver and time
             id = hash(str(self.id) + str(receiver.id) + str(self.env.now))
 
             transaction = Transaction(id, self, receiver, coins, self.env.now)
+            if self.network.tracer is not None:
+                self.network.tracer.transactions += 1
             yield self.env.process(self.forward_transaction(transaction))
 
             print(f"Peer {self.id} generated transaction {id} at time {self.env.now}")
     
+    def start_relay(self, kind, item_id, item):
+        """
+        Record that a block or transaction is being relayed to the neighbors
+        """
+        if (kind, item_id) in self.relaying:
+            self.relaying[(kind, item_id)][1] += 1
+        else:
+            self.relaying[(kind, item_id)] = [item, 1]
+
+    def end_relay(self, kind, item_id):
+        """
+        Record that a relay started with start_relay is over
+        """
+        entry = self.relaying[(kind, item_id)]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.relaying[(kind, item_id)]
+
+    def on_reorg(self, reorg):
+        """
+        Move to the new longest chain, only the blocks that changed are visited
+        """
+        for block in reorg.disconnected:
+            self.confirmed -= block.transactions
+            self.pending |= block.transactions & self.transactions
+            self.chain_counts[block.userid] -= 1
+        for block in reorg.connected:
+            self.confirmed |= block.transactions
+            self.pending -= block.transactions
+            self.chain_counts[block.userid] = self.chain_counts.get(block.userid, 0) + 1
+
+        if reorg.depth() > 0:
+            self.reorgs += 1
+            self.max_reorg_depth = max(self.max_reorg_depth, reorg.depth())
+
+        self.longest_chain = reorg.connected[-1]
+        self.balance = self.longest_chain.balances[self.id]
+
     def receive_transaction(self, sender, transaction):
         """
         Receive a transaction from a sender
         """
+        if transaction.id in self.final_ids:
+            # Late copy of a transaction that is already below the pruning checkpoint
+            return
         self.transactions.add(transaction) # add the transaction to the set of transactions 
+        if transaction not in self.confirmed:
+            self.pending.add(transaction)
         # change routing table to not send transaction back to sender
         if sender in self.transaction_routing_table.keys():
             if transaction.id not in self.transaction_routing_table[sender]:
-                self.transaction_routing_table[sender].append(transaction.id)
+                self.transaction_routing_table[sender].add(transaction.id)
         else:
-            self.transaction_routing_table[sender] = [transaction.id]
+            self.transaction_routing_table[sender] = set([transaction.id])
         yield self.env.process(self.forward_transaction(transaction))
 
     def forward_transaction(self, transaction):
@@ -101,21 +193,134 @@ class Peer:
         """
         # Forward a transaction to all neighbors
         # The structure of self.transaction_routing_table is:
-        # {recipient_peer: [list of TxIDs either sent to or received from this peer]}
+        # {recipient_peer: set of TxIDs either sent to or received from this peer}
+        if transaction.id in self.final_ids:
+            return
+        if self.network.tx_relay == "trickle":
+            self.queue_transaction(transaction)
+            return
+
+        self.start_relay("transaction", transaction.id, transaction)
         for n in self.neighbors:
             id = transaction.id
             if n in self.transaction_routing_table.keys():
                 # Send this transaction to the neighbor if it has not been sent to it before (to avoid loops)
                 # print(f"Peer {self.id} is sending transaction {id} to peer {n.id}")
                 if id not in self.transaction_routing_table[n]:
-                    self.transaction_routing_table[n].append(id)
-                    yield self.env.process(self.network.send_transaction(self, n, transaction))
+                    self.transaction_routing_table[n].add(id)
+                    send = self.env.process(self.network.send_transaction(self, n, transaction))
+                    if self.network.broadcast == "sequential":
+                        yield send
             else:
                 # Send this transaction to that neighbor 
                 # print(f"Peer {self.id} is sending transaction {id} to peer {n.id}")
-                self.transaction_routing_table[n] = [id]
-                yield self.env.process(self.network.send_transaction(self, n, transaction))
+                self.transaction_routing_table[n] = set([id])
+                send = self.env.process(self.network.send_transaction(self, n, transaction))
+                if self.network.broadcast == "sequential":
+                    yield send
+        self.end_relay("transaction", transaction.id)
+
+
+    def queue_transaction(self, transaction):
+        """
+        Queue a transaction for the next batch sent to every neighbor that has not seen it
+        """
+        id = transaction.id
+        for n in self.neighbors:
+            if n in self.transaction_routing_table.keys():
+                if id in self.transaction_routing_table[n]:
+                    continue
+                self.transaction_routing_table[n].add(id)
+            else:
+                self.transaction_routing_table[n] = set([id])
+
+            if n in self.inventory.keys():
+                self.inventory[n].append(transaction)
+            else:
+                self.inventory[n] = [transaction]
 
+        if self.inventory and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.env.process(self.flush_inventory())
+
+    def flush_inventory(self, delay=None):
+        """
+        Wait for the trickle interval and send one batch of transactions to each neighbor
+
+        delay: time left until the batch that was scheduled when a checkpoint was taken, None for a full interval
+        """
+        if delay is None:
+            delay = self.network.trickle_interval
+        self.flush_at = self.env.now + delay
+        yield self.env.timeout(delay)
+        self.flush_scheduled = False
+        self.flush_at = None
+        inventory = self.inventory
+        self.inventory = {}
+        for n, transactions in inventory.items():
+            self.env.process(self.network.send_inventory(self, n, transactions))
+
+    def receive_inventory(self, sender, transactions):
+        """
+        Receive a batch of transactions from a sender, only the new ones are relayed further
+        """
+        for transaction in transactions:
+            is_new = transaction not in self.transactions
+            self.transactions.add(transaction)
+            if transaction not in self.confirmed:
+                self.pending.add(transaction)
+            if sender in self.transaction_routing_table.keys():
+                if transaction.id not in self.transaction_routing_table[sender]:
+                    self.transaction_routing_table[sender].add(transaction.id)
+            else:
+                self.transaction_routing_table[sender] = set([transaction.id])
+            if is_new:
+                self.queue_transaction(transaction)
+
+    def buffer_orphan(self, sender, block):
+        """
+        Keep a block whose parent is unknown until the parent arrives, evicting the oldest orphan when the pool is full
+        """
+        if block.blkid in self.orphan_order.keys():
+            return
+
+        if len(self.orphan_order) >= self.network.max_orphans:
+            oldest, parent_id = next(iter(self.orphan_order.items()))
+            del self.orphan_order[oldest]
+            self.orphans[parent_id] = [entry for entry in self.orphans[parent_id] if entry[1].blkid != oldest]
+            if len(self.orphans[parent_id]) == 0:
+                del self.orphans[parent_id]
+            self.orphans_evicted += 1
+
+        parent_id = block.prevblock.blkid
+        if parent_id in self.orphans.keys():
+            self.orphans[parent_id].append((sender, block))
+        else:
+            self.orphans[parent_id] = [(sender, block)]
+        self.orphan_order[block.blkid] = parent_id
+        self.orphans_buffered += 1
+        print(f"{self.id} : Buffering orphan {block.blkid} waiting for {parent_id}")
+
+    def connect_orphans(self, blkid):
+        """
+        Add to the tree the orphans waiting for the block blkid, their own orphans follow in cascade
+
+        returns: True if at least one orphan joined the tree, an invalid one is dropped by receive_block
+        """
+        children = self.orphans.pop(blkid, None)
+        if children is None:
+            return False
+
+        # Out of the pool before the first one is received, a block buffered meanwhile must not evict them
+        for sender, child in children:
+            del self.orphan_order[child.blkid]
+        joined = False
+        for sender, child in children:
+            yield self.env.process(self.receive_block(sender, child))
+            if child.blkid in self.node_block_map.keys():
+                self.orphans_connected += 1
+                joined = True
+        return joined
 
     def receive_block(self, sender, block):
         """
@@ -125,6 +330,10 @@ class Peer:
         """
         # Receive a block from a peer
         #print("receive called")
+        if block.height <= self.root.block.height:
+            # Late copy of a block that has been collapsed into a pruning checkpoint (its balances are gone)
+            return
+
         isValid = block.validate()
         if not isValid:
             # print("Block is not valid")
@@ -135,8 +344,14 @@ class Peer:
         print("Current block ID : ", block.blkid)
         print("Previous block ID : ", block.prevblock.blkid)
         to_create = False
+        connected = False
+
+        if block.blkid in self.node_block_map.keys():
+            # Already in the tree, received again from another neighbor
+            print(f"{self.id} : Block {block.blkid} is already in the tree")
 
-        if block.prevblock.blkid in self.node_block_map.keys():
+        elif block.prevblock.blkid in self.node_block_map.keys():
+            connected = True
             # Add the block to the tree
             parent = self.node_block_map[block.prevblock.blkid]
             node = Node(block, self.env.now)
@@ -151,42 +366,71 @@ class Peer:
 
             # Update the node_block_map
             self.node_block_map[block.blkid] = node
+            if self.network.tracer is not None:
+                self.network.tracer.block_received(self, sender, block)
     
 
             print("Block height", block.height)
             print("Old longest chain height", self.longest_chain.height)
 
             # Assuming currently that block.height has the correct height
-            if block.height > self.longest_chain.height:
-                print(f"Peer {self.id} has a new longest chain")
-                self.longest_chain = block
-                self.balance = block.balances[self.id]
+            reorg = self.fork_choice.add(block)
+            if reorg is not None:
+                print(f"Peer {self.id} has a new longest chain (depth of the reorg {reorg.depth()})")
 
                 # New longest chain created
                 # Simulating PoW
                 to_create = True
 
-            elif block.height == self.longest_chain.height and block.timestamp < self.longest_chain.timestamp:
-                print(f"Peer {self.id} has a new longest chain with same height")
-                self.longest_chain = block
-                self.balance = block.balances[self.id]
-
-                # New longest chain created
-                # Simulating PoW
-                to_create = True
+        else:
+            # The parent has not arrived yet, keep the block until it does
+            self.buffer_orphan(sender, block)
 
         # Update routing table to not send block back to sender
         if sender in self.block_routing_table.keys():
             if block.blkid not in self.block_routing_table[sender]:
-                self.block_routing_table[sender].append(block.blkid)
+                self.block_routing_table[sender].add(block.blkid)
         else:
-            self.block_routing_table[sender] = [block.blkid]
+            self.block_routing_table[sender] = set([block.blkid])
         yield self.env.process(self.broadcast_block(block))
-        if to_create:
+
+        extended = False
+        if connected:
+            extended = yield self.env.process(self.connect_orphans(block.blkid))
+        # A connected child is a longer chain and has already started mining on it
+        # With the mining scheduler every peer is always mining on its current tip
+        if to_create and not extended and self.network.scheduler is None:
             yield self.env.process(self.create_block())
             pass
         
 
+    def build_block(self):
+        """
+        Block with a random set of pending transactions on top of the longest chain
+
+        returns: the block, None if it is not valid
+        """
+        if self.network.fluid is not None:
+            # Fluid transaction model: only the number of transactions is drawn
+            block = Block(self.longest_chain, self.env.now, set([]), self.id, self.network.fluid.block_size(self.longest_chain, self.rng))
+            block.validate()
+            return block
+
+        # Transactions of the longest chain are already out of self.pending
+        valid_transactions = self.pending
+        num_transactions = self.rng.randint(0, min(len(valid_transactions), 999))
+        # Sorted, the order of a set depends on its history and a resumed checkpoint rebuilds it
+        transactions = self.rng.sample(sorted(valid_transactions, key=lambda t: t.id), num_transactions)
+        block = Block(self.longest_chain, self.env.now, set(transactions), self.id)
+
+        # Haven't checked if the block is valid or not
+        # So, some transactions might get lost
+        isValid = block.validate()
+        if not isValid:
+            print("Invalid block created")
+            return None
+        return block
+
     def create_block(self):
         """
         Create a block and broadcast it to all neighbors in the network 
@@ -196,82 +440,110 @@ class Peer:
         print("Creating a block")
         self.num_gen += 1
         # yield self.env.timeout(self.id*1000)
-        longest_chain_transactions = self.longest_chain.get_all_transactions()
-        valid_transactions = self.transactions - longest_chain_transactions
-        # print(self.transactions, longest_chain_transactions, valid_transactions)
-        num_transactions = random.randint(0, min(len(valid_transactions), 999))
-        transactions = random.sample(valid_transactions, num_transactions)
-        longest_chain = self.longest_chain
-        block = Block(longest_chain, self.env.now, set(transactions), self.id)
-
-        # Haven't checked if the block is valid or not
-        # So, some transactions might get lost
-        isValid = block.validate()
-        if not isValid:
-            print("Invalid block created")
+        block = self.build_block()
+        if block is None:
             return
 
         # Next block timestamp (tk + Tk)
-        Tk = random.expovariate(self.hashing_power/self.network.interarrival)
+        Tk = self.rng.expovariate(self.hashing_power/self.network.interarrival)
+
+        yield from self.wait_block(block, Tk)
+
+    def wait_block(self, block, Tk):
+        """
+        Wait until the block being mined is found, it is kept only if the longest chain did not change meanwhile
 
+        block: block built on the longest chain
+        Tk: mining time
+        """
+        entry = (block, self.env.now + Tk)
+        self.mining.append(entry)
         yield self.env.timeout(Tk)
-        
+        self.mining.remove(entry)
+
         new_longest_chain = self.longest_chain
-        if new_longest_chain.blkid == longest_chain.blkid:
+        if new_longest_chain.blkid == block.prevblock.blkid:
             print("Chain is same")
-            print("Peer ID : ", self.id)
-            print("Creating block with block ID : ", block.blkid)
-            print("Previous block ID : ", block.prevblock.userid)
-            # Modify the longest chain and add the block to the tree
-            self.longest_chain = block
-            node = Node(block, self.env.now)
-            parent = self.node_block_map[block.prevblock.blkid]
-            print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
-            if node.block.blkid not in parent.children:
-                print("Adding the node to the tree")
-                print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
-                parent.children.append(node.block.blkid)
-                self.node_block_map[block.prevblock.blkid] = parent
-                print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
-                pass
-
-            self.node_block_map[block.blkid] = node
-            yield self.env.process(self.broadcast_block(block))
+            yield self.env.process(self.block_mined(block))
             # else:
                 # yield self.env.process(self.create_block())
             # self.print_tree(f"debug_plots/tree_{self.id}.dot")
 
+    def mine_block(self):
+        """
+        Called by the mining scheduler when this peer wins the race, the block is found right away
+        """
+        print("Creating a block")
+        self.num_gen += 1
+        block = self.build_block()
+        if block is None:
+            return
+        yield self.env.process(self.block_mined(block))
+
+    def block_mined(self, block):
+        """
+        Add a block mined by this peer on top of its longest chain to the tree and broadcast it
+        """
+        print("Peer ID : ", self.id)
+        print("Creating block with block ID : ", block.blkid)
+        print("Previous block ID : ", block.prevblock.userid)
+        # Modify the longest chain and add the block to the tree
+        node = Node(block, self.env.now)
+        parent = self.node_block_map[block.prevblock.blkid]
+        print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
+        if node.block.blkid not in parent.children:
+            print("Adding the node to the tree")
+            print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
+            parent.children.append(node.block.blkid)
+            self.node_block_map[block.prevblock.blkid] = parent
+            print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
+            pass
+
+        self.node_block_map[block.blkid] = node
+        if self.network.tracer is not None:
+            self.network.tracer.block_created(self, block, len(self.pending))
+        self.fork_choice.add(block)
+        yield self.env.process(self.broadcast_block(block))
+
 
     def broadcast_block(self, block):
         """
         Broadcast the block to all the neighbors in the network and update the block_routing_table
         The structure of self.block_routing_table is:
-        {recipient_peer: [list of blockIDs either sent to or received from this peer]}
+        {recipient_peer: set of blockIDs either sent to or received from this peer}
         """
 
         # Same as sending transaction
+        self.start_relay("block", block.blkid, block)
         for n in self.neighbors:
             id = block.blkid
             if n in self.block_routing_table.keys():
                 # Send this block to that neighbor some how
                 if id not in self.block_routing_table[n]:
                     print(f"{self.id} Broadcasting block to {n.id}")
-                    self.block_routing_table[n].append(id)
+                    self.block_routing_table[n].add(id)
 
-                    yield self.env.process(self.network.send_block(self, n, block))
+                    send = self.env.process(self.network.send_block(self, n, block))
+                    if self.network.broadcast == "sequential":
+                        yield send
             else:
                 # Send this block to that neighbor some how
                 print(f"{self.id} Broadcasting block to {n.id}")
-                self.block_routing_table[n] = [id]
+                self.block_routing_table[n] = set([id])
 
-                yield self.env.process(self.network.send_block(self, n, block))
+                send = self.env.process(self.network.send_block(self, n, block))
+                if self.network.broadcast == "sequential":
+                    yield send
                 # print("Block sent")
             print("Block sent")
+        self.end_relay("block", block.blkid)
 
-    def print_tree(self, filename):
+    def tree_graph(self, filename):
         """
-        Print the tree in a file using graphviz
+        Graphviz graph of the tree, rendered to filename by print_tree
         """
+        # Only needed for the plots, kept out of the import of the simulator
+        import graphviz
         f = graphviz.Digraph(filename, format='png')
 
         reverse_mapping = {}
@@ -320,26 +592,21 @@ class Peer:
 
         for e in edges:
             f.edge(e[0], e[1])
-        f.render()
+        return f
+
+    def print_tree(self, filename):
+        """
+        Print the tree in a file using graphviz
+        """
+        self.tree_graph(filename).render()
 
     def save_tree(self, filename):
         """
         Save the tree in a file using pickle
         """
-        if not os.path.exists(os.path.dirname(filename)):
-            os.makedirs(os.path.dirname(filename))
-
-        num_longest = 0
-
-        curr_block = self.longest_chain
-        prev_block = curr_block.prevblock
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-        while prev_block is not None:
-            if curr_block.userid == self.id:
-                num_longest += 1
-                
-            curr_block = prev_block
-            prev_block = curr_block.prevblock
+        num_longest = self.chain_counts.get(self.id, 0)
 
         with open(filename, 'w') as f:
 
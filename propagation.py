@@ -0,0 +1,179 @@
+import math
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Fractions of the honest peers for the coverage times
+COVERAGE = [0.5, 0.9, 1.0]
+
+def adversary_distances(peers, advs):
+    """
+    Number of hops from every honest peer to the closest adversary, by a breadth-first search
+    over the neighbors (nan without adversaries or when the links are not known)
+    """
+    distances = {p.id: math.nan for p in peers}
+    frontier = [adv for adv in advs if getattr(adv, "neighbors", None)]
+    seen = set([adv.id for adv in frontier])
+    hops = 0
+    while frontier:
+        hops += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor in node.neighbors:
+                if neighbor.id not in seen:
+                    seen.add(neighbor.id)
+                    distances[neighbor.id] = hops
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    return distances
+
+def correlation(x, y):
+    """
+    Pearson correlation of two arrays, ignoring nan entries (nan if one of them is constant)
+    """
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+    if len(x) < 2 or x.std() == 0 or y.std() == 0:
+        return math.nan
+    return float(np.corrcoef(x, y)[0, 1])
+
+class PropagationAnalysis:
+    """
+    Propagation delays of the blocks to the honest peers, from the arrival timestamps of the nodes of their trees
+
+    arrivals is a blocks x honest peers matrix of arrival times (nan where a peer never got the block).
+    The lag of a peer for a block is its arrival time minus the first arrival at an honest peer, which
+    is the creation time for honest blocks and the release time for withheld adversary blocks, so that
+    only the network is measured. Blocks no honest peer has seen (private or pruned) are left out.
+    """
+    def __init__(self, peers, advs):
+        """
+        peers: list of honest peers
+        advs: list of adversaries
+        """
+        if np is None:
+            raise ValueError("The propagation analysis needs the numpy package")
+        self.peers = peers
+        self.advs = advs
+
+        rows = {}
+        blocks = []
+        for p in peers:
+            for blkid, node in p.node_block_map.items():
+                if blkid not in rows and node is not p.root:
+                    rows[blkid] = len(blocks)
+                    blocks.append(node.block)
+        self.blocks = blocks
+
+        self.arrivals = np.full((len(blocks), len(peers)), np.nan)
+        for j, p in enumerate(peers):
+            for blkid, node in p.node_block_map.items():
+                if blkid in rows:
+                    self.arrivals[rows[blkid], j] = node.timestamp
+
+        self.created = np.array([block.timestamp for block in blocks], dtype=float)
+        self.miners = np.array([block.userid for block in blocks], dtype=int)
+        self.adversarial = np.isin(self.miners, [adv.id for adv in advs])
+        self.first = np.nanmin(self.arrivals, axis=1) if len(blocks) > 0 else np.zeros(0)
+        self.lags = self.arrivals - self.first[:, None]
+
+        # Time to reach a fraction of the honest peers: the k-th smallest lag of every block
+        ordered = np.sort(self.lags, axis=1)
+        self.coverage = {}
+        for fraction in COVERAGE:
+            k = max(int(math.ceil(fraction*len(peers))) - 1, 0)
+            self.coverage[fraction] = ordered[:, k] if len(peers) > 0 else np.zeros(0)
+
+        # Lags of every peer for the blocks mined by others
+        ids = np.array([p.id for p in peers], dtype=int)
+        self.peer_lags = np.where(self.miners[:, None] == ids[None, :], np.nan, self.lags)
+
+        self.slow = np.array([p.speed == "slow" for p in peers], dtype=float)
+        self.low_cpu = np.array([p.cpu == "low" for p in peers], dtype=float)
+        distances = adversary_distances(peers, advs)
+        self.distances = np.array([distances[p.id] for p in peers], dtype=float)
+
+    def peer_stats(self):
+        """
+        Lag distribution of every honest peer: blocks received, mean, median, 90th percentile, maximum
+        and fraction of the blocks never received
+        """
+        received = (~np.isnan(self.peer_lags)).sum(axis=0)
+        stats = []
+        for j, p in enumerate(self.peers):
+            column = self.peer_lags[:, j]
+            column = column[~np.isnan(column)]
+            if len(column) == 0:
+                stats.append([p.id, 0] + [math.nan]*4 + [1.0])
+                continue
+            stats.append([p.id, int(received[j]), float(column.mean()), float(np.median(column)), float(np.percentile(column, 90)),
+                          float(column.max()), 1 - received[j]/max(len(self.blocks) - (self.miners == p.id).sum(), 1)])
+        return stats
+
+    def correlations(self):
+        """
+        Correlation of the mean lag of the peers with being slow, having a low CPU and the distance to the adversaries
+        """
+        received = (~np.isnan(self.peer_lags)).sum(axis=0)
+        total = np.nansum(self.peer_lags, axis=0)
+        mean_lags = np.where(received > 0, total/np.maximum(received, 1), np.nan)
+        return {
+            "slow": correlation(self.slow, mean_lags),
+            "low cpu": correlation(self.low_cpu, mean_lags),
+            "hops to adversary": correlation(self.distances, mean_lags),
+        }
+
+    def class_means(self):
+        """
+        Mean lag of the blocks received by the peers of every speed and cpu class
+        """
+        means = {}
+        for name, mask in [("slow", self.slow == 1), ("fast", self.slow == 0), ("low cpu", self.low_cpu == 1), ("high cpu", self.low_cpu == 0)]:
+            lags = self.peer_lags[:, mask]
+            lags = lags[~np.isnan(lags)]
+            means[name] = float(lags.mean()) if len(lags) > 0 else math.nan
+        return means
+
+    def write(self, filename):
+        """
+        Write the per block coverage times, the per peer lag distributions and the correlations as CSV sections
+        """
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        honest = ~self.adversarial
+        with open(filename, 'w') as f:
+            print(f"# Block propagation to {len(self.peers)} honest peers, times in units of simulated time after the first honest arrival", file=f)
+            for name, mask in [("honest blocks", honest), ("adversary blocks", self.adversarial)]:
+                print(f"# {name} : {int(mask.sum())}", file=f)
+                for fraction in COVERAGE:
+                    times = self.coverage[fraction][mask]
+                    times = times[~np.isnan(times)]
+                    if len(times) > 0:
+                        print(f"time to {fraction:.0%} : mean {times.mean():.2f}, median {np.median(times):.2f}, 90th percentile {np.percentile(times, 90):.2f} ({len(times)} blocks)", file=f)
+                    else:
+                        print(f"time to {fraction:.0%} : no block reached it", file=f)
+
+            print(file=f)
+            print("# Mean lag by class", file=f)
+            for name, mean in self.class_means().items():
+                print(f"{name} : {mean:.2f}", file=f)
+            print("# Correlation of the mean lag of a peer with", file=f)
+            for name, value in self.correlations().items():
+                print(f"{name} : {value:.3f}", file=f)
+
+            print(file=f)
+            print("peer,speed,cpu,hops to adversary,blocks received,mean lag,median lag,p90 lag,max lag,missed", file=f)
+            for j, row in enumerate(self.peer_stats()):
+                p = self.peers[j]
+                print(",".join(str(value) for value in [row[0], p.speed, p.cpu, self.distances[j]] + row[1:]), file=f)
+
+            print(file=f)
+            print("block,height,miner,adversary,created,first arrival," + ",".join(f"time to {fraction:.0%}" for fraction in COVERAGE), file=f)
+            for i, block in enumerate(self.blocks):
+                print(",".join(str(value) for value in [block.blkid, block.height, block.userid, int(self.adversarial[i]), block.timestamp, self.first[i]]
+                               + [self.coverage[fraction][i] for fraction in COVERAGE]), file=f)
+        print(f"Propagation analysis written to {filename}")
@@ -0,0 +1,153 @@
+class Pruner:
+    """
+    Collapses the blocks that are final for every peer into a checkpoint
+
+    A block is final once it is an ancestor of every live tip (the longest chain of every peer
+    and the private tip of every adversary) with at least `depth` blocks on top of it.
+    The deepest final block becomes the root of the tree of every peer and the number of blocks
+    mined by each user up to it is kept in the checkpoint_counts of the root node, so that MPU and
+    the share of the main chain stay exact without walking below it. The blocks below the checkpoint
+    lose their transactions and balances and the checkpoint loses its link to its parent, so only the
+    live fork window stays in memory (the checkpoint keeps its height, balances and chain_tx). Dead
+    branches forking below the checkpoint are dropped from the trees and the final transactions are
+    dropped from the mempools and routing tables, their ids are kept in a set shared by all the peers
+    so that late copies are not relayed or mined again.
+    """
+    def __init__(self, env, peers, advs, depth, interval):
+        """
+        env: simpy environment
+        peers: list of honest peers
+        advs: list of adversaries
+        depth: confirmations needed before a block is final
+        interval: simulated time between two pruning passes
+        """
+        self.env = env
+        self.peers = peers
+        self.advs = advs
+        self.depth = depth
+        self.interval = interval
+
+        # The current checkpoint (genesis block until the first pass, or the root restored from a checkpoint file)
+        self.finalized = peers[0].root.block
+        self.counts = peers[0].root.checkpoint_counts if peers[0].root.checkpoint_counts is not None else {}
+        self.pruned_blocks = 0 # blocks collapsed into checkpoints
+
+        # Ids of the final transactions, one set for every peer (kept when resuming from a checkpoint file)
+        self.final_ids = peers[0].final_ids
+        for peer in peers + advs:
+            peer.final_ids = self.final_ids
+
+    def live_tips(self):
+        tips = [p.longest_chain for p in self.peers + self.advs]
+        tips += [adv.hidden_longest for adv in self.advs]
+        return tips
+
+    def ancestor_at(self, block, height):
+        """
+        Ancestor of block at the given height, None if the chain is cut above it
+        """
+        while block is not None and block.height > height:
+            block = block.prevblock
+        return block
+
+    def find_final_block(self):
+        """
+        Deepest block that is final for every live tip, None if it is not above the current checkpoint
+        """
+        tips = self.live_tips()
+        height = min(tip.height for tip in tips) - self.depth
+        if height <= self.finalized.height:
+            return None
+
+        candidate = self.ancestor_at(tips[0], height)
+        for tip in tips[1:]:
+            other = self.ancestor_at(tip, candidate.height)
+            # Tips on different branches at this height, go down to their common ancestor
+            while other is not candidate:
+                if other is None or candidate is None:
+                    return None
+                other = other.prevblock
+                candidate = candidate.prevblock
+            if candidate.height <= self.finalized.height:
+                return None
+        return candidate
+
+    def prune(self):
+        """
+        One pruning pass
+        """
+        final = self.find_final_block()
+        if final is None:
+            return
+
+        # Collapse the main chain between the old and the new checkpoint
+        counts = dict(self.counts)
+        final_transactions = set([])
+        collapsed = 0
+        curr_block = final
+        while curr_block is not self.finalized:
+            counts[curr_block.userid] = counts.get(curr_block.userid, 0) + 1
+            final_transactions |= curr_block.transactions
+            collapsed += 1
+            curr_block = curr_block.prevblock
+
+        # Blocks below the checkpoint are never read again (late copies are rejected by their height),
+        # their transactions and balances are dropped and the chain is cut so they can be freed
+        curr_block = final.prevblock
+        while curr_block is not None:
+            curr_block.transactions = set([])
+            curr_block.balances = {}
+            curr_block = curr_block.prevblock
+        final.prevblock = None
+
+        self.counts = counts
+        self.finalized = final
+        self.pruned_blocks += collapsed
+
+        final_ids = set([t.id for t in final_transactions])
+        self.final_ids |= final_ids
+        for peer in self.peers + self.advs:
+            self.prune_peer(peer, final, counts, final_transactions, final_ids)
+
+        print(f"Pruned {collapsed} blocks, checkpoint at height {final.height} ({final.blkid})")
+
+    def prune_peer(self, peer, final, counts, final_transactions, final_ids):
+        """
+        Keep only the subtree of the checkpoint in the tree of peer and forget the final transactions
+
+        counts: {userid: blocks mined up to and including the checkpoint}
+        """
+        if final.blkid not in peer.node_block_map:
+            return
+
+        kept = {}
+        stack = [final.blkid]
+        while stack:
+            blkid = stack.pop()
+            node = peer.node_block_map[blkid]
+            kept[blkid] = node
+            stack.extend(node.children)
+
+        pruned_ids = set(peer.node_block_map.keys()) - set(kept.keys())
+        peer.pruned_nodes += len(pruned_ids)
+        peer.node_block_map = kept
+        peer.root = kept[final.blkid]
+        peer.root.checkpoint_counts = counts
+
+        peer.fork_choice.tips = {blkid: block for blkid, block in peer.fork_choice.tips.items() if blkid in kept}
+
+        peer.transactions -= final_transactions
+        peer.confirmed -= final_transactions
+        # New sets, a set does not give back the memory of the entries removed from it
+        for neighbor in peer.transaction_routing_table.keys():
+            peer.transaction_routing_table[neighbor] = peer.transaction_routing_table[neighbor] - final_ids
+        for neighbor in peer.block_routing_table.keys():
+            peer.block_routing_table[neighbor] = peer.block_routing_table[neighbor] - pruned_ids
+
+    def run(self):
+        """
+        Simpy process pruning every interval
+        """
+        while True:
+            yield self.env.timeout(self.interval)
+            self.prune()
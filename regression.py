@@ -0,0 +1,245 @@
+import contextlib
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Small seeded runs covering both strategies, a few h/Z points and the modes that change results, options of the run subcommand
+SCENARIOS = {
+    "selfish_h03_z50": {"adv": ["0.3,50,selfish"]},
+    "selfish_h05_z25": {"adv": ["0.5,25,selfish"]},
+    "selfish_h05_z75": {"adv": ["0.5,75,selfish"]},
+    "stubborn_h03_z50": {"adv": ["0.3,50,stubborn"]},
+    "stubborn_h05_z75": {"adv": ["0.5,75,stubborn"]},
+    "selfish_fluid_h04_z50": {"adv": ["0.4,50,selfish"], "tx_model": "fluid"},
+    "selfish_h03_z50_gossip": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000},
+    "selfish_h03_z50_compact": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "relay": "compact"},
+    "selfish_h03_z50_trickle": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "tx_relay": "trickle"},
+    # Blocks every 300 ms keep the links busy
+    "selfish_h03_z50_shared": {"adv": ["0.3,50,selfish"], "I": 300, "time": 90000, "link": "shared"},
+    "selfish_h03_z50_pruned": {"adv": ["0.3,50,selfish"], "prune_depth": 6},
+    "selfish_h03_z50_per_peer": {"adv": ["0.3,50,selfish"], "mining": "per-peer"},
+    "selfish_h03_z50_per_peer_concurrent": {"adv": ["0.3,50,selfish"], "mining": "per-peer", "broadcast": "concurrent"},
+    # Stopped at resume_at, saved to a checkpoint, loaded and run on until time
+    "selfish_h03_z50_per_peer_resumed": {"adv": ["0.3,50,selfish"], "mining": "per-peer", "broadcast": "concurrent", "resume_at": 450000},
+    "selfish_h03_z50_gossip_concurrent": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "broadcast": "concurrent"},
+    "selfish_h03_z50_gossip_resumed": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "broadcast": "concurrent", "resume_at": 150000},
+    # Resumed with compact blocks and transaction batches in flight
+    "selfish_h03_z50_compact_trickle_concurrent": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "broadcast": "concurrent", "relay": "compact", "tx_relay": "trickle"},
+    "selfish_h03_z50_compact_trickle_resumed": {"adv": ["0.3,50,selfish"], "Ttx": 20000, "time": 300000, "broadcast": "concurrent", "relay": "compact", "tx_relay": "trickle", "resume_at": 123457},
+    # Long enough for the chain below the checkpoint to dominate the memory of the unpruned run
+    "selfish_fluid_h03_z50_long": {"adv": ["0.3,50,selfish"], "tx_model": "fluid", "time": 3000000},
+    "selfish_fluid_h03_z50_long_pruned": {"adv": ["0.3,50,selfish"], "tx_model": "fluid", "time": 3000000, "prune_depth": 6},
+    "stubborn_fluid_h03_z50_streams": {"adv": ["0.3,50,stubborn"], "tx_model": "fluid", "broadcast": "concurrent", "rng": "streams"},
+    "stubborn_fluid_h03_z50_parallel": {"adv": ["0.3,50,stubborn"], "tx_model": "fluid", "broadcast": "concurrent", "rng": "streams", "parallel": 2},
+}
+
+# Scenarios that must give exactly the fingerprint of another one
+EQUIVALENT = {
+    "selfish_h03_z50_per_peer_resumed": "selfish_h03_z50_per_peer_concurrent",
+    "selfish_h03_z50_gossip_resumed": "selfish_h03_z50_gossip_concurrent",
+    "selfish_h03_z50_compact_trickle_resumed": "selfish_h03_z50_compact_trickle_concurrent",
+    "stubborn_fluid_h03_z50_parallel": "stubborn_fluid_h03_z50_streams",
+}
+
+# Scenarios whose peak memory must stay below a fraction of the peak memory of another one
+LIGHTER = {
+    "selfish_fluid_h03_z50_long_pruned": ("selfish_fluid_h03_z50_long", 0.8),
+}
+
+# Options shared by every scenario
+BASE_OPTIONS = {"n": 12, "z1": 0.5, "Ttx": 1000000, "I": 3000, "time": 900000, "seed": 7, "mining": "race"}
+
+# The runs depend on the hashes of the block and transaction ids
+HASH_SEED = "0"
+
+# Slowdowns below this many seconds are timing noise whatever the tolerance
+WALL_SLACK = 0.1
+
+def tree_digest(peer):
+    """
+    Digest of the shape of the tree of a peer: every block is named by its height, miner and creation
+    time (the ids change with the hash seed) and the digest covers the sorted list of edges
+    """
+    def name(block):
+        return f"{block.height}:{block.userid}:{block.timestamp:.6f}"
+    edges = sorted(f"{name(node.block.prevblock) if node.block.prevblock is not None else '-'}>{name(node.block)}" for node in peer.node_block_map.values())
+    return hashlib.sha1("\n".join(edges).encode()).hexdigest()
+
+def fingerprint(peers, advs):
+    """
+    Structural outputs of a finished run: tree shapes, blocks generated by every miner and composition of the main chain
+    """
+    main_chain = []
+    curr_block = peers[0].longest_chain
+    while curr_block.prevblock is not None:
+        main_chain.append(curr_block.userid)
+        curr_block = curr_block.prevblock
+    main_chain.reverse()
+
+    tot_gen = sum(p.num_gen for p in peers)
+    return {
+        "trees": {str(p.id): tree_digest(p) for p in peers + advs},
+        "tree sizes": {str(p.id): len(p.node_block_map) for p in peers + advs},
+        "generated": {str(p.id): p.num_gen for p in peers + advs},
+        "main chain": main_chain,
+        "main chain counts": {str(id): count for id, count in sorted(peers[0].chain_counts.items())},
+        "overall mpu": peers[0].longest_chain.height/tot_gen if tot_gen != 0 else None,
+    }
+
+def run_scenario(name):
+    """
+    Run one scenario in this process
+
+    A scenario with resume_at is checkpointed at that time and resumed from the file, one with
+    parallel is run by parallel.run_parallel.
+
+    returns: its fingerprint, wall time and peak resident memory in Kb
+    """
+    import checkpoint
+    import parallel
+    import run_selfish
+
+    options = dict(BASE_OPTIONS)
+    options.update(SCENARIOS[name])
+    resume_at = options.pop("resume_at", None)
+    args = run_selfish.default_args(**options)
+    random.seed(args.seed)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if resume_at is not None:
+            args.time = resume_at
+            env, peers, advs, network, monitor = run_selfish.simulate(args)
+            args.time = options["time"]
+            with tempfile.TemporaryDirectory(prefix="regress_") as directory:
+                filename = os.path.join(directory, "checkpoint.gz")
+                checkpoint.save_checkpoint(filename, env, peers, advs, network, args)
+                env, peers, advs, network, saved_args = checkpoint.load_checkpoint(filename)
+            checkpoint.resume_processes(env, peers, advs, network, args.Ttx)
+            run_selfish.run_until_done(env, peers, advs, args)
+        elif args.parallel is not None:
+            parallel.check_options(args)
+            env, peers, advs, network = parallel.run_parallel(args, args.parallel)
+        else:
+            env, peers, advs, network, monitor = run_selfish.simulate(args)
+    wall = time.time() - start
+    return {"fingerprint": fingerprint(peers, advs), "wall": wall, "peak memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def run_child(name):
+    """
+    Run a scenario in a fresh interpreter with a fixed hash seed, so its results and memory do not depend on the caller
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_selfish.py")
+    env = dict(os.environ, PYTHONHASHSEED=HASH_SEED)
+    output = subprocess.run([sys.executable, script, "regress", "--child", name], env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def compare(golden, result):
+    """
+    Differences between the golden fingerprint of a scenario and a new one
+
+    returns: a list of messages, empty if they match
+    """
+    differences = []
+    for key in golden.keys():
+        expected, actual = golden[key], result.get(key)
+        if key == "overall mpu" and expected is not None and actual is not None:
+            if abs(expected - actual) > 1e-9:
+                differences.append(f"{key}: expected {expected}, got {actual}")
+        elif key == "trees" and expected != actual:
+            changed = [id for id in expected.keys() if expected[id] != actual.get(id)]
+            differences.append(f"tree shapes differ for peers {', '.join(changed)}")
+        elif expected != actual:
+            differences.append(f"{key}: expected {expected}, got {actual}")
+    return differences
+
+def run_regression(directory, names, update=False, wall_tolerance=0.5, memory_tolerance=0.25, repeat=3):
+    """
+    Run the scenarios and compare them with the golden files of directory
+
+    Scenarios of EQUIVALENT are also compared with their reference scenario and those of LIGHTER with the
+    peak memory of theirs, the reference is run if it is not in names.
+
+    update: write new golden files (outputs and performance baseline) instead of comparing
+    wall_tolerance: allowed relative increase of the wall time over the baseline (best of repeat runs)
+    memory_tolerance: allowed relative increase of the peak memory over the baseline
+
+    returns: True if every scenario matches
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    ok = True
+    fingerprints = {}
+    memories = {}
+    for name in names:
+        runs = [run_child(name) for i in range(repeat)]
+        result = runs[0]
+        fingerprints[name] = result["fingerprint"]
+        wall = min(run["wall"] for run in runs)
+        memory = max(run["peak memory"] for run in runs)
+        memories[name] = memory
+        filename = os.path.join(directory, f"{name}.json")
+
+        if any(run["fingerprint"] != result["fingerprint"] for run in runs):
+            print(f"FAIL {name}: runs with the same seed differ")
+            ok = False
+            continue
+
+        if update or not os.path.exists(filename):
+            with open(filename, 'w') as f:
+                json.dump({"options": dict(BASE_OPTIONS, **SCENARIOS[name]), "fingerprint": result["fingerprint"],
+                           "wall": wall, "peak memory": memory}, f, indent=1)
+            print(f"WROTE {name}: wall {wall:.3f}s, peak memory {memory} Kb")
+            continue
+
+        with open(filename) as f:
+            golden = json.load(f)
+        failures = compare(golden["fingerprint"], result["fingerprint"])
+        if wall > golden["wall"]*(1 + wall_tolerance) and wall - golden["wall"] > WALL_SLACK:
+            failures.append(f"wall time {wall:.3f}s over the baseline {golden['wall']:.3f}s by more than {wall_tolerance:.0%}")
+        if memory > golden["peak memory"]*(1 + memory_tolerance):
+            failures.append(f"peak memory {memory} Kb over the baseline {golden['peak memory']} Kb by more than {memory_tolerance:.0%}")
+
+        if failures:
+            ok = False
+            print(f"FAIL {name}")
+            for failure in failures:
+                print(f"  {failure}")
+        else:
+            print(f"OK   {name}: wall {wall:.3f}s (baseline {golden['wall']:.3f}s), peak memory {memory} Kb (baseline {golden['peak memory']} Kb)")
+
+    for name in names:
+        if name not in EQUIVALENT.keys():
+            continue
+        reference = EQUIVALENT[name]
+        if reference not in fingerprints.keys():
+            fingerprints[reference] = run_child(reference)["fingerprint"]
+        differences = compare(fingerprints[reference], fingerprints[name])
+        if differences:
+            ok = False
+            print(f"FAIL {name}: differs from {reference}")
+            for difference in differences:
+                print(f"  {difference}")
+        else:
+            print(f"OK   {name}: same as {reference}")
+
+    for name in names:
+        if name not in LIGHTER.keys():
+            continue
+        reference, fraction = LIGHTER[name]
+        if reference not in memories.keys():
+            memories[reference] = run_child(reference)["peak memory"]
+        if memories[name] > fraction*memories[reference]:
+            ok = False
+            print(f"FAIL {name}: peak memory {memories[name]} Kb over {fraction:.0%} of {reference} ({memories[reference]} Kb)")
+        else:
+            print(f"OK   {name}: peak memory {memories[name]} Kb, {reference} {memories[reference]} Kb")
+    return ok
@@ -1,6 +1,9 @@
-import os, shutil
+import os
 import argparse
-import simpy
+import contextlib
+import itertools
+import math
+import sys
 import time
 from peer import Peer
 from selfish_peer import SelfishPeer
@@ -8,111 +11,1051 @@ from block import Block
 from network import Network
 import random
 import params
+import checkpoint
+import metrics
+import convergence
+import pruning
+import scenario
+import event_trace
+import visualize
+import topology
+import output_writer
+from mining import MiningScheduler
+from fluid import FluidTransactions
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="P2P currency simulator")
-    parser.add_argument("--n", type=int, default=10, help="Number of peers")
-    parser.add_argument("--z1", type=float, default=0.5, help = "fraction of low CPU peers")
-    parser.add_argument("--Ttx", type=float, default=0.5, help = "mean interarrival time of transactions")
-    parser.add_argument("--time", type=float, default=100, help = "simulation time")
-    parser.add_argument("--I", type=float, default=0.5, help = "mean interarrival time of blocks")
-    parser.add_argument("--h", type=float, default=0.5, help = "hashing power of the adversary")
-    parser.add_argument("--Z", type=float, default=50, help = "percentage of honest nodes connected to the adversary")
+def parse_adversaries(args):
+    """
+    Build the list of adversary configurations from the command line
+
+    args: parsed arguments, --adv entries are of the form h,Z[,strategy]
 
-    args = parser.parse_args()
+    returns: a list of dictionaries with keys h, Z and strategy
+    """
+    default_strategy = "selfish" if params.selfish else "stubborn"
+    if not args.adv:
+        return [{"h": args.h, "Z": args.Z, "strategy": default_strategy}]
 
-    # Generating only the honest peers here and the adversary will be added later
-    n = args.n - 1
+    advs_config = []
+    for entry in args.adv:
+        fields = entry.split(",")
+        if len(fields) not in (2, 3):
+            raise ValueError(f"Invalid adversary '{entry}', expected h,Z[,strategy]")
+        strategy = fields[2] if len(fields) == 3 else default_strategy
+        if strategy not in ("selfish", "stubborn"):
+            raise ValueError(f"Unknown strategy '{strategy}' for adversary '{entry}'")
+        advs_config.append({"h": float(fields[0]), "Z": float(fields[1]), "strategy": strategy})
+    return advs_config
 
-    env = simpy.Environment()  # simulated in simpy
+def run_tag(args, advs_config):
+    """
+    Name used for the output folders of a run
+    A single adversary keeps the historical n_z1_Ttx_I_time_h_Z_strategy layout
+    """
+    h = "+".join(str(a["h"]) for a in advs_config)
+    Z = "+".join(str(a["Z"]) for a in advs_config)
+    strategy = "+".join(a["strategy"] for a in advs_config)
+    return f"{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{h}_{Z}_{strategy}"
+
+def adversary_stats(tip, advs, root=None):
+    """
+    Per-adversary metrics collected in a single walk from tip back to the genesis block
+
+    tip: last block of the main chain
+    advs: list of adversaries
+    root: root node of the tree tip belongs to, a pruning checkpoint ends the walk
+
+    returns: a list of dictionaries, one per adversary
+    """
+    counts = tip.chain_counts(root)
+
+    stats = []
+    for adv in advs:
+        num_main = counts.get(adv.id, 0)
+        stats.append({
+            "id": adv.id,
+            "strategy": "selfish" if adv.isSelfish else "stubborn",
+            "h": adv.hashing_power,
+            "num_gen": adv.num_gen,
+            "num_main": num_main,
+            "mpu": num_main/adv.num_gen if adv.num_gen != 0 else None,
+            "share": num_main/tip.height if tip.height != 0 else None,
+        })
+    return stats
+
+def build_simulation(args, advs_config, topology=None):
+    """
+    Create the environment, the honest peers, the adversaries and the network
+
+    topology: Topology of the honest peers to reuse, None to draw a new one
+
+    returns: env, peers, advs, network
+    """
+    # Generating only the honest peers here and the adversaries will be added later
+    n = args.n - len(advs_config)
+    if topology is not None and topology.n != n:
+        raise ValueError(f"The topology has {topology.n} honest peers, the run needs {n}")
+
+    env = metrics.CountingEnvironment()  # simulated in simpy
     genesis = Block(None, 0, set([]), -1) # genesis block
     
-    num_slow = int(n//2)
-    slow_peers = random.sample(range(n), num_slow)
+    if topology is None:
+        num_slow = int(n*args.slow)
+        slow_peers = random.sample(range(n), num_slow)
     
-    num_low = int(n*args.z1)
-    low_peers = random.sample(range(n), num_low)
+        num_low = int(n*args.z1)
+        low_peers = random.sample(range(n), num_low)
 
     # Generate the peers
     peers = []
     for i in range(n):
-        config = {}
-        if i in slow_peers:
-            config["speed"] = "slow"
+        if topology is not None:
+            config = topology.peer_config(i)
         else:
-            config["speed"] = "fast"
+            config = {}
+            if i in slow_peers:
+                config["speed"] = "slow"
+            else:
+                config["speed"] = "fast"
 
-        if i in low_peers:
-            config["cpu"] = "low"
-            config["hashing power"] = 1/(10*n - 9*num_low) # 1/10 of the hashing power of a high CPU peer
-        else:
-            config["cpu"] = "high"
-            config["hashing power"] = 10/(10*n - 9*num_low) # 10 times the hashing power of a low CPU peer
+            if i in low_peers:
+                config["cpu"] = "low"
+                config["hashing power"] = 1/(10*n - 9*num_low) # 1/10 of the hashing power of a high CPU peer
+            else:
+                config["cpu"] = "high"
+                config["hashing power"] = 10/(10*n - 9*num_low) # 10 times the hashing power of a low CPU peer
 
         p = Peer(i, genesis, env, config)
         peers.append(p)
         genesis.balances = {i: 0 for i in range(n)}
 
-    # Generate the adversary
-    adv = SelfishPeer(n, genesis, env, {"speed": "fast", "cpu": "high", "hashing power": args.h}, params.selfish)
-    genesis.balances[n] = 0
+    # Generate the adversaries, their ids follow the honest peers
+    advs = []
+    for k, adv_config in enumerate(advs_config):
+        adv = SelfishPeer(n + k, genesis, env, {"speed": "fast", "cpu": "high", "hashing power": adv_config["h"]}, adv_config["strategy"] == "selfish")
+        genesis.balances[n + k] = 0
+        advs.append(adv)
 
     # Generate the network
     # Assuming that Z is not normalized
-    network = Network(peers, adv, args.I, args.Z, env)
+    network = Network(peers, advs, args.I, [adv_config["Z"] for adv_config in advs_config], env, args.relay, args.tx_relay, args.trickle_interval, args.link, args.max_orphans, topology, args.broadcast)
+    if args.rng == "streams":
+        network.use_streams(args.seed if args.seed is not None else random.randrange(2**32))
+    return env, peers, advs, network
+
+def shared_topology(args, advs_config):
+    """
+    Topology of the honest peers given by --topology (None without it or --topology-cache), read from
+    the --topology-cache folder when the same (model, parameters, seed) was generated before
+
+    The topology seed is --topology-seed, or the seed of the run, so replicates with the same seed
+    run on the same network whatever the adversaries are.
+    """
+    if args.topology is None and args.topology_cache is None:
+        return None
+    seed = args.topology_seed if args.topology_seed is not None else args.seed
+    if seed is None:
+        seed = random.randrange(2**32)
+    model = args.topology if args.topology is not None else "random"
+    return topology.get_topology(args.n - len(advs_config), args.z1, args.slow, model, topology.parse_params(args.topology_param), seed, args.topology_cache)
+
+def start_processes(env, peers, advs, network, args):
+    """
+    Start transaction generation and mining on a freshly built network
+    """
+    if args.tx_model == "fluid":
+        network.fluid = FluidTransactions(env, peers + advs, args.Ttx)
 
     for peer in peers:
         peer.use_network(network)
-        env.process(peer.generate_transactions(args.Ttx, peers))
-        if random.random() < 0.25:
+        if network.fluid is None:
+            env.process(peer.generate_transactions(args.Ttx, peers))
+        if args.mining == "per-peer" and random.random() < 0.25:
             env.process(peer.create_block())
 
-    adv.use_network(network)
-    env.process(adv.generate_transactions(args.Ttx, peers))
-    env.process(adv.create_block())
+    for adv in advs:
+        adv.use_network(network)
+        if network.fluid is None:
+            env.process(adv.generate_transactions(args.Ttx, peers))
+        if args.mining == "per-peer":
+            env.process(adv.create_block())
+
+    if args.mining == "race":
+        network.scheduler = MiningScheduler(env, peers + advs, args.I)
+        network.scheduler.rng = network.stream("race")
+        env.process(network.scheduler.run())
+
+def write_outputs(args, advs_config, peers, advs, network, monitor=None, directory="", writer=None):
+    """
+    Write MPU.txt and the block tree of every peer
+
+    directory: folder the outputs are written to (default: the current directory)
+    writer: OutputWriter writing the trees, plots and other artifacts in the background, None to write them before returning
+    """
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
 
-    env.run(until=args.time)
+    write_mpu(os.path.join(directory, "MPU.txt"), peers, advs, network, monitor)
 
-    with open("MPU.txt", 'w') as f:
+    if args.plots:
+        write_plots(run_tag(args, advs_config), peers + advs, directory, writer)
+    write_trees(run_tag(args, advs_config), peers + advs, directory, writer)
+    if args.html is not None:
+        write_html(args.html, peers, advs, run_tag(args, advs_config), directory, writer)
+    if args.propagation is not None:
+        write_propagation(args.propagation, peers, advs, directory, writer)
+
+def write_mpu(filename, peers, advs, network, monitor=None):
+    """
+    Write the MPU, the adversaries' share of the main chain and the relay, orphan and reorg counters
+    """
+    with open(filename, 'w') as f:
         tot_gen = 0
         for p in peers:
             tot_gen += p.num_gen
         
-        print("Overall MPU : ", peers[0].longest_chain.height/tot_gen, file=f)
+        # No block generated by the honest peers (very short run)
+        print("Overall MPU : ", peers[0].longest_chain.height/tot_gen if tot_gen != 0 else None, file=f)
 
-    if(params.selfish):
-        if os.path.exists(os.path.dirname(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/")):
-            shutil.rmtree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/")
+        # Single walk of the main chain shared by all the adversaries
+        for stats in adversary_stats(peers[0].longest_chain, advs, peers[0].root):
+            print(f"Adversary {stats['id']} ({stats['strategy']}, h = {stats['h']}) : generated {stats['num_gen']}, in main chain {stats['num_main']}, MPU adv {stats['mpu']}, share of main chain {stats['share']}", file=f)
 
-        if os.path.exists(os.path.dirname(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/")):
-            shutil.rmtree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/")
+        print(f"Block relay ({network.relay}) : {network.block_kb} Kb sent, {network.missing_tx_fetches} round trips for missing transactions", file=f)
+        if network.link == "shared":
+            mean_wait = network.queueing_delay/network.queued_messages if network.queued_messages != 0 else 0
+            print(f"Link queueing : {network.queued_messages} messages waited for a busy link, mean wait {mean_wait} ms", file=f)
 
-        # time.sleep(10)
-        for peer in peers:
-            longest_chain = peer.longest_chain.height
-            peer.print_tree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/tree_{peer.id}_{longest_chain}.dot")
-            peer.save_tree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/tree_{peer.id}_{longest_chain}.tree")
-        
-        # Printing actions of the adversary
-        longest_chain = adv.longest_chain.height
-        adv.print_tree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/tree_{adv.id}_{longest_chain}.dot")
-        adv.save_tree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_selfish/tree_{adv.id}_{longest_chain}.tree")
-    elif(params.stubborn):
-        if os.path.exists(os.path.dirname(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/")):
-            shutil.rmtree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/")
-
-        if os.path.exists(os.path.dirname(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/")):
-            shutil.rmtree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/")
-
-        # time.sleep(10)
-        for peer in peers:
-            longest_chain = peer.longest_chain.height
-            peer.print_tree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/tree_{peer.id}_{longest_chain}.dot")
-            peer.save_tree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/tree_{peer.id}_{longest_chain}.tree")
-        
-        # Printing actions of the adversary
-        longest_chain = adv.longest_chain.height
-        adv.print_tree(f"plots_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/tree_{adv.id}_{longest_chain}.dot")
-        adv.save_tree(f"trees_{args.n}_{args.z1}_{args.Ttx}_{args.I}_{args.time}_{args.h}_{args.Z}_stubborn/tree_{adv.id}_{longest_chain}.tree")
+        buffered = sum(p.orphans_buffered for p in peers + advs)
+        connected = sum(p.orphans_connected for p in peers + advs)
+        evicted = sum(p.orphans_evicted for p in peers + advs)
+        print(f"Orphan blocks : {buffered} buffered, {connected} connected once their parent arrived, {evicted} evicted", file=f)
+        print(f"Reorgs of honest peers : {sum(p.reorgs for p in peers)}, deepest {max(p.max_reorg_depth for p in peers)}", file=f)
+
+        if monitor is not None:
+            monitor.report(f)
+
+def analyze_propagation(filename, peers, advs):
+    import propagation
+    propagation.PropagationAnalysis(peers, advs).write(filename)
+
+def write_propagation(filename, peers, advs, directory="", writer=None):
+    """
+    Analyze the arrival times of the blocks at the honest peers (needs numpy)
+    """
+    filename = os.path.join(directory, filename)
+    output_writer.submit(writer, filename, analyze_propagation, filename, peers, advs)
+
+def draw_html(filename, peers, advs, title):
+    visualize.MergedTree(peers, advs).write_html(filename, title)
+
+def write_html(filename, peers, advs, tag, directory="", writer=None):
+    """
+    Draw the merged block tree of all the peers as an HTML page
+    """
+    filename = os.path.join(directory, filename)
+    output_writer.submit(writer, filename, draw_html, filename, peers, advs, f"Block tree {tag}")
+
+def write_plots(tag, nodes, directory="", writer=None):
+    """
+    Render the block tree of every peer (honest or adversary) with graphviz into plots_<tag>/
+
+    The graphs are built here (with their debug prints), only the rendering is left to writer.
+    """
+    folder = os.path.join(directory, f"plots_{tag}")
+    output_writer.clear_folder(folder, writer)
+    os.makedirs(folder, exist_ok=True)
+
+    for peer in nodes:
+        longest_chain = peer.longest_chain.height
+        filename = os.path.join(folder, f"tree_{peer.id}_{longest_chain}.dot")
+        output_writer.submit(writer, filename, peer.tree_graph(filename).render)
+
+def write_trees(tag, nodes, directory="", writer=None):
+    """
+    Save the block tree of every peer (honest or adversary) as text into trees_<tag>/
+    """
+    folder = os.path.join(directory, f"trees_{tag}")
+    output_writer.clear_folder(folder, writer)
+    os.makedirs(folder, exist_ok=True)
+
+    for peer in nodes:
+        longest_chain = peer.longest_chain.height
+        filename = os.path.join(folder, f"tree_{peer.id}_{longest_chain}.tree")
+        output_writer.submit(writer, filename, peer.save_tree, filename)
+
+def run_until_done(env, peers, advs, args):
+    """
+    Run the simulation until --time, or until convergence with --stop-ci
+
+    returns: the convergence monitor (None without --stop-ci)
+    """
+    if args.prune_depth is not None:
+        interval = args.prune_every if args.prune_every is not None else 10*args.I
+        env.process(pruning.Pruner(env, peers, advs, args.prune_depth, interval).run())
+
+    monitor = None
+    if args.stop_ci is not None:
+        batch = args.stop_batch if args.stop_batch is not None else 10*args.I
+        monitor = convergence.ConvergenceMonitor(env, peers, advs, args.stop_ci, batch, args.time, args.stop_min_batches)
+        env.run(until=env.process(monitor.run()))
+        print(f"Run stopped ({monitor.stop_reason}) at time {env.now}")
+    else:
+        env.run(until=args.time)
+    return monitor
+
+def default_args(**options):
+    """
+    Arguments of the run subcommand with their default values, for use as a library
+
+    options: values overriding the defaults, named like the attributes of the parsed arguments (e.g. tx_relay="trickle")
+
+    returns: an argparse.Namespace accepted by simulate, build_simulation and the other functions of this module
+    """
+    parser = argparse.ArgumentParser()
+    add_simulation_options(parser)
+    add_run_options(parser)
+    actions = {action.dest: action for action in parser._actions}
+    args = parser.parse_args([])
+    args.command = "run"
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise ValueError(f"Unknown option '{key}'")
+        setattr(args, key, check_option(actions[key], value))
+    return args
+
+def check_option(action, value):
+    """
+    Convert and check a value given outside the command line (library call or scenario file) like the parser would
+
+    action: argparse action of the option
+    value: value, a list (or a key=value table) for the options that can be repeated, a bool for the flags
+
+    returns: the converted value, raises a ValueError if the command line would have refused it
+    """
+    name = action.option_strings[0]
+    if value is None:
+        return value
+    if action.nargs == 0:
+        # Flags like --no-plots
+        if not isinstance(value, bool):
+            raise ValueError(f"Option {name} expects true or false, got {value!r}")
+        return value
+    if isinstance(action, argparse._AppendAction):
+        if isinstance(value, dict):
+            # Table of a scenario file, e.g. topology_param = {m = 3}
+            value = [f"{key}={v}" for key, v in value.items()]
+        if not isinstance(value, list):
+            raise ValueError(f"Option {name} expects a list of values, got {value!r}")
+        return [check_option_value(action, name, v) for v in value]
+    return check_option_value(action, name, value)
+
+def check_option_value(action, name, value):
+    """
+    One value of an option, converted from its text as on the command line so that 2.5 is not taken as an int
+    """
+    if isinstance(value, bool) or isinstance(value, (list, dict)):
+        raise ValueError(f"Invalid value {value!r} for option {name}")
+    if action.type is not None:
+        try:
+            value = action.type(str(value))
+        except ValueError:
+            raise ValueError(f"Invalid value {value!r} for option {name}, expected {action.type.__name__}")
+    if action.choices is not None and value not in action.choices:
+        raise ValueError(f"Invalid value {value!r} for option {name}, expected one of {', '.join(str(c) for c in action.choices)}")
+    return value
+
+def simulate(args, metrics_file=None):
+    """
+    Build and run one simulation without writing any output
+
+    args: arguments as returned by default_args (the seed of the random generator is left to the caller)
+    metrics_file: CSV file for the time series sampled every args.metrics_every, None to sample nothing
+
+    returns: env, peers, advs, network and the convergence monitor (None without stop_ci)
+    """
+    advs_config = parse_adversaries(args)
+    env, peers, advs, network = build_simulation(args, advs_config, shared_topology(args, advs_config))
+    start_processes(env, peers, advs, network, args)
+    sampler = None
+    if metrics_file is not None:
+        interval = args.metrics_every if args.metrics_every is not None else args.I
+        sampler = metrics.MetricsSampler(env, peers, advs, metrics_file, interval, args.metrics_buffer)
+        env.process(sampler.run())
+    monitor = run_until_done(env, peers, advs, args)
+    if sampler is not None:
+        sampler.flush()
+    return env, peers, advs, network, monitor
+
+def summarize(env, peers, advs, network):
+    """
+    Compact metrics of a finished run, small enough to be sent back from a worker process
+    """
+    tot_gen = sum(p.num_gen for p in peers)
+    summary = {
+        "time": env.now,
+        "events": getattr(env, "events_processed", 0),
+        "main chain height": peers[0].longest_chain.height,
+        "overall mpu": peers[0].longest_chain.height/tot_gen if tot_gen != 0 else None,
+        "orphans buffered": sum(p.orphans_buffered for p in peers + advs),
+        "orphans connected": sum(p.orphans_connected for p in peers + advs),
+    }
+    for stats in adversary_stats(peers[0].longest_chain, advs, peers[0].root):
+        summary[f"adversary {stats['id']} mpu"] = stats["mpu"]
+        summary[f"adversary {stats['id']} share"] = stats["share"]
+    return summary
+
+def run_replicate(saved_args, seed, metrics_file=None):
+    """
+    Run one replicate with its own seed in a worker process
+
+    saved_args: dictionary of the command line arguments
+    seed: seed of the random generator
+    metrics_file: CSV file for the time series of the run, None to sample nothing
+
+    returns: (seed, summary of the run, wall time)
+    """
+    args = argparse.Namespace(**saved_args)
+    args.seed = seed
+    random.seed(seed)
+    start = time.time()
+    # The per-event prints of the simulator would only slow the workers down
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, peers, advs, network, monitor = simulate(args, metrics_file)
+    return seed, summarize(env, peers, advs, network), time.time() - start
+
+def aggregate(summaries):
+    """
+    Mean, standard error and 95% confidence interval of every metric over the replicates
+
+    returns: {metric: (number of samples, mean, standard error, CI half width)}
+    """
+    results = {}
+    for key in summaries[0].keys():
+        values = [s[key] for s in summaries if s.get(key) is not None]
+        if len(values) == 0:
+            continue
+        mean = sum(values)/len(values)
+        if len(values) > 1:
+            std = math.sqrt(sum((v - mean)**2 for v in values)/(len(values) - 1))
+            stderr = std/math.sqrt(len(values))
+            half_width = convergence.t_quantile(len(values) - 1)*stderr
+        else:
+            stderr = None
+            half_width = None
+        results[key] = (len(values), mean, stderr, half_width)
+    return results
+
+def print_aggregate(results, f):
+    """
+    Print the output of aggregate to the file f, one metric per line
+    """
+    for key, (count, mean, stderr, half_width) in results.items():
+        if stderr is None:
+            print(f"{key} : mean {mean} ({count} sample)", file=f)
+        else:
+            print(f"{key} : mean {mean}, standard error {stderr}, 95% CI [{mean - half_width}, {mean + half_width}] ({count} samples)", file=f)
+
+def run_replicates(args, advs_config):
+    """
+    Run --replicates independent seeds of the configuration in parallel and write the combined report
+    """
+    base_seed = args.seed if args.seed is not None else random.randrange(2**32)
+    seeds = [base_seed + i for i in range(args.replicates)]
+    workers = args.workers if args.workers is not None else os.cpu_count()
+
+    import multiprocessing
+
+    start = time.time()
+    results = []
+    with multiprocessing.Pool(processes=min(workers, len(seeds))) as pool:
+        for seed, summary, wall in pool.starmap(run_replicate, [(vars(args), seed) for seed in seeds]):
+            print(f"Replicate with seed {seed} done in {wall:.2f}s")
+            results.append((seed, summary, wall))
+    total_wall = time.time() - start
+
+    report = args.report if args.report is not None else f"replicates_{run_tag(args, advs_config)}.txt"
+    with open(report, 'w') as f:
+        print(f"Replicates : {len(seeds)} (seeds {seeds[0]} to {seeds[-1]}), {min(workers, len(seeds))} workers", file=f)
+        print(f"Wall time : {total_wall:.2f}s total, {sum(r[2] for r in results):.2f}s of simulation", file=f)
+        print(file=f)
+        print_aggregate(aggregate([r[1] for r in results]), f)
+        print(file=f)
+        for seed, summary, wall in results:
+            print(f"Seed {seed} : " + ", ".join(f"{key} = {value}" for key, value in summary.items()), file=f)
+    print(f"Report written to {report}")
+
+def load_run(filename):
+    """
+    Load a checkpoint written by run --checkpoint
+
+    returns: env, peers, advs, network and the arguments of the run
+    """
+    env, peers, advs, network, saved_args = checkpoint.load_checkpoint(filename)
+    return env, peers, advs, network, argparse.Namespace(**saved_args)
+
+def run_command(args):
+    """
+    run: one simulation (or --replicates seeds of it) writing MPU.txt and the block trees
+    """
+
+    if args.replicates is not None:
+        if args.resume is not None or args.checkpoint is not None or args.metrics is not None:
+            raise ValueError("--replicates cannot be combined with --resume, --checkpoint or --metrics")
+        run_replicates(args, parse_adversaries(args))
+        return
+
+    if args.checkpoint is not None and (args.checkpoint_every is not None or args.checkpoint_wall is not None) and args.resume is None:
+        # Periodic checkpoints are only useful to resume from, a final one can still be rendered or analyzed
+        checkpoint.check_resumable(args.broadcast)
+
+    if args.parallel is not None:
+        import parallel
+        parallel.check_options(args)
+        if args.seed is None:
+            args.seed = random.randrange(2**32)
+            print(f"Seed {args.seed}")
+        env, peers, advs, network = parallel.run_parallel(args, args.parallel)
+        with output_writer.OutputWriter(args.output_workers) as writer:
+            write_outputs(args, parse_adversaries(args), peers, advs, network, writer=writer)
+        return
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.memprofile is not None:
+        import memprofile
+        memprofile.start_tracing()
+
+    if args.resume is not None:
+        env, peers, advs, network, saved_args = checkpoint.load_checkpoint(args.resume)
+        if args.time <= env.now:
+            raise ValueError(f"--time {args.time} is not past the checkpoint time {env.now}")
+
+        # The run keeps the configuration it was started with, only the horizon and checkpointing change
+        run_args = argparse.Namespace(**saved_args)
+        for key in ["time", "resume", "checkpoint", "checkpoint_every", "checkpoint_wall", "metrics", "metrics_every", "metrics_buffer", "stop_ci", "stop_batch", "stop_min_batches", "prune_depth", "prune_every", "plots", "live", "memprofile", "memprofile_every", "trace", "html", "propagation", "output_workers"]:
+            setattr(run_args, key, getattr(args, key))
+        args = run_args
+        advs_config = parse_adversaries(args)
+        checkpoint.resume_processes(env, peers, advs, network, args.Ttx)
+    else:
+        advs_config = parse_adversaries(args)
+        env, peers, advs, network = build_simulation(args, advs_config, shared_topology(args, advs_config))
+        start_processes(env, peers, advs, network, args)
+
+    if args.checkpoint is not None and (args.checkpoint_every is not None or args.checkpoint_wall is not None):
+        env.process(checkpoint.checkpointer(env, args.checkpoint, peers, advs, network, args, args.checkpoint_every, args.checkpoint_wall))
+
+    sampler = None
+    if args.metrics is not None:
+        interval = args.metrics_every if args.metrics_every is not None else args.I
+        sampler = metrics.MetricsSampler(env, peers, advs, args.metrics, interval, args.metrics_buffer, append=args.resume is not None)
+        env.process(sampler.run())
+
+    if args.trace is not None:
+        network.tracer = event_trace.Tracer(args.trace, peers, advs, peers[0].genesis, args, append=args.resume is not None)
+
+    profiler = None
+    if args.memprofile is not None:
+        interval = args.memprofile_every if args.memprofile_every is not None else 10*args.I
+        profiler = memprofile.MemoryProfiler(env, peers, advs, args.memprofile, interval)
+        env.process(profiler.run())
+
+    live_metrics = None
+    if args.live is not None:
+        import live
+        live_metrics = live.LiveMetrics(env, peers, advs, args.live)
+        live_metrics.start()
+
+    monitor = run_until_done(env, peers, advs, args)
+
+    if live_metrics is not None:
+        live_metrics.stop()
+
+    if profiler is not None:
+        profiler.write()
+
+    if network.tracer is not None:
+        network.tracer.close(peers + advs)
+
+    if sampler is not None:
+        sampler.flush()
+
+    if args.checkpoint is not None:
+        # Final snapshot, a finished run can later be extended with --resume
+        checkpoint.save_checkpoint(args.checkpoint, env, peers, advs, network, args)
+
+    with output_writer.OutputWriter(args.output_workers) as writer:
+        write_outputs(args, advs_config, peers, advs, network, monitor, writer=writer)
+
+def parse_grid(args):
+    """
+    Options and values of the --grid entries
+
+    returns: [(option, [values])]
+    """
+    grid = []
+    for entry in args.grid:
+        key, _, values = entry.partition("=")
+        key = key.replace("-", "_")
+        if not values or key not in ("n", "z1", "Ttx", "I", "time", "h", "Z", "relay", "tx_relay", "trickle_interval", "link", "max_orphans", "mining", "tx_model", "broadcast", "prune_depth"):
+            raise ValueError(f"Invalid grid entry '{entry}', expected option=v1,v2,... with a simulation option")
+        kind = type(getattr(args, key)) if getattr(args, key) is not None else float
+        grid.append((key, [kind(v) for v in values.split(",")]))
+    return grid
+
+def write_sweep_report(report, keys, points, summaries):
+    """
+    Write the CSV report of a sweep: one row per combination with the grid values, then the mean
+    and the 95% CI half width of every metric over the seeds
+
+    keys: options of the grid
+    points: list of combinations of values
+    summaries: list of the summaries of the seeds of every combination
+    """
+    import csv
+
+    rows = []
+    metrics_names = []
+    for point, point_summaries in zip(points, summaries):
+        stats = aggregate(point_summaries) if len(point_summaries) > 0 else {}
+        for key in stats.keys():
+            if key not in metrics_names:
+                metrics_names.append(key)
+        rows.append((point, stats))
+
+    with open(report, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = list(keys)
+        for name in metrics_names:
+            header += [name, f"{name} ci"]
+        writer.writerow(header)
+        for point, stats in rows:
+            row = list(point)
+            for name in metrics_names:
+                count, mean, stderr, half_width = stats.get(name, (0, None, None, None))
+                row += [mean, half_width]
+            writer.writerow(row)
+    print(f"Report written to {report}")
+
+def sweep_command(args):
+    """
+    sweep: run every combination of the --grid values, each with --replicates seeds, in parallel
+
+    With --queue the tasks are only written to a shared folder, run by the worker subcommand on any
+    number of machines and compiled by the merge subcommand.
+    """
+    import multiprocessing
+
+    grid = parse_grid(args)
+    if args.metrics and args.queue is None:
+        raise ValueError("--metrics needs --queue, the time series of every task are written next to its result")
+    base_seed = args.seed if args.seed is not None else random.randrange(2**32)
+    points = list(itertools.product(*[values for key, values in grid]))
+    tasks = []
+    for point in points:
+        point_args = dict(vars(args))
+        point_args.update(zip([key for key, values in grid], point))
+        tasks += [(point_args, base_seed + i) for i in range(args.replicates)]
+
+    if args.queue is not None:
+        import workqueue
+        description = {"keys": [key for key, values in grid], "points": points, "replicates": args.replicates, "seed": base_seed}
+        queue_tasks = [{"point": i//args.replicates, "args": point_args, "seed": seed, "metrics": args.metrics} for i, (point_args, seed) in enumerate(tasks)]
+        workqueue.WorkQueue(args.queue).create(description, queue_tasks)
+        print(f"{len(tasks)} tasks ({len(points)} points x {args.replicates} seeds) written to {args.queue}")
+        return
+
+    workers = args.workers if args.workers is not None else os.cpu_count()
+    start = time.time()
+    with multiprocessing.Pool(processes=min(workers, len(tasks))) as pool:
+        results = pool.starmap(run_replicate, tasks)
+    print(f"Sweep of {len(points)} points x {args.replicates} seeds done in {time.time() - start:.2f}s")
+
+    summaries = [[summary for seed, summary, wall in results[i*args.replicates:(i + 1)*args.replicates]] for i in range(len(points))]
+    write_sweep_report(args.report if args.report is not None else "sweep.csv", [key for key, values in grid], points, summaries)
+
+def run_queued_task(task, metrics_file):
+    """
+    Run one task of a sweep queue
+
+    metrics_file: file the time series are written to, if the sweep asked for them
+
+    returns: the result saved in the results folder of the queue
+    """
+    seed, summary, wall = run_replicate(task["args"], task["seed"], metrics_file if task.get("metrics", False) else None)
+    return {"point": task["point"], "seed": seed, "summary": summary, "wall": wall}
+
+def run_worker(directory, stale):
+    """
+    Worker loop of the worker subcommand, in its own process with --processes
+    """
+    import workqueue
+    return workqueue.WorkQueue(directory).work(run_queued_task, stale)
+
+def worker_command(args):
+    """
+    worker: run the tasks of a sweep queue until none is left
+    """
+    import workqueue
+
+    start = time.time()
+    if args.processes > 1:
+        import multiprocessing
+        with multiprocessing.Pool(processes=args.processes) as pool:
+            done = sum(pool.starmap(run_worker, [(args.queue, args.stale)]*args.processes))
+    else:
+        done = run_worker(args.queue, args.stale)
+    status = workqueue.WorkQueue(args.queue).status()
+    print(f"{done} tasks done in {time.time() - start:.2f}s, queue: {status['todo']} waiting, {status['claimed']} claimed, {status['done']} done, {status['failed']} failed")
+
+def merge_command(args):
+    """
+    merge: compile the results of a sweep queue into the sweep report
+    """
+    import workqueue
+
+    queue = workqueue.WorkQueue(args.queue)
+    description = queue.description()
+    summaries = [[] for point in description["points"]]
+    results = queue.collect()
+    for result in results.values():
+        summaries[result["point"]].append(result["summary"])
+
+    status = queue.status()
+    if status["done"] < description["tasks"]:
+        print(f"Warning: {status['done']} of {description['tasks']} tasks done ({status['todo']} waiting, {status['claimed']} claimed, {status['failed']} failed)")
+    report = args.report if args.report is not None else os.path.join(args.queue, "sweep.csv")
+    write_sweep_report(report, description["keys"], description["points"], summaries)
+
+    # One row per task, pointing to its time series
+    import csv
+    index = args.index if args.index is not None else os.path.join(args.queue, "tasks.csv")
+    with open(index, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["task"] + description["keys"] + ["seed", "worker", "wall", "metrics"])
+        for task, result in results.items():
+            metrics_file = os.path.join(queue.results, result["metrics"]) if "metrics" in result.keys() else None
+            writer.writerow([task] + list(description["points"][result["point"]]) + [result["seed"], result["worker"], result["wall"], metrics_file])
+    print(f"Index written to {index}")
+
+def render_command(args):
+    """
+    render: draw the block trees saved in a checkpoint with graphviz
+    """
+    env, peers, advs, network, run_args = load_run(args.checkpoint)
+    with output_writer.OutputWriter(args.output_workers) as writer:
+        if args.html is not None:
+            write_html(args.html, peers, advs, run_tag(run_args, parse_adversaries(run_args)), writer=writer)
+            return
+        nodes = [p for p in peers + advs if args.peer is None or p.id in args.peer]
+        write_plots(run_tag(run_args, parse_adversaries(run_args)), nodes, writer=writer)
+
+def analyze_command(args):
+    """
+    analyze: print the metrics of the run saved in a checkpoint
+    """
+    env, peers, advs, network, run_args = load_run(args.checkpoint)
+    for key, value in summarize(env, peers, advs, network).items():
+        print(f"{key} : {value}")
+    print(f"Block relay ({network.relay}) : {network.block_kb} Kb sent, {network.missing_tx_fetches} round trips for missing transactions")
+    print(f"Reorgs of honest peers : {sum(p.reorgs for p in peers)}, deepest {max(p.max_reorg_depth for p in peers)}")
+    if args.propagation is not None:
+        write_propagation(args.propagation, peers, advs)
+
+def bench_command(args):
+    """
+    bench: time --repeat runs of the configuration without any output and report the event rate
+    """
+    base_seed = args.seed if args.seed is not None else 0
+    rates = []
+    for i in range(args.repeat):
+        seed, summary, wall = run_replicate(vars(args), base_seed + i)
+        rates.append(summary["events"]/wall if wall > 0 else 0)
+        print(f"Run {i} (seed {seed}) : {summary['events']} events in {wall:.2f}s, {rates[-1]:.0f} events/s, main chain height {summary['main chain height']}")
+    print(f"Mean : {sum(rates)/len(rates):.0f} events/s")
+
+def run_scenario_group(key, entries, output_workers=0):
+    """
+    Run scenarios sharing the same topology, which is built once from the topology seed
+
+    key: topology key (honest peers, z1, slow, seed, model, parameters)
+    entries: list of (scenario, dictionary of the run arguments)
+    output_workers: threads writing the outputs of a scenario while the next one runs, 0 to write them before it starts
+
+    returns: a list of (name, seed, summary, wall time)
+    """
+    n, z1, slow, topology_seed, model, params = key
+    shared = topology.get_topology(n, z1, slow, model, dict(params), topology_seed, entries[0][1]["topology_cache"])
+
+    results = []
+    with output_writer.OutputWriter(output_workers) as writer:
+        for entry, saved_args in entries:
+            args = argparse.Namespace(**saved_args)
+            directory = os.path.join(entry["output"].get("directory", "scenarios"), entry["name"])
+            random.seed(args.seed)
+            start = time.time()
+            # The per-event prints of the simulator would only slow the runs down
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                advs_config = parse_adversaries(args)
+                env, peers, advs, network = build_simulation(args, advs_config, shared)
+                start_processes(env, peers, advs, network, args)
+                sampler = None
+                if entry["output"].get("metrics", False):
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    interval = args.metrics_every if args.metrics_every is not None else args.I
+                    sampler = metrics.MetricsSampler(env, peers, advs, os.path.join(directory, "metrics.csv"), interval, args.metrics_buffer)
+                    env.process(sampler.run())
+                monitor = run_until_done(env, peers, advs, args)
+                if sampler is not None:
+                    sampler.flush()
+                write_outputs(args, advs_config, peers, advs, network, monitor, directory, writer)
+            wall = time.time() - start
+            print(f"Scenario {entry['name']} done in {wall:.2f}s")
+            results.append((entry["name"], args.seed, summarize(env, peers, advs, network), wall))
+    return results
+
+def batch_command(args):
+    """
+    batch: run every scenario of a scenario file and write one index of the results
+
+    Scenarios that only differ in their adversaries (same number of honest peers, z1, slow and
+    topology seed) share one Topology, groups of scenarios run in parallel with --workers.
+    """
+    import csv
+
+    scenarios = scenario.load_scenarios(args.file)
+    groups = {}
+    for entry in scenarios:
+        run_args = default_args(**scenario.scenario_options(entry))
+        if run_args.seed is None:
+            run_args.seed = random.randrange(2**32)
+        key = scenario.topology_key(entry, run_args, len(parse_adversaries(run_args)))
+        groups.setdefault(key, []).append((entry, vars(run_args)))
+    print(f"{len(scenarios)} scenarios on {len(groups)} topologies")
+
+    start = time.time()
+    if args.workers > 1:
+        import multiprocessing
+        with multiprocessing.Pool(processes=min(args.workers, len(groups))) as pool:
+            grouped = pool.starmap(run_scenario_group, [(key, entries, args.output_workers) for key, entries in groups.items()])
+    else:
+        grouped = [run_scenario_group(key, entries, args.output_workers) for key, entries in groups.items()]
+    results = {}
+    for group in grouped:
+        for name, seed, summary, wall in group:
+            results[name] = (seed, summary, wall)
+    print(f"Batch done in {time.time() - start:.2f}s")
+
+    metrics_names = []
+    for seed, summary, wall in results.values():
+        for key in summary.keys():
+            if key not in metrics_names:
+                metrics_names.append(key)
+
+    index = args.index if args.index is not None else os.path.splitext(args.file)[0] + "_index.csv"
+    with open(index, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "seed", "directory", "wall time"] + metrics_names)
+        # Rows in the order of the scenario file
+        for entry in scenarios:
+            seed, summary, wall = results[entry["name"]]
+            directory = os.path.join(entry["output"].get("directory", "scenarios"), entry["name"])
+            writer.writerow([entry["name"], seed, directory, wall] + [summary.get(key) for key in metrics_names])
+    print(f"Index written to {index}")
+
+def replay_command(args):
+    """
+    replay: rebuild the trees of a run from its event trace and write MPU.txt and the trees
+    """
+    replay = event_trace.Replay(args.trace)
+    run_args = argparse.Namespace(**replay.metadata["args"])
+    peers, advs = replay.peers, replay.advs
+    print(f"Replayed {replay.records} records, {len(replay.blocks) - 1} blocks")
+    for adv in advs:
+        print(f"Adversary {adv.id} released {replay.releases[adv.id]} blocks")
+    print(f"Transactions generated : {replay.transactions}")
+
+    if args.directory and not os.path.exists(args.directory):
+        os.makedirs(args.directory)
+    write_mpu(os.path.join(args.directory, "MPU.txt"), peers, advs, replay.network)
+
+    tag = run_tag(run_args, parse_adversaries(run_args))
+    with output_writer.OutputWriter(args.output_workers) as writer:
+        if args.plots:
+            write_plots(tag, peers + advs, args.directory, writer)
+        write_trees(tag, peers + advs, args.directory, writer)
+        if args.html is not None:
+            write_html(args.html, peers, advs, tag, args.directory, writer)
+        if args.propagation is not None:
+            write_propagation(args.propagation, peers, advs, args.directory, writer)
+
+def regress_command(args):
+    """
+    regress: run the seeded regression scenarios and compare their outputs, wall time and memory with the golden files
+    """
+    import json
+    import regression
+
+    if args.child is not None:
+        print(json.dumps(regression.run_scenario(args.child)))
+        return
+
+    names = args.scenario if args.scenario is not None else list(regression.SCENARIOS.keys())
+    for name in names:
+        if name not in regression.SCENARIOS.keys():
+            raise ValueError(f"Unknown scenario '{name}', expected one of {', '.join(regression.SCENARIOS.keys())}")
+    if not regression.run_regression(args.golden, names, args.update, args.wall_tolerance, args.memory_tolerance, args.repeat):
+        sys.exit(1)
+
+COMMANDS = {
+    "run": run_command,
+    "sweep": sweep_command,
+    "worker": worker_command,
+    "merge": merge_command,
+    "render": render_command,
+    "analyze": analyze_command,
+    "bench": bench_command,
+    "batch": batch_command,
+    "replay": replay_command,
+    "regress": regress_command,
+}
+
+def add_simulation_options(parser):
+    """
+    Options describing the simulated network, shared by run, sweep and bench
+    """
+    parser.add_argument("--n", type=int, default=10, help="Number of peers")
+    parser.add_argument("--z1", type=float, default=0.5, help = "fraction of low CPU peers")
+    parser.add_argument("--slow", type=float, default=0.5, help = "fraction of slow peers")
+    parser.add_argument("--Ttx", type=float, default=0.5, help = "mean interarrival time of transactions")
+    parser.add_argument("--time", type=float, default=100, help = "simulation time")
+    parser.add_argument("--I", type=float, default=0.5, help = "mean interarrival time of blocks")
+    parser.add_argument("--h", type=float, default=0.5, help = "hashing power of the adversary")
+    parser.add_argument("--Z", type=float, default=50, help = "percentage of honest nodes connected to the adversary")
+    parser.add_argument("--adv", type=str, action="append", default=None, help = "adversary as h,Z[,selfish|stubborn]; repeat for several competing adversaries (overrides --h and --Z)")
+    parser.add_argument("--relay", type=str, default="full", choices=["full", "compact"], help = "block relay: full blocks or compact blocks (header + short transaction ids)")
+    parser.add_argument("--tx-relay", type=str, default="flood", choices=["flood", "trickle"], help = "transaction relay: one message per transaction or batches per neighbor")
+    parser.add_argument("--trickle-interval", type=float, default=1000, help = "time a peer collects transactions before sending a batch (trickle relay)")
+    parser.add_argument("--link", type=str, default="independent", choices=["independent", "shared"], help = "link model: independent messages or a FIFO transmission queue per directed link")
+    parser.add_argument("--tx-model", type=str, default="detailed", choices=["detailed", "fluid"], help = "transactions: objects gossiped to every peer, or fluid counts drawn from the backlog of every chain (no gossip, no balances)")
+    parser.add_argument("--broadcast", type=str, default="sequential", choices=["sequential", "concurrent"], help = "send blocks and transactions to one neighbor after the other, each send waiting for the neighbor to process them, or to every neighbor at once")
+    parser.add_argument("--rng", type=str, default="global", choices=["global", "streams"], help = "draw every random number from one generator, or give every peer and the mining race a stream of its own derived from --seed (needed by --parallel)")
+    parser.add_argument("--max-orphans", type=int, default=100, help = "blocks without a known parent kept by each peer")
+    parser.add_argument("--mining", type=str, default="per-peer", choices=["per-peer", "race"], help = "mining model: a create_block process per peer restarted on every new tip, or one race between all the peers")
+    parser.add_argument("--stop-ci", type=float, default=None, help = "stop once the 95%% CI width of the adversary share and of the MPU is below this (--time becomes the maximum)")
+    parser.add_argument("--stop-batch", type=float, default=None, help = "simulated time per batch for --stop-ci (default: 10*I)")
+    parser.add_argument("--stop-min-batches", type=int, default=10, help = "batches needed before --stop-ci can stop the run")
+    parser.add_argument("--prune-depth", type=int, default=None, help = "collapse blocks with this many confirmations below every tip into a checkpoint")
+    parser.add_argument("--prune-every", type=float, default=None, help = "simulated time between pruning passes (default: 10*I)")
+    parser.add_argument("--seed", type=int, default=None, help = "seed of the random generator (first seed with --replicates)")
+    parser.add_argument("--topology", type=str, default=None, choices=list(topology.GENERATORS.keys()), help = "generator of the links and delays between honest peers (default: the historical random graph drawn with the run)")
+    parser.add_argument("--topology-param", type=str, action="append", default=None, help = "key=value parameter of the topology generator (e.g. m=3); repeat for several")
+    parser.add_argument("--topology-seed", type=int, default=None, help = "seed of the topology (default: the seed of the run)")
+    parser.add_argument("--topology-cache", type=str, default=None, help = "folder of generated topologies, reused by runs with the same model, parameters and seed")
+
+
+def add_run_options(parser):
+    """
+    Options of the run subcommand on top of the simulation options
+    """
+    parser.add_argument("--no-plots", dest="plots", action="store_false", help = "do not render the block trees with graphviz (they can be drawn later with render)")
+    parser.add_argument("--html", type=str, default=None, help = "draw the merged block tree of all the peers with their arrival times into this HTML file")
+    parser.add_argument("--propagation", type=str, default=None, help = "write the block propagation delays (coverage times, per peer lags and their correlations) to this file; needs numpy")
+    parser.add_argument("--output-workers", type=int, default=4, help = "threads writing the trees, plots and other outputs in the background, 0 to write them in the main thread")
+    parser.add_argument("--parallel", type=int, default=None, help = "split the peers of one run across this many processes (needs --tx-model fluid --broadcast concurrent --rng streams, same results as without --parallel)")
+    parser.add_argument("--replicates", type=int, default=None, help = "run this many independent seeds in parallel and report means and confidence intervals")
+    parser.add_argument("--workers", type=int, default=None, help = "worker processes for --replicates (default: number of cores)")
+    parser.add_argument("--report", type=str, default=None, help = "report file for --replicates")
+    parser.add_argument("--checkpoint", type=str, default=None, help = "file to write checkpoints to")
+    parser.add_argument("--checkpoint-every", type=float, default=None, help = "simulated time between checkpoints (needs --broadcast concurrent)")
+    parser.add_argument("--checkpoint-wall", type=float, default=None, help = "wall-clock seconds between checkpoints (needs --broadcast concurrent)")
+    parser.add_argument("--metrics", type=str, default=None, help = "CSV file for time series sampled during the run")
+    parser.add_argument("--metrics-every", type=float, default=None, help = "simulated time between two samples (default: --I)")
+    parser.add_argument("--metrics-buffer", type=int, default=1024, help = "samples kept in memory before they are written out")
+    parser.add_argument("--live", type=str, default=None, help = "serve live metrics over HTTP on port, host:port or unix:/path (JSON, Prometheus text on /metrics)")
+    parser.add_argument("--memprofile", type=str, default=None, help = "trace memory with tracemalloc and write a report of the memory used by each subsystem to this file")
+    parser.add_argument("--memprofile-every", type=float, default=None, help = "simulated time between two memory snapshots (default: 10*I)")
+    parser.add_argument("--trace", type=str, default=None, help = "record a binary event trace of the run, replayed with the replay subcommand")
+    parser.add_argument("--resume", type=str, default=None, help = "continue the run saved in this checkpoint until --time (the run must use --broadcast concurrent)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="P2P currency simulator")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help = "run one simulation")
+    add_simulation_options(run_parser)
+    add_run_options(run_parser)
+
+    sweep_parser = subparsers.add_parser("sweep", help = "run a grid of configurations in parallel")
+    add_simulation_options(sweep_parser)
+    sweep_parser.add_argument("--grid", type=str, action="append", required=True, help = "option=v1,v2,... (e.g. h=0.1,0.3); repeat for a grid over several options")
+    sweep_parser.add_argument("--replicates", type=int, default=1, help = "seeds per point of the grid")
+    sweep_parser.add_argument("--workers", type=int, default=None, help = "worker processes (default: number of cores)")
+    sweep_parser.add_argument("--report", type=str, default=None, help = "CSV report (default: sweep.csv)")
+    sweep_parser.add_argument("--queue", type=str, default=None, help = "write the tasks to this shared folder for the worker subcommand instead of running them")
+    sweep_parser.add_argument("--metrics", action="store_true", help = "with --queue, sample the time series of every task into results/<task>.csv of the queue")
+    sweep_parser.add_argument("--metrics-every", type=float, default=None, help = "simulated time between two samples (default: --I)")
+    sweep_parser.add_argument("--metrics-buffer", type=int, default=1024, help = "samples kept in memory before they are written out")
+
+    worker_parser = subparsers.add_parser("worker", help = "run the tasks of a sweep queue")
+    worker_parser.add_argument("queue", type=str, help = "folder written by sweep --queue")
+    worker_parser.add_argument("--processes", type=int, default=1, help = "worker processes on this machine")
+    worker_parser.add_argument("--stale", type=float, default=None, help = "seconds after which a task claimed by a worker that did not finish it is run again")
+
+    merge_parser = subparsers.add_parser("merge", help = "compile the results of a sweep queue")
+    merge_parser.add_argument("queue", type=str, help = "folder written by sweep --queue")
+    merge_parser.add_argument("--report", type=str, default=None, help = "CSV report (default: <queue>/sweep.csv)")
+    merge_parser.add_argument("--index", type=str, default=None, help = "CSV index of the tasks with their seed, worker and time series (default: <queue>/tasks.csv)")
+
+    render_parser = subparsers.add_parser("render", help = "draw the block trees of a checkpoint")
+    render_parser.add_argument("checkpoint", type=str, help = "checkpoint written by run --checkpoint")
+    render_parser.add_argument("--peer", type=int, action="append", default=None, help = "only draw the tree of this peer; repeat for several peers")
+    render_parser.add_argument("--html", type=str, default=None, help = "draw the merged block tree of all the peers into this HTML file instead")
+    render_parser.add_argument("--output-workers", type=int, default=4, help = "threads writing the trees, plots and other outputs in the background, 0 to write them in the main thread")
+
+    analyze_parser = subparsers.add_parser("analyze", help = "print the metrics of a checkpoint")
+    analyze_parser.add_argument("checkpoint", type=str, help = "checkpoint written by run --checkpoint")
+    analyze_parser.add_argument("--propagation", type=str, default=None, help = "also write the block propagation delays to this file; needs numpy")
+
+    batch_parser = subparsers.add_parser("batch", help = "run the scenarios of a scenario file")
+    batch_parser.add_argument("file", type=str, help = "scenario file (.json, .toml, .yaml or .yml)")
+    batch_parser.add_argument("--workers", type=int, default=1, help = "worker processes, each runs the scenarios of one topology")
+    batch_parser.add_argument("--index", type=str, default=None, help = "CSV index of the results (default: <file>_index.csv)")
+    batch_parser.add_argument("--output-workers", type=int, default=4, help = "threads per worker process writing the outputs of a scenario while the next one runs, 0 to write them before it starts")
+
+    replay_parser = subparsers.add_parser("replay", help = "rebuild the outputs of a run from its event trace")
+    replay_parser.add_argument("trace", type=str, help = "trace written by run --trace")
+    replay_parser.add_argument("--directory", type=str, default="", help = "folder for MPU.txt and the trees (default: the current directory)")
+    replay_parser.add_argument("--plots", action="store_true", help = "also draw the trees with graphviz")
+    replay_parser.add_argument("--html", type=str, default=None, help = "also draw the merged block tree into this HTML file")
+    replay_parser.add_argument("--propagation", type=str, default=None, help = "also write the block propagation delays to this file; needs numpy")
+    replay_parser.add_argument("--output-workers", type=int, default=4, help = "threads writing the trees, plots and other outputs in the background, 0 to write them in the main thread")
+
+    regress_parser = subparsers.add_parser("regress", help = "check the outputs and the speed of seeded scenarios against golden files")
+    regress_parser.add_argument("--golden", type=str, default="golden", help = "folder of the golden files")
+    regress_parser.add_argument("--update", action="store_true", help = "write the golden files from this version instead of comparing")
+    regress_parser.add_argument("--scenario", type=str, action="append", default=None, help = "only run this scenario; repeat for several")
+    regress_parser.add_argument("--wall-tolerance", type=float, default=0.5, help = "allowed relative slowdown over the baseline wall time")
+    regress_parser.add_argument("--memory-tolerance", type=float, default=0.25, help = "allowed relative increase of the peak memory")
+    regress_parser.add_argument("--repeat", type=int, default=3, help = "runs per scenario, the fastest one is timed")
+    regress_parser.add_argument("--child", type=str, default=None, help = argparse.SUPPRESS)
+
+    bench_parser = subparsers.add_parser("bench", help = "measure the speed of the simulator")
+    add_simulation_options(bench_parser)
+    bench_parser.add_argument("--repeat", type=int, default=3, help = "number of timed runs")
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Options without a subcommand are the historical command line of run
+    if len(argv) == 0 or argv[0].startswith("-") and argv[0] not in ("-h", "--help"):
+        argv = ["run"] + argv
+    args = build_parser().parse_args(argv)
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
 
-# python3 run_selfish.py --n 25 --z1 0.4 --Ttx 1000000 --I 6000 --time 5000000 --Z 75 > out.txt
\ No newline at end of file
+# python3 run_selfish.py run --n 25 --z1 0.4 --Ttx 1000000 --I 6000 --time 5000000 --Z 75 > out.txt
@@ -0,0 +1,98 @@
+import json
+import os
+import topology
+
+# Keys of a scenario that are not options of the run subcommand
+SCENARIO_KEYS = ["name", "adversaries", "output"]
+
+def read_file(filename):
+    """
+    Parse a JSON, TOML or YAML file according to its extension
+
+    TOML needs Python 3.11 (or the tomli package), YAML needs the PyYAML package.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".json":
+        with open(filename) as f:
+            return json.load(f)
+    if extension == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ValueError(f"Reading {filename} needs Python 3.11 or the tomli package")
+        with open(filename, "rb") as f:
+            return tomllib.load(f)
+    if extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError(f"Reading {filename} needs the PyYAML package")
+        with open(filename) as f:
+            return yaml.safe_load(f)
+    raise ValueError(f"Unknown scenario format '{extension}', expected .json, .toml, .yaml or .yml")
+
+def load_scenarios(filename):
+    """
+    Read a scenario file
+
+    The file holds an optional "defaults" table and a list of "scenarios". Every scenario is
+    a table of options of the run subcommand (n, z1, slow, Ttx, I, time, link, relay, seed, ...)
+    plus a name, a list of adversaries ({h, Z, strategy}) and output options
+    ({directory, plots, metrics}). Options missing from a scenario are taken from the defaults.
+
+    returns: a list of scenarios, each a dictionary with the defaults applied
+    """
+    data = read_file(filename)
+    if not isinstance(data, dict) or not isinstance(data.get("scenarios"), list) or len(data["scenarios"]) == 0:
+        raise ValueError(f"{filename} has no list of scenarios")
+
+    defaults = data.get("defaults", {})
+    scenarios = []
+    names = set([])
+    for i, entry in enumerate(data["scenarios"]):
+        scenario = dict(defaults)
+        scenario.update(entry)
+        scenario["output"] = dict(defaults.get("output", {}))
+        scenario["output"].update(entry.get("output", {}))
+        scenario.setdefault("name", f"scenario_{i}")
+        if scenario["name"] in names:
+            raise ValueError(f"Scenario name '{scenario['name']}' is used twice in {filename}")
+        names.add(scenario["name"])
+        scenarios.append(scenario)
+    return scenarios
+
+def scenario_options(scenario):
+    """
+    Options of the run subcommand given by a scenario, named like the parsed arguments
+
+    The adversaries are turned into --adv entries and the output options into plots.
+    """
+    options = {}
+    for key, value in scenario.items():
+        if key not in SCENARIO_KEYS:
+            options[key.replace("-", "_")] = value
+
+    adversaries = scenario.get("adversaries")
+    if adversaries is not None:
+        adv = []
+        for entry in adversaries:
+            fields = [str(entry["h"]), str(entry["Z"])]
+            if "strategy" in entry:
+                fields.append(entry["strategy"])
+            adv.append(",".join(fields))
+        options["adv"] = adv
+
+    options["plots"] = scenario["output"].get("plots", False)
+    return options
+
+def topology_key(scenario, args, num_advs):
+    """
+    Scenarios with the same key are built on the same Topology: same honest peers, classes, model, parameters and seed
+    """
+    seed = args.topology_seed if args.topology_seed is not None else args.seed
+    model = args.topology if args.topology is not None else "random"
+    params = tuple(sorted(topology.parse_params(args.topology_param).items()))
+    return (args.n - num_advs, args.z1, args.slow, seed, model, params)
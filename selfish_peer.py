@@ -1,11 +1,9 @@
-import random
 from transaction import Transaction
 from block import Block
 from tree import Node
-import graphviz
 import os
-import json
 from peer import Peer
+from fork_choice import chain_change
 
 class SelfishPeer(Peer):
     """
@@ -67,28 +65,60 @@ class SelfishPeer(Peer):
         Disconnect the peer from the network
         """
         self.neighbors = []
+
+    def mempool_size(self):
+        """
+        Number of known transactions that are not in the private chain yet
+        """
+        if self.network.fluid is not None:
+            return self.network.fluid.backlog(self.hidden_longest)
+        return len(self.pending)
+
+    def move_hidden(self, block):
+        """
+        Make block the tip of the private chain, pending and confirmed follow it by delta like on_reorg does for the longest chain
+        """
+        if block is self.hidden_longest:
+            return
+        change = chain_change(self.hidden_longest, block)
+        for blk in change.disconnected:
+            self.confirmed -= blk.transactions
+            self.pending |= blk.transactions & self.transactions
+        for blk in change.connected:
+            self.confirmed |= blk.transactions
+            self.pending -= blk.transactions
+        self.hidden_longest = block
     
-    def generate_transactions(self, Ttx, peers):
+    def generate_transactions(self, Ttx, peers, pending=None):
         """
         Generate transactions at a rate of Ttx
 
         Ttx: mean interarrival time of transactions
         peers: list of all peers in the network
+        pending: (time left, coins) of the transaction that was awaited when a checkpoint was taken, None to draw a new one
 
         returns: a generator
         """
         while True:
-            r = random.expovariate(1/Ttx) # same as exponential distribution with mean Ttx
-            coins = random.randint(1, 5)
+            if pending is None:
+                r = self.rng.expovariate(1/Ttx) # same as exponential distribution with mean Ttx
+                coins = self.rng.randint(1, 5)
+            else:
+                r, coins = pending
+                pending = None
+            self.next_transaction = (self.env.now + r, coins)
             yield self.env.timeout(r)
+            self.next_transaction = None
 
-            receiver = random.choice(peers)
+            receiver = self.rng.choice(peers)
             while receiver == self:
-                receiver = random.choice(peers)
+                receiver = self.rng.choice(peers)
             # generate a random transaction id by hashing the sender, receiver and time
             id = hash(str(self.id) + str(receiver.id) + str(self.env.now))
 
             transaction = Transaction(id, self, receiver, coins, self.env.now)
+            if self.network.tracer is not None:
+                self.network.tracer.transactions += 1
             yield self.env.process(self.forward_transaction(transaction))
 
             print(f"Peer {self.id} generated transaction {id} at time {self.env.now}")
@@ -97,13 +127,18 @@ class SelfishPeer(Peer):
         """
         Receive a transaction from a sender
         """
+        if transaction.id in self.final_ids:
+            # Late copy of a transaction that is already below the pruning checkpoint
+            return
         self.transactions.add(transaction) # add the transaction to the set of transactions 
+        if transaction not in self.confirmed:
+            self.pending.add(transaction)
         # change routing table to not send transaction back to sender
         if sender in self.transaction_routing_table.keys():
             if transaction.id not in self.transaction_routing_table[sender]:
-                self.transaction_routing_table[sender].append(transaction.id)
+                self.transaction_routing_table[sender].add(transaction.id)
         else:
-            self.transaction_routing_table[sender] = [transaction.id]
+            self.transaction_routing_table[sender] = set([transaction.id])
         yield self.env.process(self.forward_transaction(transaction))
 
     def forward_transaction(self, transaction):
@@ -114,20 +149,32 @@ class SelfishPeer(Peer):
         """
         # Forward a transaction to all neighbors
         # The structure of self.transaction_routing_table is:
-        # {recipient_peer: [list of TxIDs either sent to or received from this peer]}
+        # {recipient_peer: set of TxIDs either sent to or received from this peer}
+        if transaction.id in self.final_ids:
+            return
+        if self.network.tx_relay == "trickle":
+            self.queue_transaction(transaction)
+            return
+
+        self.start_relay("transaction", transaction.id, transaction)
         for n in self.neighbors:
             id = transaction.id
             if n in self.transaction_routing_table.keys():
                 # Send this transaction to the neighbor if it has not been sent to it before (to avoid loops)
                 # print(f"Peer {self.id} is sending transaction {id} to peer {n.id}")
                 if id not in self.transaction_routing_table[n]:
-                    self.transaction_routing_table[n].append(id)
-                    yield self.env.process(self.network.send_transaction(self, n, transaction))
+                    self.transaction_routing_table[n].add(id)
+                    send = self.env.process(self.network.send_transaction(self, n, transaction))
+                    if self.network.broadcast == "sequential":
+                        yield send
             else:
                 # Send this transaction to that neighbor 
                 # print(f"Peer {self.id} is sending transaction {id} to peer {n.id}")
-                self.transaction_routing_table[n] = [id]
-                yield self.env.process(self.network.send_transaction(self, n, transaction))
+                self.transaction_routing_table[n] = set([id])
+                send = self.env.process(self.network.send_transaction(self, n, transaction))
+                if self.network.broadcast == "sequential":
+                    yield send
+        self.end_relay("transaction", transaction.id)
 
 
     def receive_block(self, sender, block):
@@ -138,6 +185,10 @@ class SelfishPeer(Peer):
         """
         # Receive a block from a peer
         #print("receive called")
+        if block.height <= self.root.block.height:
+            # Late copy of a block that has been collapsed into a pruning checkpoint (its balances are gone)
+            return
+
         isValid = block.validate()
         if not isValid:
             # print("Block is not valid")
@@ -148,8 +199,14 @@ class SelfishPeer(Peer):
         print("Current block ID : ", block.blkid)
         print("Previous block ID : ", block.prevblock.blkid)
         to_create = False
+        connected = False
+
+        if block.prevblock.blkid not in self.node_block_map.keys() and block.blkid not in self.node_block_map.keys():
+            # The parent has not arrived yet, keep the block until it does
+            self.buffer_orphan(sender, block)
 
         if block.prevblock.blkid in self.node_block_map.keys() and block.blkid not in self.node_block_map.keys():
+            connected = True
             # Add the block to the tree
             print("Previous block is: ", block.prevblock.blkid)
             parent = self.node_block_map[block.prevblock.blkid]
@@ -167,6 +224,8 @@ class SelfishPeer(Peer):
 
             # Update the node_block_map
             self.node_block_map[block.blkid] = node
+            if self.network.tracer is not None:
+                self.network.tracer.block_received(self, sender, block)
     
             print("Block height", block.height)
             print("Old longest chain height", self.longest_chain.height)
@@ -177,9 +236,9 @@ class SelfishPeer(Peer):
 
             if sender in self.block_routing_table.keys():
                 if block.blkid not in self.block_routing_table[sender]:
-                    self.block_routing_table[sender].append(block.blkid)
+                    self.block_routing_table[sender].add(block.blkid)
             else:
-                self.block_routing_table[sender] = [block.blkid]
+                self.block_routing_table[sender] = set([block.blkid])
 
             # Assuming currently that block.height has the correct height
             if block.height > self.longest_chain.height or (block.height == self.longest_chain.height and block.timestamp > self.longest_chain.timestamp):
@@ -217,11 +276,13 @@ class SelfishPeer(Peer):
                         self.lead = 0
                         self.longest_chain = self.hidden_longest
                         # self.public_length = 0
-                        
-                        for blk in self.private_chain:
+
+                        # Blocks mined while the release is on the wire start a new private chain
+                        released = self.private_chain
+                        self.private_chain = []
+                        for blk in released:
                             # Also add the block to the tree
                             yield self.env.process(self.broadcast_block(blk))
-                        self.private_chain = []
                     elif(self.lead > 2):
                         print("Lead is ", self.lead)
                         self.lead = self.lead - 1
@@ -231,13 +292,13 @@ class SelfishPeer(Peer):
                         # Also add the block to the tree
                         yield self.env.process(self.broadcast_block(blk))
                     elif (self.lead == 0):
-                        self.hidden_longest = self.longest_chain
+                        self.move_hidden(self.longest_chain)
                         self.private_chain = []
                         self.lead = 0
                     elif (self.lead == -1):
                         self.lead = 0
                         self.private_chain = []
-                        self.hidden_longest = self.longest_chain
+                        self.move_hidden(self.longest_chain)
                 
                 # In stubborn mining
                 # Check the lead
@@ -276,150 +337,212 @@ class SelfishPeer(Peer):
                         # Also add the block to the tree
                         yield self.env.process(self.broadcast_block(blk))
                     elif (self.lead == 0):
-                        self.hidden_longest = self.longest_chain
+                        self.move_hidden(self.longest_chain)
                         self.private_chain = []
                         self.lead = 0
                     elif (self.lead == -1):
                         self.lead = 0
                         self.private_chain = []
-                        self.hidden_longest = self.longest_chain
+                        self.move_hidden(self.longest_chain)
 
         # Don't broadcast the block since it is adversary
         # yield self.env.process(self.broadcast_block(block))
 
-        if to_create:
+        extended = False
+        if connected:
+            extended = yield self.env.process(self.connect_orphans(block.blkid))
+        # A connected child is a longer chain and has already started mining on it
+        # With the mining scheduler every peer is always mining on its current tip
+        if to_create and not extended and self.network.scheduler is None:
             yield self.env.process(self.create_block())
             pass
         
 
-    def create_block(self):
+    def build_block(self):
         """
-        Create a block and broadcast it to all neighbors in the network 
+        Block with a random set of valid transactions on top of the private chain
+
+        returns: the block, None if it is not valid
         """
-        # Create a block
-        # while True:
-        print(self.id, " : Creating a block")
-        # yield self.env.timeout(self.id*1000)
-        longest_chain_transactions = self.hidden_longest.get_all_transactions()
-        valid_transactions = self.transactions - longest_chain_transactions
-        # print(self.transactions, longest_chain_transactions, valid_transactions)
-        num_transactions = random.randint(0, min(len(valid_transactions), 999))
-        transactions = random.sample(valid_transactions, num_transactions)
-        hidden_longest = self.hidden_longest
-        block = Block(hidden_longest, self.env.now, set(transactions), self.id)
+        if self.network.fluid is not None:
+            # Fluid transaction model: only the number of transactions is drawn
+            block = Block(self.hidden_longest, self.env.now, set([]), self.id, self.network.fluid.block_size(self.hidden_longest, self.rng))
+            block.validate()
+            return block
+
+        # Transactions of the private chain are already out of self.pending
+        valid_transactions = self.pending
+        num_transactions = self.rng.randint(0, min(len(valid_transactions), 999))
+        # Sorted, the order of a set depends on its history and a resumed checkpoint rebuilds it
+        transactions = self.rng.sample(sorted(valid_transactions, key=lambda t: t.id), num_transactions)
+        block = Block(self.hidden_longest, self.env.now, set(transactions), self.id)
 
         # Haven't checked if the block is valid or not
         # So, some transactions might get lost
         isValid = block.validate()
         if not isValid:
             print("Invalid block created")
+            return None
+        return block
+
+    def create_block(self):
+        """
+        Create a block and broadcast it to all neighbors in the network 
+        """
+        # Create a block
+        # while True:
+        print(self.id, " : Creating a block")
+        # yield self.env.timeout(self.id*1000)
+        block = self.build_block()
+        if block is None:
             return
 
         # Next block timestamp (tk + Tk)
-        Tk = random.expovariate(self.hashing_power/self.network.interarrival)
+        Tk = self.rng.expovariate(self.hashing_power/self.network.interarrival)
 
+        yield from self.wait_block(block, Tk)
+
+    def wait_block(self, block, Tk):
+        """
+        Wait until the block being mined is found, it is kept only if the private chain did not change meanwhile
+
+        block: block built on the private chain
+        Tk: mining time
+        """
+        entry = (block, self.env.now + Tk)
+        self.mining.append(entry)
         yield self.env.timeout(Tk)
-        
+        self.mining.remove(entry)
+
+        new_longest_chain = self.hidden_longest
+        if(new_longest_chain.blkid == block.prevblock.blkid):
+            yield self.env.process(self.block_mined(block))
+
+    def mine_block(self):
+        """
+        Called by the mining scheduler when this adversary wins the race, the block is found right away
+        """
+        print(self.id, " : Creating a block")
+        block = self.build_block()
+        if block is None:
+            return
+        yield self.env.process(self.block_mined(block))
+
+    def block_mined(self, block):
+        """
+        Add a block mined on top of the private chain and apply the selfish or stubborn strategy
+        """
         # In selfish mining
         # Check the lead
         # If the lead is -1, then broadcast the block and change the lead to 0
-        new_longest_chain = self.hidden_longest
-        if(new_longest_chain.blkid == hidden_longest.blkid):
-            self.num_gen += 1
-            if(self.isSelfish):
-                node = Node(block, self.env.now)
-                self.node_block_map[block.blkid] = node
-                parent = self.node_block_map[block.prevblock.blkid]
-                print("line 346")
-                print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
-                if node.block.blkid not in parent.children:
-                    print("Adding the node to the tree")
-                    print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
-                    parent.children.append(node.block.blkid)
-                    self.node_block_map[block.prevblock.blkid] = parent
-                    print("Hash of ", block.prevblock.blkid, hash(parent))
-                    print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
-                    pass 
-                self.node_block_map[block.blkid] = node
-                if(self.lead == -1):
-                    self.lead = 0
-                    self.public_length = 0
-                    self.private_chain = []
-                    self.longest_chain = block
-                    self.hidden_longest = block
-                    self.private_length = 0
-                    # Also, add the block to the tree
-                    
-                    yield self.env.process(self.broadcast_block(block))
-                else:
-                    self.private_chain.append(block)
-                    self.hidden_longest = block
-                    self.lead = self.lead + 1
-                    self.private_length = self.private_length + 1
-
-            # In stubborn mining
-            # Check the lead
-            # If the lead is -1, then don't broadcast the block but change the lead to 1
-            if(not self.isSelfish):
-                node = Node(block, self.env.now)
-                self.node_block_map[block.blkid] = node
-                parent = self.node_block_map[block.prevblock.blkid]
-                print("line 346")
-                print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
-                if node.block.blkid not in parent.children:
-                    print("Adding the node to the tree")
-                    print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
-                    parent.children.append(node.block.blkid)
-                    self.node_block_map[block.prevblock.blkid] = parent
-                    print("Hash of ", block.prevblock.blkid, hash(parent))
-                    print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
-                    pass 
-                self.node_block_map[block.blkid] = node
-                if(self.lead == -1):
-                    self.lead = 1
-                    self.private_chain.append(block)
-                    self.hidden_longest = block
-                    self.private_length = 1
-                    # Also, add the block to the tree
-                    
-                    yield self.env.process(self.broadcast_block(block))
-                else:
-                    self.private_chain.append(block)
-                    self.hidden_longest = block
-                    self.lead = self.lead + 1
-                    self.private_length = self.private_length + 1    
+        self.num_gen += 1
+        if self.network.tracer is not None:
+            self.network.tracer.block_created(self, block, len(self.pending))
+        if(self.isSelfish):
+            node = Node(block, self.env.now)
+            self.node_block_map[block.blkid] = node
+            parent = self.node_block_map[block.prevblock.blkid]
+            print("line 346")
+            print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
+            if node.block.blkid not in parent.children:
+                print("Adding the node to the tree")
+                print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
+                parent.children.append(node.block.blkid)
+                self.node_block_map[block.prevblock.blkid] = parent
+                print("Hash of ", block.prevblock.blkid, hash(parent))
+                print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
+                pass 
+            self.node_block_map[block.blkid] = node
+            if(self.lead == -1):
+                self.lead = 0
+                self.public_length = 0
+                self.private_chain = []
+                self.longest_chain = block
+                self.move_hidden(block)
+                self.private_length = 0
+                # Also, add the block to the tree
+                
+                yield self.env.process(self.broadcast_block(block))
+            else:
+                self.private_chain.append(block)
+                self.move_hidden(block)
+                self.lead = self.lead + 1
+                self.private_length = self.private_length + 1
 
+        # In stubborn mining
+        # Check the lead
+        # If the lead is -1, then don't broadcast the block but change the lead to 1
+        if(not self.isSelfish):
+            node = Node(block, self.env.now)
+            self.node_block_map[block.blkid] = node
+            parent = self.node_block_map[block.prevblock.blkid]
+            print("line 346")
+            print(f"{self.id} : Searching for {node.block.blkid} in {parent.children}")
+            if node.block.blkid not in parent.children:
+                print("Adding the node to the tree")
+                print("Edge from ", parent.block.blkid, " to ", node.block.blkid)
+                parent.children.append(node.block.blkid)
+                self.node_block_map[block.prevblock.blkid] = parent
+                print("Hash of ", block.prevblock.blkid, hash(parent))
+                print("New children array : ", self.node_block_map[block.prevblock.blkid].children)
+                pass 
+            self.node_block_map[block.blkid] = node
+            if(self.lead == -1):
+                self.lead = 1
+                self.private_chain.append(block)
+                self.move_hidden(block)
+                self.private_length = 1
+                # Also, add the block to the tree
+                
+                yield self.env.process(self.broadcast_block(block))
+            else:
+                self.private_chain.append(block)
+                self.move_hidden(block)
+                self.lead = self.lead + 1
+                self.private_length = self.private_length + 1
 
     def broadcast_block(self, block):
         """
         Broadcast the block to all the neighbors in the network and update the block_routing_table
         The structure of self.block_routing_table is:
-        {recipient_peer: [list of blockIDs either sent to or received from this peer]}
+        {recipient_peer: set of blockIDs either sent to or received from this peer}
         """
 
+        if self.network.tracer is not None:
+            self.network.tracer.adversary_release(self, block)
+
         # Same as sending transaction
+        self.start_relay("block", block.blkid, block)
         for n in self.neighbors:
             id = block.blkid
             if n in self.block_routing_table.keys():
                 # Send this block to that neighbor some how
                 if id not in self.block_routing_table[n]:
                     print(f"{self.id} Broadcasting block to {n.id}")
-                    self.block_routing_table[n].append(id)
+                    self.block_routing_table[n].add(id)
 
-                    yield self.env.process(self.network.send_block(self, n, block))
+                    send = self.env.process(self.network.send_block(self, n, block))
+                    if self.network.broadcast == "sequential":
+                        yield send
             else:
                 # Send this block to that neighbor some how
                 print(f"{self.id} Broadcasting block to {n.id}")
-                self.block_routing_table[n] = [id]
+                self.block_routing_table[n] = set([id])
 
-                yield self.env.process(self.network.send_block(self, n, block))
+                send = self.env.process(self.network.send_block(self, n, block))
+                if self.network.broadcast == "sequential":
+                    yield send
                 # print("Block sent")
             print("Block sent")
+        self.end_relay("block", block.blkid)
 
-    def print_tree(self, filename):
+    def tree_graph(self, filename):
         """
-        Print the tree in a file using graphviz
+        Graphviz graph of the tree, rendered to filename by print_tree
         """
+        # Only needed for the plots, kept out of the import of the simulator
+        import graphviz
+        import json
         f = graphviz.Digraph(filename, format='png')
 
         reverse_mapping = {}
@@ -476,26 +599,21 @@ class SelfishPeer(Peer):
 
         for e in edges:
             f.edge(e[0], e[1])
-        f.render()
+        return f
+
+    def print_tree(self, filename):
+        """
+        Print the tree in a file using graphviz
+        """
+        self.tree_graph(filename).render()
 
     def save_tree(self, filename):
         """
         Save the tree in a file using pickle
         """
-        if not os.path.exists(os.path.dirname(filename)):
-            os.makedirs(os.path.dirname(filename))
-
-        num_longest = 0
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-        curr_block = self.hidden_longest
-        prev_block = curr_block.prevblock
-
-        while prev_block is not None:
-            if curr_block.userid == self.id:
-                num_longest += 1
-                
-            curr_block = prev_block
-            prev_block = curr_block.prevblock
+        num_longest = self.hidden_longest.chain_counts(self.root).get(self.id, 0)
 
         with open(filename, 'w') as f:
 
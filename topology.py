@@ -0,0 +1,298 @@
+import hashlib
+import inspect
+import json
+import math
+import os
+import random
+import struct
+import sys
+from array import array
+
+def uniform_delays(n, rng, low=10, high=500):
+    """
+    Propagation delay in ms of every pair of peers drawn uniformly in [low, high] {(i, j): delay} with i < j
+    """
+    delays = {}
+    for i in range(n):
+        for j in range(i + 1, n):
+            delays[(i, j)] = rng.randint(low, high)
+    return delays
+
+def random_graph(n, rng, min_degree=4, max_degree=8):
+    """
+    Same construction as Network.generate_network: min_degree to max_degree random neighbors per peer
+    """
+    edges = set([])
+    for i in range(n):
+        num_neighbors = min(rng.randint(min_degree, max_degree), n - 1)
+        for j in rng.sample([k for k in range(n) if k != i], num_neighbors):
+            edges.add((min(i, j), max(i, j)))
+    return edges, uniform_delays(n, rng)
+
+def scale_free(n, rng, m=2):
+    """
+    Barabasi-Albert graph: every new peer links to m peers chosen with a probability proportional to their degree
+    """
+    m = max(1, min(m, n - 1))
+    # The first peers are fully linked, with n <= m + 1 that is the whole graph
+    seed = min(m + 1, n)
+    edges = set([])
+    # Every peer appears once per link, so a uniform draw in it follows the degrees
+    ends = []
+    for i in range(seed):
+        for j in range(i + 1, seed):
+            edges.add((i, j))
+            ends += [i, j]
+    for i in range(seed, n):
+        targets = set([])
+        while len(targets) < m:
+            targets.add(rng.choice(ends))
+        for j in targets:
+            edges.add((j, i))
+            ends += [i, j]
+    return edges, uniform_delays(n, rng)
+
+def small_world(n, rng, k=4, p=0.1):
+    """
+    Watts-Strogatz graph: a ring where every peer is linked to its k nearest peers, every link rewired with probability p
+    """
+    k = max(2, min(k, n - 1))
+    edges = set([])
+    for i in range(n):
+        for step in range(1, k//2 + 1):
+            j = (i + step) % n
+            if j != i:
+                edges.add((min(i, j), max(i, j)))
+    for i, j in sorted(edges):
+        if rng.random() < p:
+            new = rng.randrange(n)
+            if new != i and (min(i, new), max(i, new)) not in edges:
+                edges.discard((i, j))
+                edges.add((min(i, new), max(i, new)))
+    return edges, uniform_delays(n, rng)
+
+def geographic(n, rng, k=4, base=10, scale=500):
+    """
+    Peers placed uniformly in a unit square, linked to their k nearest peers, with a delay of base
+    plus scale times their distance (divided by the diagonal)
+    """
+    points = [(rng.random(), rng.random()) for i in range(n)]
+    distances = {}
+    for i in range(n):
+        for j in range(i + 1, n):
+            distances[(i, j)] = math.dist(points[i], points[j])/math.sqrt(2)
+
+    edges = set([])
+    for i in range(n):
+        nearest = sorted([j for j in range(n) if j != i], key=lambda j: distances[(min(i, j), max(i, j))])
+        for j in nearest[:k]:
+            edges.add((min(i, j), max(i, j)))
+    delays = {pair: int(base + scale*distance) for pair, distance in distances.items()}
+    return edges, delays
+
+def core_periphery(n, rng, core=None, links=2, core_delay=50):
+    """
+    A fully connected core of fast peers (core peers, default n/10) and a periphery where every peer links to
+    links random core peers. Delays inside the core are drawn in [10, core_delay], the others in [10, 500].
+    """
+    core = max(1, min(core if core is not None else n//10, n))
+    edges = set([])
+    for i in range(core):
+        for j in range(i + 1, core):
+            edges.add((i, j))
+    for i in range(core, n):
+        for j in rng.sample(range(core), min(links, core)):
+            edges.add((j, i))
+    delays = uniform_delays(n, rng)
+    for i in range(core):
+        for j in range(i + 1, core):
+            delays[(i, j)] = rng.randint(10, core_delay)
+    return edges, delays
+
+def star(n, rng):
+    """
+    One hub linked to every other peer
+    """
+    return core_periphery(n, rng, core=1, links=1)
+
+# Topology generators by name: generator(n, rng, **params) returns (set of links (i, j) with i < j, {(i, j): delay in ms})
+GENERATORS = {
+    "random": random_graph,
+    "scale-free": scale_free,
+    "small-world": small_world,
+    "geographic": geographic,
+    "core-periphery": core_periphery,
+    "star": star,
+}
+
+def connect(n, edges, rng):
+    """
+    Link every connected component to the first one, so that Network.check_graph does not replace the topology by a ring
+    """
+    component = list(range(n))
+    def find(i):
+        while component[i] != i:
+            component[i] = component[component[i]]
+            i = component[i]
+        return i
+    for i, j in edges:
+        component[find(i)] = find(j)
+
+    members = {}
+    for i in range(n):
+        members.setdefault(find(i), []).append(i)
+    groups = sorted(members.values())
+    for group in groups[1:]:
+        i, j = rng.choice(groups[0]), rng.choice(group)
+        edges.add((min(i, j), max(i, j)))
+
+def check_params(model, params):
+    """
+    Raise a ValueError if params has a name the generator of model does not take
+    """
+    accepted = [name for name in inspect.signature(GENERATORS[model]).parameters.keys() if name not in ("n", "rng")]
+    for key in params.keys():
+        if key not in accepted:
+            raise ValueError(f"Invalid parameter '{key}' for topology '{model}', expected one of {', '.join(accepted) if accepted else 'none'}")
+
+def parse_params(entries):
+    """
+    Parameters of a generator from a list of "key=value" strings (or a dictionary), numbers are converted
+    """
+    if entries is None:
+        return {}
+    if isinstance(entries, dict):
+        return dict(entries)
+    params = {}
+    for entry in entries:
+        key, _, value = entry.partition("=")
+        if not value:
+            raise ValueError(f"Invalid topology parameter '{entry}', expected key=value")
+        for kind in (int, float):
+            try:
+                value = kind(value)
+                break
+            except ValueError:
+                pass
+        params[key.replace("-", "_")] = value
+    return params
+
+class Topology:
+    """
+    Honest part of a network: the class of every honest peer, the links between honest peers
+    and their propagation delays
+
+    A topology does not depend on the adversaries, so scenarios that only differ in their
+    adversaries can be built on the same one. The Network then only draws the links and
+    delays of the adversaries.
+    """
+    def __init__(self, n, z1, slow=0.5, model="random", params=None, seed=None):
+        """
+        n: number of honest peers
+        z1: fraction of low CPU peers
+        slow: fraction of slow peers
+        model: name of the generator in GENERATORS
+        params: parameters of the generator
+        seed: seed of a generator of its own, None to draw from the global random generator
+        """
+        if model not in GENERATORS.keys():
+            raise ValueError(f"Unknown topology '{model}', expected one of {', '.join(GENERATORS.keys())}")
+        check_params(model, params if params is not None else {})
+        rng = random.Random(seed) if seed is not None else random
+        self.n = n
+        self.z1 = z1
+        self.slow = slow
+        self.model = model
+        self.params = dict(params) if params is not None else {}
+        self.seed = seed
+
+        self.slow_peers = set(rng.sample(range(n), int(n*slow)))
+        self.low_peers = set(rng.sample(range(n), int(n*z1)))
+
+        # Links between honest peers {(i, j)} and propagation delay in ms of every pair {(i, j): delay} with i < j
+        self.edges, self.delays = GENERATORS[model](n, rng, **self.params)
+        connect(n, self.edges, rng)
+
+    def peer_config(self, i):
+        """
+        Configuration of the honest peer i, as expected by Peer
+        """
+        num_low = len(self.low_peers)
+        config = {"speed": "slow" if i in self.slow_peers else "fast"}
+        if i in self.low_peers:
+            config["cpu"] = "low"
+            config["hashing power"] = 1/(10*self.n - 9*num_low) # 1/10 of the hashing power of a high CPU peer
+        else:
+            config["cpu"] = "high"
+            config["hashing power"] = 10/(10*self.n - 9*num_low) # 10 times the hashing power of a low CPU peer
+        return config
+
+    def save(self, filename):
+        """
+        Write the topology in a compact binary file: a JSON header, the links and the delays as arrays of integers
+
+        The file is written under a temporary name and renamed, so parallel runs can share a cache.
+        """
+        edges = sorted(self.edges)
+        header = json.dumps({
+            "n": self.n, "z1": self.z1, "slow": self.slow, "model": self.model, "params": self.params, "seed": self.seed,
+            "slow_peers": sorted(self.slow_peers), "low_peers": sorted(self.low_peers), "edges": len(edges), "byteorder": sys.byteorder,
+        }).encode()
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp = f"{filename}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            array("I", [i for edge in edges for i in edge]).tofile(f)
+            array("I", [self.delays[(i, j)] for i in range(self.n) for j in range(i + 1, self.n)]).tofile(f)
+        os.replace(temp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a topology written by save
+        """
+        with open(filename, "rb") as f:
+            length, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(length))
+            n = header["n"]
+            edges = array("I")
+            edges.fromfile(f, 2*header["edges"])
+            delays = array("I")
+            delays.fromfile(f, n*(n - 1)//2)
+        if header["byteorder"] != sys.byteorder:
+            edges.byteswap()
+            delays.byteswap()
+
+        topology = cls.__new__(cls)
+        for key in ["n", "z1", "slow", "model", "params", "seed"]:
+            setattr(topology, key, header[key])
+        topology.slow_peers = set(header["slow_peers"])
+        topology.low_peers = set(header["low_peers"])
+        topology.edges = set(zip(edges[0::2], edges[1::2]))
+        pairs = ((i, j) for i in range(n) for j in range(i + 1, n))
+        topology.delays = dict(zip(pairs, delays))
+        return topology
+
+def cache_file(directory, n, z1, slow, model, params, seed):
+    """
+    File of the topology (model, params, seed) for n honest peers in a cache folder
+    """
+    key = json.dumps([model, sorted(params.items()), n, z1, slow, seed])
+    return os.path.join(directory, f"{model}_{n}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.topo")
+
+def get_topology(n, z1, slow, model, params, seed, cache=None):
+    """
+    Topology (model, params, seed), read from the cache folder when it was generated before and added to it otherwise
+
+    cache: cache folder, None to always generate the topology
+    """
+    if cache is None:
+        return Topology(n, z1, slow, model, params, seed)
+    filename = cache_file(cache, n, z1, slow, model, params, seed)
+    if os.path.exists(filename):
+        return Topology.load(filename)
+    topology = Topology(n, z1, slow, model, params, seed)
+    topology.save(filename)
+    return topology
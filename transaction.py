@@ -17,6 +17,11 @@ class Transaction:
         self.amount = amount
         self.timestamp = timestamp
 
+    def __hash__(self):
+        # Sets of transactions iterate in the same order in every run (for a given PYTHONHASHSEED),
+        # the default hash follows the memory address
+        return self.id
+
     def __str__(self):
         output = f"{self.id}: {self.sender.id} pays {self.receiver.id} {self.amount} coins"
         return output
\ No newline at end of file
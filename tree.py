@@ -4,4 +4,7 @@ class Node:
         self.block = block
         self.timestamp = timestamp
 
-        self.children = [] # List of nodes that are children of this node
\ No newline at end of file
+        self.children = [] # List of nodes that are children of this node
+
+        # Set on the root of a pruned tree: {userid: blocks mined up to and including this block}
+        self.checkpoint_counts = None
\ No newline at end of file
@@ -0,0 +1,132 @@
+import json
+import os
+from html import escape
+
+class MergedTree:
+    """
+    Global block tree, the union of the trees of all the peers, with the arrival time of every block at every peer
+
+    The main chain is the longest chain of the first honest peer, the other blocks are on orphaned branches.
+    """
+    def __init__(self, peers, advs):
+        """
+        peers: list of honest peers
+        advs: list of adversaries
+        """
+        self.adv_ids = set([adv.id for adv in advs])
+        self.blocks = {} # {blkid: block}
+        self.children = {} # {blkid: [child blkid, ...]}
+        self.arrivals = {} # {blkid: {peer id: arrival time}}
+
+        for p in peers + advs:
+            for blkid, node in p.node_block_map.items():
+                if blkid not in self.blocks:
+                    self.blocks[blkid] = node.block
+                    self.children[blkid] = []
+                    self.arrivals[blkid] = {}
+                self.arrivals[blkid][p.id] = node.timestamp
+        for blkid, block in self.blocks.items():
+            if block.prevblock is not None and block.prevblock.blkid in self.children:
+                self.children[block.prevblock.blkid].append(blkid)
+
+        self.main_chain = set([])
+        curr_block = peers[0].longest_chain
+        while curr_block is not None:
+            self.main_chain.add(curr_block.blkid)
+            curr_block = curr_block.prevblock
+
+    def layout(self):
+        """
+        Position of every block: the column is its height and every branch gets its own row,
+        the main chain is on row 0
+
+        returns: {blkid: (column, row)}, number of rows
+        """
+        # Blocks without a parent in the tree: the genesis block, or the checkpoints of pruned trees
+        roots = sorted([blkid for blkid, block in self.blocks.items() if block.prevblock is None or block.prevblock.blkid not in self.blocks],
+                       key=lambda blkid: (blkid not in self.main_chain, self.blocks[blkid].height))
+        base = min(self.blocks[blkid].height for blkid in roots)
+
+        positions = {}
+        rows = 0
+        stack = []
+        for blkid in reversed(roots):
+            stack.append((blkid, None))
+        while stack:
+            blkid, row = stack.pop()
+            if row is None:
+                row = rows
+                rows += 1
+            positions[blkid] = (self.blocks[blkid].height - base, row)
+            # The child continuing the main chain (or the first one) stays on the row of its parent
+            children = sorted(self.children[blkid], key=lambda child: (child not in self.main_chain, self.blocks[child].timestamp))
+            for i, child in enumerate(reversed(children)):
+                stack.append((child, row if i == len(children) - 1 else None))
+        return positions, rows
+
+    def color(self, userid):
+        if userid in self.adv_ids:
+            return "#d62728"
+        if userid < 0:
+            return "#7f7f7f"
+        # Spread the honest miners around the color wheel
+        return f"hsl({(userid*137) % 360}, 55%, 60%)"
+
+    def write_html(self, filename, title="Block tree"):
+        """
+        Write the tree as a self-contained HTML page with an SVG drawing
+
+        Hovering a block shows its miner and height, clicking it lists its arrival time at every peer.
+        """
+        positions, rows = self.layout()
+        dx, dy, r = 40, 30, 9
+        columns = max(column for column, row in positions.values()) + 1
+        width, height = columns*dx + 2*dx, rows*dy + 2*dy
+
+        def center(blkid):
+            column, row = positions[blkid]
+            return dx + column*dx, dy + row*dy
+
+        shapes = []
+        for blkid, block in self.blocks.items():
+            if block.prevblock is None or block.prevblock.blkid not in positions:
+                continue
+            x1, y1 = center(block.prevblock.blkid)
+            x2, y2 = center(blkid)
+            dash = "" if blkid in self.main_chain else ' stroke-dasharray="4,3"'
+            shapes.append(f'<path d="M{x1},{y1} L{x1 + dx/2},{y2} L{x2},{y2}" fill="none" stroke="#999"{dash}/>')
+
+        data = {}
+        for blkid, block in self.blocks.items():
+            x, y = center(blkid)
+            adversary = block.userid in self.adv_ids
+            orphan = blkid not in self.main_chain
+            stroke = ' stroke="#000" stroke-width="3"' if adversary else ' stroke="#555"'
+            opacity = ' fill-opacity="0.4"' if orphan else ""
+            label = f"block {blkid}, height {block.height}, miner {block.userid}" + (" (adversary)" if adversary else "") + (", orphaned" if orphan else "")
+            shapes.append(f'<circle cx="{x}" cy="{y}" r="{r}" fill="{self.color(block.userid)}"{stroke}{opacity} data-id="{blkid}"><title>{escape(label)}</title></circle>')
+            data[str(blkid)] = {"label": label, "arrivals": sorted([[peer, time] for peer, time in self.arrivals[blkid].items()], key=lambda item: item[1])}
+
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            print(f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{escape(title)}</title>", file=f)
+            print("<style>body{font-family:sans-serif;margin:0;display:flex}#tree{overflow:auto;flex:1;height:100vh}"
+                  "#panel{width:320px;height:100vh;overflow:auto;border-left:1px solid #ccc;padding:8px;font-size:13px}"
+                  "circle{cursor:pointer}td{padding:0 8px}</style></head><body>", file=f)
+            print(f'<div id="tree"><svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">', file=f)
+            for shape in shapes:
+                print(shape, file=f)
+            print("</svg></div>", file=f)
+            print(f"<div id=\"panel\"><h3>{escape(title)}</h3><p>{len(self.blocks)} blocks, {len(self.main_chain)} on the main chain. "
+                  "Colors are miners, adversary blocks have a thick border, orphaned blocks are faded. Click a block for its arrival times.</p>"
+                  "<div id=\"details\"></div></div>", file=f)
+            print("<script>const blocks = " + json.dumps(data) + ";", file=f)
+            print("document.querySelectorAll('circle').forEach(c => c.addEventListener('click', () => {"
+                  "const b = blocks[c.dataset.id];"
+                  "let html = '<p>' + b.label + '</p><table><tr><th>peer</th><th>arrival</th><th>delay</th></tr>';"
+                  "const first = b.arrivals.length ? b.arrivals[0][1] : 0;"
+                  "for (const [peer, time] of b.arrivals) html += '<tr><td>' + peer + '</td><td>' + time.toFixed(1) + '</td><td>' + (time - first).toFixed(1) + '</td></tr>';"
+                  "document.getElementById('details').innerHTML = html + '</table>';"
+                  "}));</script></body></html>", file=f)
+        print(f"Merged tree written to {filename}")
@@ -0,0 +1,162 @@
+import json
+import os
+import socket
+import time
+import traceback
+
+class WorkQueue:
+    """
+    Queue of sweep tasks in a folder shared by the workers (a network file system for several machines)
+
+    Every task is a file of todo/. A worker claims a task by renaming it into claimed/, with its
+    name and the claim time in the new name: a rename is atomic, so only one worker gets each task.
+    Results are written to results/ (failures to failed/) one file per task, with the time series of
+    the task next to it when they were asked for, through a temporary file and a rename, so that a
+    reader never sees a partial file. No lock and no server is needed.
+    """
+    def __init__(self, directory):
+        """
+        directory: folder of the queue
+        """
+        self.directory = directory
+        self.todo = os.path.join(directory, "todo")
+        self.claimed = os.path.join(directory, "claimed")
+        self.results = os.path.join(directory, "results")
+        self.failed = os.path.join(directory, "failed")
+        # "@" separates the fields of the name of a claimed task
+        self.worker = f"{socket.gethostname()}-{os.getpid()}".replace("@", "-")
+
+    def create(self, description, tasks):
+        """
+        Write a new queue
+
+        description: data of the whole sweep, saved in queue.json
+        tasks: list of dictionaries, one per task
+        """
+        if os.path.exists(os.path.join(self.directory, "queue.json")):
+            raise ValueError(f"{self.directory} already holds a queue")
+        for folder in [self.todo, self.claimed, self.results, self.failed]:
+            os.makedirs(folder, exist_ok=True)
+        for i, task in enumerate(tasks):
+            self.write(os.path.join(self.todo, f"{i:06d}.json"), task)
+        self.write(os.path.join(self.directory, "queue.json"), dict(description, tasks=len(tasks)))
+
+    def write(self, filename, data):
+        temp = f"{filename}.{self.worker}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, filename)
+
+    def description(self):
+        with open(os.path.join(self.directory, "queue.json")) as f:
+            return json.load(f)
+
+    def claim(self):
+        """
+        Take the first task nobody claimed
+
+        returns: (task name, claimed file, task) or None once todo/ is empty
+        """
+        for name in sorted(os.listdir(self.todo)):
+            if not name.endswith(".json"):
+                continue
+            task = name[:-len(".json")]
+            claimed = os.path.join(self.claimed, f"{task}@{self.worker}@{time.time():.0f}.json")
+            try:
+                os.rename(os.path.join(self.todo, name), claimed)
+            except FileNotFoundError:
+                # Another worker was faster
+                continue
+            with open(claimed) as f:
+                return task, claimed, json.load(f)
+        return None
+
+    def complete(self, task, claimed, result, metrics=None):
+        """
+        metrics: temporary file of the time series of the task, moved to results/<task>.csv if the task wrote it
+        """
+        if metrics is not None and os.path.exists(metrics):
+            os.replace(metrics, os.path.join(self.results, f"{task}.csv"))
+            result = dict(result, metrics=f"{task}.csv")
+        self.write(os.path.join(self.results, f"{task}.json"), dict(result, worker=self.worker))
+        self.release(claimed)
+
+    def fail(self, task, claimed, error, metrics=None):
+        if metrics is not None and os.path.exists(metrics):
+            os.remove(metrics)
+        self.write(os.path.join(self.failed, f"{task}.json"), {"worker": self.worker, "error": error})
+        self.release(claimed)
+
+    def release(self, claimed):
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            # Requeued as stale in the meantime, the task runs again with the same seed
+            pass
+
+    def requeue_stale(self, timeout):
+        """
+        Put back into todo/ the tasks claimed more than timeout seconds ago and not finished (their worker died)
+
+        returns: number of requeued tasks
+        """
+        requeued = 0
+        now = time.time()
+        for name in os.listdir(self.claimed):
+            if not name.endswith(".json"):
+                continue
+            task, worker, claimed_at = name[:-len(".json")].split("@")
+            if now - float(claimed_at) < timeout or os.path.exists(os.path.join(self.results, f"{task}.json")):
+                continue
+            try:
+                os.rename(os.path.join(self.claimed, name), os.path.join(self.todo, f"{task}.json"))
+                requeued += 1
+            except FileNotFoundError:
+                pass
+        return requeued
+
+    def work(self, run, stale=None):
+        """
+        Run tasks until none is left
+
+        run: function of a task and of the file its time series are written to (if it asks for them),
+        returning its result as a dictionary
+        stale: seconds after which a claimed task is given to another worker, None to never requeue
+
+        returns: number of tasks done by this worker
+        """
+        done = 0
+        while True:
+            if stale is not None:
+                self.requeue_stale(stale)
+            claim = self.claim()
+            if claim is None:
+                return done
+            task, claimed, data = claim
+            metrics = os.path.join(self.results, f"{task}.csv.{self.worker}.tmp")
+            try:
+                result = run(data, metrics)
+            except Exception:
+                print(f"Task {task} failed on {self.worker}")
+                self.fail(task, claimed, traceback.format_exc(), metrics)
+                continue
+            self.complete(task, claimed, result, metrics)
+            done += 1
+
+    def status(self):
+        """
+        Number of tasks waiting, claimed, done and failed
+        """
+        return {name: len([f for f in os.listdir(folder) if f.endswith(".json")])
+                for name, folder in [("todo", self.todo), ("claimed", self.claimed), ("done", self.results), ("failed", self.failed)]}
+
+    def collect(self):
+        """
+        Results of the finished tasks {task name: result}
+        """
+        results = {}
+        for name in sorted(os.listdir(self.results)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.results, name)) as f:
+                    results[name[:-len(".json")]] = json.load(f)
+        return results